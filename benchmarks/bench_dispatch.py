@@ -0,0 +1,70 @@
+"""Measure the cost of matching messages against the patterns of all kitchensink message handlers
+
+Compares plain regexes, as Slack Machine would use them, with the prefiltered patterns from
+``sm_kitchensink_plugin.dispatch``, over a synthetic corpus of chat messages.
+
+Run with: python benchmarks/bench_dispatch.py [number of messages]
+"""
+import random
+import sys
+import time
+
+from sm_kitchensink_plugin import BlockKit, ListeningAdvanced, ListeningBasics
+
+WORDS = (
+    "the a to and of in is it you that for on with this we be have are not at can do will just so but what "
+    "about if all my your our get deploy build ship review meeting today tomorrow lunch coffee thanks please "
+    "pinned spin opinion shopping happy sprint release bug fix merge branch ticket ok yes no maybe"
+).split()
+COMMANDS = ["reply", "wait", "dm reply", "list users dan", "greetings", "show bot info", "pin this", "interactions"]
+
+
+def collect_patterns():
+    patterns = []
+    for cls in (ListeningBasics, ListeningAdvanced, BlockKit):
+        for name in dir(cls):
+            metadata = getattr(getattr(cls, name), "metadata", None)
+            if metadata is not None:
+                for matcher in metadata.plugin_actions.listen_to + metadata.plugin_actions.respond_to:
+                    patterns.append(matcher.regex)
+    return patterns
+
+
+def corpus(size, seed=42):
+    rnd = random.Random(seed)
+    messages = []
+    for _ in range(size):
+        if rnd.random() < 0.02:
+            messages.append(rnd.choice(COMMANDS))
+        else:
+            messages.append(" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 30))))
+    return messages
+
+
+def dispatch(messages, patterns):
+    # mimics machine.handlers.message_handler.dispatch_listeners
+    matches = 0
+    start = time.perf_counter()
+    for text in messages:
+        for pattern in patterns:
+            if pattern.search(text):
+                matches += 1
+    return time.perf_counter() - start, matches
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    prefiltered = collect_patterns()
+    plain = [pattern.regex for pattern in prefiltered]
+    messages = corpus(size)
+    print(f"{len(prefiltered)} patterns, {size} messages")
+    plain_time, plain_matches = dispatch(messages, plain)
+    prefiltered_time, prefiltered_matches = dispatch(messages, prefiltered)
+    assert plain_matches == prefiltered_matches, "prefiltered dispatch should find the same matches"
+    print(f"plain regexes:      {plain_time / size * 1e6:6.2f} µs per message")
+    print(f"prefiltered:        {prefiltered_time / size * 1e6:6.2f} µs per message")
+    print(f"speedup:            {plain_time / prefiltered_time:6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Import time of the kitchensink plugins
+
+Imports each plugin class, and the whole package the way ``PLUGINS = ["sm_kitchensink_plugin"]`` does, in a fresh
+interpreter. Reports the total import time, the time spent in the kitchensink modules themselves, and which plugin
+modules got imported.
+
+The package imports its plugin modules with ``importlib``, which ``-X importtime`` doesn't report, so the modules are
+read from ``sys.modules`` instead. The time spent in the kitchensink modules is measured by importing the target again
+in another fresh interpreter, that imported all other modules the target needs beforehand.
+
+The script exits with status 1 if importing a single plugin pulls in the modules of other plugins, or if the time spent
+in the kitchensink modules exceeds the budget, so it can be used as a startup regression check. The budget is per
+plugin, so the whole package gets it once for every plugin.
+
+Run with: python benchmarks/bench_import.py [--repeat 5] [--budget-ms 50]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from typing import List, Optional, Tuple
+
+PACKAGE = "sm_kitchensink_plugin"
+PLUGIN_MODULES = {
+    "ListeningBasics": f"{PACKAGE}.listening_basics",
+    "ListeningAdvanced": f"{PACKAGE}.listening_advanced",
+    "SlashCommands": f"{PACKAGE}.slash_commands",
+    "BlockKit": f"{PACKAGE}.block_kit",
+    "Modals": f"{PACKAGE}.modals",
+}
+ALL = "all plugins"
+
+# runs in the fresh interpreter: imports the modules in argv[2] first, then times the statement in argv[1] and prints
+# the time and the modules it imported
+PROBE = """
+import json, sys, time
+for name in json.loads(sys.argv[2]):
+    try:
+        __import__(name)
+    except Exception:
+        pass
+before = set(sys.modules)
+started = time.perf_counter()
+exec(sys.argv[1])
+elapsed = time.perf_counter() - started
+print(json.dumps([elapsed * 1000, [name for name in sys.modules if name not in before]]))
+"""
+
+
+def statement(target: str) -> str:
+    if target == ALL:
+        # what Slack Machine does when the package is listed in PLUGINS
+        return f"import inspect, {PACKAGE}; inspect.getmembers({PACKAGE}, inspect.isclass)"
+    return f"from {PACKAGE} import {target}"
+
+
+def is_own(module: str) -> bool:
+    return module == PACKAGE or module.startswith(f"{PACKAGE}.")
+
+
+def probe(target: str, preload: List[str]) -> Tuple[float, List[str]]:
+    """Time of importing `target` in ms after importing `preload`, and the modules the import added, in order"""
+    proc = subprocess.run(
+        [sys.executable, "-c", PROBE, statement(target), json.dumps(preload)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed, modules = json.loads(proc.stdout)
+    return elapsed, modules
+
+
+def measure(target: str) -> Tuple[float, float, List[str]]:
+    """Total import time and time in the kitchensink modules in ms, and the kitchensink modules that were imported"""
+    total, modules = probe(target, [])
+    own, _ = probe(target, [module for module in modules if not is_own(module)])
+    return total, own, sorted(module for module in modules if is_own(module))
+
+
+def unexpected_modules(target: str, modules: List[str]) -> List[str]:
+    if target == ALL:
+        return []
+    return sorted(m for m in modules if m in PLUGIN_MODULES.values() and m != PLUGIN_MODULES[target])
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=5, help="imports per target, the median is reported")
+    parser.add_argument(
+        "--budget-ms", type=float, default=50.0, help="allowed time in the kitchensink modules per plugin"
+    )
+    args = parser.parse_args(argv)
+
+    failed = False
+    print(f"{'import':<20} {'total ms':>10} {'own ms':>10}  plugin modules")
+    for target in [*PLUGIN_MODULES, ALL]:
+        runs = [measure(target) for _ in range(args.repeat)]
+        total = statistics.median(run[0] for run in runs)
+        own = statistics.median(run[1] for run in runs)
+        modules = runs[0][2]
+        plugins = [m.rsplit(".", 1)[1] for m in modules if m in PLUGIN_MODULES.values()]
+        print(f"{target:<20} {total:>10.1f} {own:>10.1f}  {', '.join(plugins)}")
+        unexpected = unexpected_modules(target, modules)
+        if unexpected:
+            print(f"  importing {target} also imported {', '.join(unexpected)}")
+            failed = True
+        budget = args.budget_ms * max(1, len(plugins))
+        if own > budget:
+            print(f"  {own:.1f}ms spent in the kitchensink modules, over the budget of {budget:.1f}ms")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,507 @@
+"""End-to-end load test of the kitchensink plugins against a local fake Slack
+
+Runs Slack Machine with all plugins exported by ``sm_kitchensink_plugin``, connected to the fake Slack server from
+``fake_slack.py``, and pushes synthetic messages, block actions, modal submissions, slash commands and events through
+Socket Mode. Every scenario sends a few bursts of events that all trigger the same handler, and reports the median throughput,
+p50/p95/p99 latency of the handler and p50/p99 latency of acknowledging the events over those bursts.
+
+Results are written as JSON and compared against a stored baseline, the script exits with status 1 if a scenario
+regressed by more than the tolerance.
+
+By default the API scheduler's rate limits are lifted, so the results reflect the plugins rather than Slack's pacing.
+Pass ``--slack-rate-limits`` to keep them, and ``--latency`` and ``--rate-limit-ratio`` to make the fake Slack slow
+or make it push back.
+
+Run with: python benchmarks/bench_load.py [--events 200] [--output results.json] [--save-baseline]
+"""
+import argparse
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from machine.clients.slack import SlackClient
+from machine.core import Machine
+from machine.utils.collections import CaseInsensitiveDict
+from slack_sdk.socket_mode.aiohttp import SocketModeClient
+from slack_sdk.web.async_client import AsyncWebClient
+
+from fake_slack import BOT_USER_ID, TEAM_ID, FakeSlack, make_user
+from sm_kitchensink_plugin import api_scheduler
+from sm_kitchensink_plugin.api_scheduler import TIER_LIMITS, TokenBucket, scheduler
+
+DEFAULT_BASELINE = Path(__file__).with_name("load_baseline.json")
+
+Envelope = Tuple[str, Dict[str, Any]]
+
+
+class LoadTestMachine(Machine):
+    """Slack Machine that talks to the fake Slack instead of the real one"""
+
+    def __init__(self, settings: CaseInsensitiveDict, base_url: str):
+        super().__init__(settings)
+        self._base_url = base_url
+
+    async def _setup_slack_clients(self) -> None:
+        self._socket_mode_client = SocketModeClient(
+            app_token=self._settings["SLACK_APP_TOKEN"],
+            web_client=AsyncWebClient(token=self._settings["SLACK_BOT_TOKEN"], base_url=self._base_url),
+        )
+        self._client = SlackClient(self._socket_mode_client, self._tz)
+        await self._client.setup()
+
+
+class Recorder:
+    """Records how long every handler invocation takes"""
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.running = 0
+        self._changed = asyncio.Event()
+
+    def _record(self, name: str, duration: float, failed: bool):
+        self.running -= 1
+        self.durations[name].append(duration)
+        if failed:
+            self.errors[name] += 1
+        self._changed.set()
+
+    def wrap(self, name: str, fn: Callable) -> Callable:
+        if inspect.isasyncgenfunction(fn):
+
+            @functools.wraps(fn)
+            async def timed_generator(*args, **kwargs):
+                self.running += 1
+                start, failed = time.perf_counter(), True
+                try:
+                    async for item in fn(*args, **kwargs):
+                        yield item
+                    failed = False
+                finally:
+                    self._record(name, time.perf_counter() - start, failed)
+
+            return timed_generator
+
+        @functools.wraps(fn)
+        async def timed(*args, **kwargs):
+            self.running += 1
+            start, failed = time.perf_counter(), True
+            try:
+                result = await fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self._record(name, time.perf_counter() - start, failed)
+
+        return timed
+
+    def instrument(self, machine: Machine):
+        actions = machine._registered_actions
+        for handlers in (
+            actions.listen_to, actions.respond_to, actions.block_actions, actions.modal, actions.modal_closed
+        ):
+            for key, handler in handlers.items():
+                handler.function = self.wrap(self._name(key), handler.function)
+        for handler in actions.command.values():
+            name = f"{type(handler.class_).__name__}.{handler.function.__name__}"
+            handler.function = self.wrap(name, handler.function)
+        for handlers in actions.process.values():
+            for key, fn in handlers.items():
+                handlers[key] = self.wrap(self._name(key), fn)
+
+    @staticmethod
+    def _name(key: str) -> str:
+        # Slack Machine registers handlers under "<module>.<class>.<method>-<matcher>", the method name is used
+        # rather than the name of the function because decorators like require_any_role don't preserve it
+        return ".".join(key.split("-", 1)[0].rsplit(".", 2)[-2:])
+
+    async def wait(self, name: str, total: int, timeout: float):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while len(self.durations[name]) < total:
+            self._changed.clear()
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise TimeoutError(f"{name}: {len(self.durations[name])} of {total} invocations finished in time")
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_idle(self, fake: FakeSlack, settle: float, timeout: float):
+        """Wait until all events are acknowledged and no handler ran for `settle` seconds"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            self._changed.clear()
+            if fake.pending_acks or self.running:
+                await asyncio.sleep(0.05)
+                continue
+            try:
+                await asyncio.wait_for(self._changed.wait(), settle)
+            except asyncio.TimeoutError:
+                return
+        raise TimeoutError(f"{fake.pending_acks} events unacknowledged, {self.running} handlers running")
+
+
+class Events:
+    """Factory for Socket Mode envelopes"""
+
+    def __init__(self, fake: FakeSlack):
+        self.fake = fake
+
+    def user(self, i: int) -> Dict[str, Any]:
+        return self.fake.users[i % len(self.fake.users)]
+
+    def channel(self, i: int) -> Dict[str, Any]:
+        return self.fake.channels[i % len(self.fake.channels)]
+
+    def event(self, event: Dict[str, Any]) -> Envelope:
+        return "events_api", {"type": "event_callback", "team_id": TEAM_ID, "event": event}
+
+    def message(self, i: int, text: str) -> Envelope:
+        return self.event({
+            "type": "message",
+            "text": text,
+            "user": self.user(i)["id"],
+            "channel": self.channel(i)["id"],
+            "channel_type": "channel",
+            "ts": self.fake.next_ts(),
+            "team": TEAM_ID,
+        })
+
+    def slash_command(self, i: int, command: str, text: str = "") -> Envelope:
+        user, channel = self.user(i), self.channel(i)
+        return "slash_commands", {
+            "command": command,
+            "text": text,
+            "user_id": user["id"],
+            "user_name": user["name"],
+            "channel_id": channel["id"],
+            "channel_name": channel["name"],
+            "team_id": TEAM_ID,
+            "response_url": f"{self.fake.url}/response",
+            "trigger_id": f"trigger-{i}",
+        }
+
+    def _interaction_base(self, i: int, type_: str) -> Dict[str, Any]:
+        user = self.user(i)
+        return {
+            "type": type_,
+            "user": {"id": user["id"], "username": user["name"], "name": user["name"], "team_id": TEAM_ID},
+            "team": {"id": TEAM_ID, "domain": "kitchensink"},
+            "api_app_id": "A0001",
+            "token": "token",
+            "enterprise": None,
+            "is_enterprise_install": False,
+        }
+
+    def block_action(self, i: int, block_id: str, action_id: str, value: str = "", message_ts: str = "") -> Envelope:
+        channel = self.channel(i)
+        ts = message_ts or self.fake.next_ts()
+        payload = self._interaction_base(i, "block_actions")
+        payload.update({
+            "trigger_id": f"trigger-{i}",
+            "container": {"type": "message", "message_ts": ts, "channel_id": channel["id"], "is_ephemeral": False},
+            "channel": {"id": channel["id"], "name": channel["name"]},
+            "message": {
+                "user": BOT_USER_ID, "type": "message", "ts": ts, "bot_id": "BBOT", "app_id": "A0001",
+                "text": "fallback", "team": TEAM_ID, "blocks": [],
+            },
+            "state": {"values": {}},
+            "response_url": f"{self.fake.url}/response",
+            "actions": [{
+                "type": "button",
+                "action_id": action_id,
+                "block_id": block_id,
+                "action_ts": self.fake.next_ts(),
+                "text": {"type": "plain_text", "text": "Click", "emoji": True},
+                "value": value,
+            }],
+        })
+        return "interactive", payload
+
+    def _view(self, i: int) -> Dict[str, Any]:
+        return {
+            "id": f"V{i}",
+            "team_id": TEAM_ID,
+            "type": "modal",
+            "blocks": [],
+            "private_metadata": "",
+            "callback_id": "my_modal",
+            "state": {"values": {"modal_input": {"opinion": {"type": "plain_text_input", "value": f"opinion {i}"}}}},
+            "hash": "hash",
+            "title": {"type": "plain_text", "text": "My App", "emoji": True},
+            "clear_on_close": False,
+            "notify_on_close": True,
+            "close": None,
+            "submit": None,
+            "previous_view_id": None,
+            "root_view_id": f"V{i}",
+            "app_id": "A0001",
+            "external_id": "",
+            "app_installed_team_id": TEAM_ID,
+            "bot_id": "BBOT",
+        }
+
+    def view_submission(self, i: int) -> Envelope:
+        payload = self._interaction_base(i, "view_submission")
+        payload.update({"view": self._view(i), "trigger_id": f"trigger-{i}", "response_urls": []})
+        return "interactive", payload
+
+    def view_closed(self, i: int) -> Envelope:
+        payload = self._interaction_base(i, "view_closed")
+        payload.update({"view": self._view(i), "is_cleared": False})
+        return "interactive", payload
+
+    def reaction(self, i: int) -> Envelope:
+        # a handful of messages that everyone reacts to with the same few emoji
+        return self.event({
+            "type": "reaction_added",
+            "user": self.user(i)["id"],
+            "reaction": ("+1", "tada", "eyes", "rocket")[i % 4],
+            "item": {"type": "message", "channel": self.channel(i % 3)["id"], "ts": f"1700000000.{i % 10:06d}"},
+            "event_ts": self.fake.next_ts(),
+        })
+
+    def user_change(self, i: int) -> Envelope:
+        user = make_user(i % len(self.fake.users))
+        user["name"] = f"renamed{i:05d}"
+        return self.event({"type": "user_change", "user": user})
+
+    def app_home_opened(self, i: int) -> Envelope:
+        return self.event({"type": "app_home_opened", "user": self.user(i)["id"], "channel": "D0001", "tab": "home"})
+
+
+def scenarios(events: Events) -> List[Tuple[str, Callable[[int], Envelope]]]:
+    """Handler every scenario exercises, and the event to send for the i-th invocation"""
+    bot = f"<@{BOT_USER_ID}>"
+    return [
+        ("ListeningBasics.greetings", lambda i: events.message(i, "greetings")),
+        ("ListeningBasics.love", lambda i: events.message(i, f"{bot} I love you")),
+        ("ListeningBasics.list_users", lambda i: events.message(i, f"list users user{i % 10}")),
+        ("ListeningBasics.list_users_next_page", lambda i: events.block_action(
+            i, "users", "list_users_next", json.dumps(["", "user00099", "U00099"])
+        )),
+        ("ListeningBasics.list_all_users", lambda i: events.message(i, "list all users")),
+        ("ListeningBasics.reply_me", lambda i: events.message(i, "reply")),
+        ("ListeningBasics.reply_me_ephemeral", lambda i: events.message(i, "reply ephemeral")),
+        ("ListeningBasics.reply_me_in_thread", lambda i: events.message(i, "reply in thread")),
+        ("ListeningBasics.dm", lambda i: events.message(i, "dm reply")),
+        ("ListeningBasics.blocks", lambda i: events.message(i, "show blocks")),
+        ("ListeningBasics.blocks_raw", lambda i: events.message(i, "show blocks raw")),
+        ("ListeningBasics.update_user_directory", events.user_change),
+        ("ListeningAdvanced.admin", lambda i: events.message(i, "do secret stuff")),
+        ("ListeningAdvanced.trigger_plugin_event", lambda i: events.message(i, "trigger my-plugin-event")),
+        ("ListeningAdvanced.wait", lambda i: events.message(i, "wait")),
+        ("ListeningAdvanced.dm_scheduled", lambda i: events.message(i, "dm reply scheduled")),
+        ("ListeningAdvanced.pin_message", lambda i: events.message(i, "please pin this")),
+        ("ListeningAdvanced.match_reaction", events.reaction),
+        ("ListeningAdvanced.info", lambda i: events.message(i, "show bot info")),
+        ("BlockKit.interactions", lambda i: events.message(i, "interactions")),
+        ("BlockKit.interactions_logger", lambda i: events.block_action(
+            i, "interaction_feelings", f"feeling_{i % 3}", message_ts="1700000000.000001"
+        )),
+        ("BlockKit.order_lunch", lambda i: events.message(i, f"{bot} order lunch")),
+        ("BlockKit.lunch_action", lambda i: events.block_action(
+            i, ("lunch_sushi", "lunch_hamburger", "lunch_ramen")[i % 3], "vote", message_ts="1700000000.000002"
+        )),
+        ("Modals.home_tab_opened", events.app_home_opened),
+        ("Modals.modal_command", lambda i: events.slash_command(i, "/modal")),
+        ("Modals.handle_modal", events.view_submission),
+        ("Modals.handle_modal_closed", events.view_closed),
+        ("SlashCommands.hello_command", lambda i: events.slash_command(i, "/hello", f"load test {i}")),
+    ]
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def lift_rate_limits():
+    # The scheduler is a module level singleton that the plugins already installed, so its buckets are replaced
+    for tier in TIER_LIMITS:
+        scheduler._tier_buckets[tier] = TokenBucket(rate=1e9, capacity=1e9)
+    scheduler._channel_buckets.clear()
+    api_scheduler.CHANNEL_RATE = 1e9
+
+
+async def run_round(
+    fake: FakeSlack, recorder: Recorder, name: str, make_event: Callable[[int], Envelope], args: argparse.Namespace
+) -> Dict[str, Any]:
+    """Send a burst of events and wait until the handler has processed all of them"""
+    acks, done = len(fake.ack_latencies), len(recorder.durations[name])
+    errors = recorder.errors[name]
+    start = time.perf_counter()
+    for i in range(args.events):
+        await fake.send(*make_event(i))
+    try:
+        await recorder.wait(name, done + args.events, args.timeout)
+    except TimeoutError as e:
+        print(f"  {e}", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    durations = recorder.durations[name][done:]
+    ack_latencies = fake.ack_latencies[acks:]
+    return {
+        "events": len(durations),
+        "errors": recorder.errors[name] - errors,
+        "throughput": round(len(durations) / elapsed, 1),
+        "p50_ms": round(percentile(durations, 50) * 1000, 3),
+        "p95_ms": round(percentile(durations, 95) * 1000, 3),
+        "p99_ms": round(percentile(durations, 99) * 1000, 3),
+        "ack_p50_ms": round(percentile(ack_latencies, 50) * 1000, 3),
+        "ack_p99_ms": round(percentile(ack_latencies, 99) * 1000, 3),
+    }
+
+
+async def start_machine(fake: FakeSlack, base_url: str, **settings: Any) -> Tuple[LoadTestMachine, asyncio.Task]:
+    """Run Slack Machine with all kitchensink plugins against the fake Slack, until it's connected"""
+    machine = LoadTestMachine(CaseInsensitiveDict({
+        "PLUGINS": ["sm_kitchensink_plugin"],
+        "STORAGE_BACKEND": "machine.storage.backends.memory.MemoryStorage",
+        "HTTP_PROXY": None,
+        "TZ": "UTC",
+        "LOGLEVEL": "CRITICAL",
+        "LOG_HANDLED_MESSAGES": False,
+        "SLACK_APP_TOKEN": "xapp-load-test",
+        "SLACK_BOT_TOKEN": "xoxb-load-test",
+        "KITCHENSINK_REACTION_RATE": "1000000",
+        **settings,
+    }), base_url)
+    machine_task = asyncio.create_task(machine.run())
+    connected = asyncio.create_task(fake.wait_connected())
+    await asyncio.wait([machine_task, connected], return_when=asyncio.FIRST_COMPLETED)
+    if machine_task.done():
+        connected.cancel()
+        machine_task.result()
+    await connected
+    logging.getLogger().setLevel(logging.CRITICAL)
+    return machine, machine_task
+
+
+async def stop_machine(fake: FakeSlack, machine: LoadTestMachine, machine_task: asyncio.Task):
+    machine_task.cancel()
+    await asyncio.gather(machine_task, return_exceptions=True)
+    await machine.close()
+    await fake.stop()
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    fake = FakeSlack(
+        users=args.users, channels=args.channels, latency=args.latency, rate_limit_ratio=args.rate_limit_ratio
+    )
+    base_url = await fake.start()
+    machine, machine_task = await start_machine(fake, base_url)
+    if not args.slack_rate_limits:
+        lift_rate_limits()
+    recorder = Recorder()
+    recorder.instrument(machine)
+    events = Events(fake)
+
+    results: Dict[str, Any] = {}
+    for name, make_event in scenarios(events):
+        if args.only and not any(only in name for only in args.only):
+            continue
+        rounds = [await run_round(fake, recorder, name, make_event, args) for _ in range(args.repeat)]
+        # the median of every metric over the rounds, to smooth out noise
+        results[name] = {metric: statistics.median(r[metric] for r in rounds) for metric in rounds[0]}
+        print_result(name, results[name])
+
+    await stop_machine(fake, machine, machine_task)
+    return {
+        "meta": {
+            "events": args.events,
+            "repeat": args.repeat,
+            "users": args.users,
+            "channels": args.channels,
+            "latency": args.latency,
+            "rate_limit_ratio": args.rate_limit_ratio,
+            "slack_rate_limits": args.slack_rate_limits,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "api_calls": dict(fake.calls),
+            "rate_limited": dict(fake.rate_limited),
+        },
+        "scenarios": results,
+    }
+
+
+def print_result(name: str, result: Dict[str, Any]):
+    print(
+        f"{name:42} {result['events']:6} ev {result['errors']:4} err {result['throughput']:9.1f}/s  "
+        f"p50 {result['p50_ms']:8.3f}ms  p95 {result['p95_ms']:8.3f}ms  p99 {result['p99_ms']:8.3f}ms  "
+        f"ack p50 {result['ack_p50_ms']:7.3f}ms  p99 {result['ack_p99_ms']:7.3f}ms"
+    )
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, min_delta_ms: float) -> List[str]:
+    """Scenarios whose throughput dropped, or whose p95 latency rose, by more than `tolerance` vs the baseline"""
+    regressions = []
+    for name, base in baseline["scenarios"].items():
+        current = results["scenarios"].get(name)
+        if current is None:
+            continue
+        if current["errors"] > base["errors"]:
+            regressions.append(f"{name}: {current['errors']} errors, baseline {base['errors']}")
+        if current["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {current['throughput']}/s, baseline {base['throughput']}/s")
+        if (
+            current["p95_ms"] > base["p95_ms"] * (1 + tolerance)
+            and current["p95_ms"] - base["p95_ms"] > min_delta_ms
+        ):
+            regressions.append(f"{name}: p95 {current['p95_ms']}ms, baseline {base['p95_ms']}ms")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--events", type=int, default=200, help="events per scenario")
+    parser.add_argument("--repeat", type=int, default=3, help="rounds per scenario, the median is reported")
+    parser.add_argument("--users", type=int, default=1000, help="users in the fake workspace")
+    parser.add_argument("--channels", type=int, default=100, help="channels in the fake workspace")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every Web API call takes")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="fraction of Web API calls that get a 429")
+    parser.add_argument("--slack-rate-limits", action="store_true", help="keep the API scheduler's rate limits")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for a scenario to finish")
+    parser.add_argument("--only", nargs="*", help="only run scenarios whose name contains one of these strings")
+    parser.add_argument("--output", type=Path, help="write the results to this JSON file")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="baseline to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="ignore latency regressions below this")
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+        return 0
+    regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance, args.min_delta_ms)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regressions compared to {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""Throughput of sharded event execution
+
+Runs the kitchensink plugins with the dispatcher from ``sm_kitchensink_plugin.sharding`` against the fake Slack from
+``fake_slack.py``, once for every number of shards, and sends a burst of messages spread over many channels that all
+trigger the same handler. Reports how many events per second were handled, measured by the Web API calls the handlers
+make, and the speedup over the first number of shards.
+
+The API scheduler's rate limits are lifted in every shard, so the results reflect the handlers rather than Slack's
+pacing.
+
+Run with: python benchmarks/bench_shards.py [--shards 1 2 4] [--events 2000] [--text interactions]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from machine.utils.collections import CaseInsensitiveDict
+
+from bench_load import Events, lift_rate_limits
+from fake_slack import FakeSlack
+from sm_kitchensink_plugin.sharding import ShardDispatcher, ShardMachine
+
+
+class LoadTestShardMachine(ShardMachine):
+    """Shard without the API scheduler's rate limits"""
+
+    async def _setup_slack_clients(self):
+        await super()._setup_slack_clients()
+        lift_rate_limits()
+
+
+async def wait_settled(fake: FakeSlack, settle: float, timeout: float) -> float:
+    """Wait until all events are acknowledged and no API call was made for `settle` seconds, returns the time of
+    the last call"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    calls, changed = sum(fake.calls.values()), time.perf_counter()
+    while loop.time() < deadline:
+        await asyncio.sleep(0.05)
+        current = sum(fake.calls.values())
+        if current != calls:
+            calls, changed = current, time.perf_counter()
+        elif not fake.pending_acks and time.perf_counter() - changed >= settle:
+            return changed
+    raise TimeoutError(f"{fake.pending_acks} events unacknowledged after {timeout}s")
+
+
+async def run_shards(shards: int, args: argparse.Namespace) -> Dict[str, Any]:
+    fake = FakeSlack(users=args.users, channels=args.channels, latency=args.latency)
+    base_url = await fake.start()
+    dispatcher = ShardDispatcher(CaseInsensitiveDict({
+        "PLUGINS": ["sm_kitchensink_plugin"],
+        "HTTP_PROXY": None,
+        "TZ": "UTC",
+        "LOGLEVEL": "CRITICAL",
+        "LOG_HANDLED_MESSAGES": False,
+        "SLACK_APP_TOKEN": "xapp-load-test",
+        "SLACK_BOT_TOKEN": "xoxb-load-test",
+        "KITCHENSINK_METRICS_LOG_INTERVAL": 0,
+    }), shards=shards, base_url=base_url, shard_class=LoadTestShardMachine)
+    dispatcher_task = asyncio.create_task(dispatcher.run())
+    connected = asyncio.create_task(fake.wait_connected(120))
+    await asyncio.wait([dispatcher_task, connected], return_when=asyncio.FIRST_COMPLETED)
+    if dispatcher_task.done():
+        connected.cancel()
+        dispatcher_task.result()
+    await connected
+    try:
+        events = Events(fake)
+        startup_calls = sum(fake.calls.values())
+        start = time.perf_counter()
+        for i in range(args.events):
+            await fake.send(*events.message(i, args.text))
+        finished = await wait_settled(fake, args.settle, args.timeout)
+    finally:
+        dispatcher_task.cancel()
+        await asyncio.gather(dispatcher_task, return_exceptions=True)
+        await dispatcher.close()
+        await fake.stop()
+    elapsed = finished - start
+    return {
+        "shards": shards,
+        "events": args.events,
+        "api_calls": sum(fake.calls.values()) - startup_calls,
+        "duration_s": round(elapsed, 3),
+        "events_per_s": round(args.events / elapsed, 1),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, os.cpu_count() or 1])
+    parser.add_argument("--events", type=int, default=2000, help="number of messages to send")
+    parser.add_argument("--text", default="interactions", help="text of the messages, which selects the handler")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--channels", type=int, default=100, help="number of channels the messages are spread over")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every Web API call takes")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds without API calls to finish")
+    parser.add_argument("--timeout", type=float, default=300.0, help="seconds to wait for the handlers to finish")
+    args = parser.parse_args(argv)
+
+    results = []
+    for shards in dict.fromkeys(args.shards):
+        result = asyncio.run(run_shards(shards, args))
+        results.append(result)
+        speedup = result["events_per_s"] / results[0]["events_per_s"]
+        print(
+            f"{shards:3} shards  {result['events']:6} events  {result['api_calls']:6} API calls  "
+            f"{result['duration_s']:8.3f}s  {result['events_per_s']:8.1f} events/s  {speedup:5.2f}x"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
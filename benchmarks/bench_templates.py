@@ -0,0 +1,51 @@
+"""Compare building Block Kit layouts per call with rendering precompiled templates
+
+Run with: python benchmarks/bench_templates.py
+"""
+import timeit
+
+from slack_sdk.models.blocks import Block
+
+from sm_kitchensink_plugin.block_kit import LUNCH_OPTIONS, format_votes, interactions_layout, lunch_layout
+from sm_kitchensink_plugin.listening_basics import blocks_layout
+from sm_kitchensink_plugin.templates import BlockTemplate
+
+NUMBER = 2000
+LUNCH_FIELDS = [f"{option}_votes" for option in LUNCH_OPTIONS.values()]
+LUNCH_VOTES = {field: format_votes(count) for count, field in enumerate(LUNCH_FIELDS)}
+
+
+def serialize(layout):
+    # this is what the Slack SDK does with block models when sending a message
+    return [block.to_dict() if isinstance(block, Block) else block for block in layout]
+
+
+def bench(name, per_call, template):
+    per_call_time = timeit.timeit(per_call, number=NUMBER) / NUMBER
+    template_time = timeit.timeit(template, number=NUMBER) / NUMBER
+    print(
+        f"{name:<14} per call: {per_call_time * 1e6:9.1f} µs   "
+        f"template: {template_time * 1e6:7.1f} µs   speedup: {per_call_time / template_time:6.1f}x"
+    )
+
+
+def main():
+    interactions = BlockTemplate(interactions_layout(), fields=["at_sender", "sender_id"])
+    lunch = BlockTemplate(lunch_layout(), fields=LUNCH_FIELDS)
+    show_blocks = BlockTemplate(blocks_layout())
+    bench(
+        "interactions",
+        lambda: serialize(interactions_layout()),
+        lambda: interactions.render(at_sender="<@U123>", sender_id="U123"),
+    )
+    # the lunch poll has no per-call version anymore, the votes are filled in by building the template every call
+    bench(
+        "order_lunch",
+        lambda: BlockTemplate(lunch_layout(), fields=LUNCH_FIELDS).render(**LUNCH_VOTES),
+        lambda: lunch.render(**LUNCH_VOTES),
+    )
+    bench("show blocks", lambda: serialize(blocks_layout()), show_blocks.render)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Local stand-in for the Slack Web API and Socket Mode
+
+Serves canned responses for the Web API methods the kitchensink plugins use, and a Socket Mode websocket endpoint
+that load tests can push envelopes (events, slash commands, interactive payloads) through. Responses can be delayed
+and a fraction of them can be rate limited, to see how the plugins behave when Slack is slow or pushes back.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from aiohttp import WSMsgType, web
+
+BOT_USER_ID = "UBOT"
+BOT_ID = "BBOT"
+TEAM_ID = "T0001"
+
+
+def make_user(i: int) -> Dict[str, Any]:
+    name = f"user{i:05d}"
+    return {
+        "id": f"U{i:05d}",
+        "team_id": TEAM_ID,
+        "name": name,
+        "deleted": False,
+        "is_bot": False,
+        "is_app_user": False,
+        "updated": 1700000000,
+        "profile": {
+            "avatar_hash": "0",
+            "real_name": name.title(),
+            "display_name": name,
+            "real_name_normalized": name.title(),
+            "display_name_normalized": name,
+            "team": TEAM_ID,
+            "email": f"{name}@example.com",
+        },
+    }
+
+
+def make_channel(i: int) -> Dict[str, Any]:
+    name = "general" if i == 0 else f"channel{i:04d}"
+    return {
+        "id": f"C{i:04d}",
+        "name": name,
+        "name_normalized": name,
+        "created": 1700000000,
+        "is_archived": False,
+        "is_general": i == 0,
+        "is_org_shared": False,
+        "is_channel": True,
+        "is_member": True,
+    }
+
+
+class FakeSlack:
+    """Fake Slack server
+
+    :param users: number of users in the workspace
+    :param channels: number of channels in the workspace
+    :param latency: seconds every Web API call takes
+    :param rate_limit_ratio: fraction of Web API calls that is answered with HTTP 429
+    :param retry_after: Retry-After of rate limited calls, in seconds
+    """
+
+    def __init__(
+        self,
+        users: int = 1000,
+        channels: int = 100,
+        latency: float = 0.0,
+        rate_limit_ratio: float = 0.0,
+        retry_after: int = 1,
+        seed: int = 42,
+    ):
+        self.users = [make_user(i) for i in range(users)]
+        self.channels = [make_channel(i) for i in range(channels)]
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.rate_limited: Counter = Counter()
+        self.ack_latencies: List[float] = []
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._sent: Dict[str, float] = {}
+        self._socket: Optional[web.WebSocketResponse] = None
+        self._connected = asyncio.Event()
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start the server, returns the base url of the Web API"""
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/api/{method}", self._api)
+        app.router.add_get("/link", self._link)
+        app.router.add_post("/upload", self._ok)
+        app.router.add_post("/response", self._ok)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        # the Slack SDK opens a connection per call, so bursts of calls need a long accept queue
+        site = web.TCPSite(self._runner, host, port, backlog=4096)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return f"{self.url}/api/"
+
+    async def stop(self):
+        if self._socket is not None:
+            await self._socket.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def wait_connected(self, timeout: float = 10.0):
+        await asyncio.wait_for(self._connected.wait(), timeout)
+
+    def next_id(self) -> str:
+        return str(next(self._ids))
+
+    def next_ts(self) -> str:
+        return f"{int(time.time())}.{next(self._ids):06d}"
+
+    # Socket Mode
+
+    async def _link(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self._socket = ws
+        await ws.send_json({"type": "hello", "num_connections": 1})
+        self._connected.set()
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            envelope_id = json.loads(message.data).get("envelope_id")
+            sent = self._sent.pop(envelope_id, None)
+            if sent is not None:
+                self.ack_latencies.append(time.perf_counter() - sent)
+        return ws
+
+    async def send(self, type_: str, payload: Dict[str, Any]) -> str:
+        """Push a Socket Mode envelope to the connected client, returns its envelope id"""
+        envelope_id = f"envelope-{self.next_id()}"
+        self._sent[envelope_id] = time.perf_counter()
+        envelope = {"envelope_id": envelope_id, "type": type_, "payload": payload, "accepts_response_payload": True}
+        await self._socket.send_str(json.dumps(envelope))
+        return envelope_id
+
+    @property
+    def pending_acks(self) -> int:
+        return len(self._sent)
+
+    # Web API
+
+    async def _ok(self, request: web.Request) -> web.Response:
+        await request.read()
+        return web.json_response({"ok": True})
+
+    async def _api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        params.update(request.query)
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rate_limit_ratio and self._random.random() < self.rate_limit_ratio:
+            self.rate_limited[method] += 1
+            return web.json_response(
+                {"ok": False, "error": "ratelimited"}, status=429, headers={"Retry-After": str(self.retry_after)}
+            )
+        return web.json_response({"ok": True, **self._response(method, params)})
+
+    @staticmethod
+    def _channel(channel: Optional[str]) -> Optional[str]:
+        # like Slack, messages posted to a user go to the DM channel with that user
+        return f"D{channel}" if channel and channel[0] in ("U", "W") else channel
+
+    def _response(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        if method == "apps.connections.open":
+            return {"url": self.url.replace("http", "ws", 1) + "/link"}
+        if method == "auth.test":
+            return {"user_id": BOT_USER_ID, "bot_id": BOT_ID, "team_id": TEAM_ID, "user": "kitchensink"}
+        if method == "bots.info":
+            return {"bot": {"id": BOT_ID, "name": "kitchensink", "user_id": BOT_USER_ID, "app_id": "A0001"}}
+        if method == "users.list":
+            return {"members": self.users, "response_metadata": {"next_cursor": ""}}
+        if method == "conversations.list":
+            return {"channels": self.channels, "response_metadata": {"next_cursor": ""}}
+        if method == "conversations.open":
+            return {"channel": {"id": f"D{params.get('users', 'X')}"}}
+        if method in ("chat.postMessage", "chat.update", "chat.postEphemeral"):
+            ts = params.get("ts") or self.next_ts()
+            return {
+                "channel": self._channel(params.get("channel")),
+                "ts": ts,
+                "message_ts": ts,
+                "message": {"type": "message", "text": params.get("text", ""), "user": BOT_USER_ID, "ts": ts},
+            }
+        if method == "chat.scheduleMessage":
+            return {"channel": self._channel(params.get("channel")), "scheduled_message_id": f"Q{self.next_id()}"}
+        if method in ("views.open", "views.publish", "views.update", "views.push"):
+            return {"view": {"id": f"V{self.next_id()}"}}
+        if method == "files.getUploadURLExternal":
+            return {"upload_url": f"{self.url}/upload", "file_id": f"F{self.next_id()}"}
+        if method == "files.completeUploadExternal":
+            return {"files": [{"id": file["id"]} for file in json.loads(params.get("files", "[]"))]}
+        return {}
@@ -0,0 +1,228 @@
+"""Replay a recording of production events against the kitchensink plugins and a local fake Slack
+
+Feeds the requests in a recording made with ``KITCHENSINK_RECORD_EVENTS`` (see ``sm_kitchensink_plugin.recording``)
+to Slack Machine with all kitchensink plugins, connected to the fake Slack from ``fake_slack.py``. Requests are sent
+with the gaps between them as recorded, divided by ``--speed``, or back to back with ``--speed max``. Gaps longer than
+``--max-gap`` seconds, like the time between two recording runs, are shortened to that.
+
+The fake workspace has the users and channels the recording refers to, mentions of the recording bot are rewritten to
+mention the fake bot, and responses go to the fake Slack. Reports the number of invocations, errors and latency
+percentiles per handler, which can be written to a file and compared with another run of the same recording:
+
+    python benchmarks/replay.py run events.jsonl.gz --speed 10 --output before.json
+    python benchmarks/replay.py run events.jsonl.gz --speed 10 --output after.json
+    python benchmarks/replay.py compare before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from bench_load import Recorder, lift_rate_limits, percentile, start_machine, stop_machine
+from fake_slack import BOT_USER_ID, FakeSlack, make_channel, make_user
+from sm_kitchensink_plugin.recording import read_recording
+
+Request = Tuple[float, str, Dict[str, Any]]
+
+
+def load(path: Path, max_gap: float) -> Tuple[List[Request], Set[str]]:
+    """The requests in a recording with their offset from the start in seconds, and the recording bots' user ids"""
+    requests: List[Request] = []
+    bot_user_ids: Set[str] = set()
+    offset, last = 0.0, None
+    for record in read_recording(str(path)):
+        if isinstance(record, dict):
+            if record.get("bot_user_id"):
+                bot_user_ids.add(record["bot_user_id"])
+            continue
+        recorded_at, type_, payload = record
+        if last is not None:
+            offset += min(max(recorded_at - last, 0.0), max_gap)
+        last = recorded_at
+        requests.append((offset, type_, payload))
+    return requests, bot_user_ids
+
+
+def _collect_ids(value: Any, users: Set[str], channels: Set[str]):
+    if isinstance(value, list):
+        for item in value:
+            _collect_ids(item, users, channels)
+        return
+    if not isinstance(value, dict):
+        return
+    for key, item in value.items():
+        if key in ("user", "user_id", "item_user") and isinstance(item, str) and item[:1] in ("U", "W"):
+            users.add(item)
+        elif key in ("channel", "channel_id") and isinstance(item, str) and item[:1] in ("C", "G"):
+            channels.add(item)
+        elif key == "user" and isinstance(item, dict) and "id" in item:
+            users.add(item["id"])
+        elif key == "channel" and isinstance(item, dict) and str(item.get("id", ""))[:1] in ("C", "G"):
+            channels.add(item["id"])
+        _collect_ids(item, users, channels)
+
+
+def _rewrite(value: Any, response_url: str) -> Any:
+    if isinstance(value, list):
+        return [_rewrite(item, response_url) for item in value]
+    if not isinstance(value, dict):
+        return value
+    rewritten = {key: _rewrite(item, response_url) for key, item in value.items()}
+    if "response_url" in rewritten:
+        rewritten["response_url"] = response_url
+    if "response_urls" in rewritten:
+        rewritten["response_urls"] = []
+    return rewritten
+
+
+def prepare(requests: List[Request], bot_user_ids: Set[str], fake: FakeSlack) -> List[Request]:
+    """Populate the fake workspace with the users and channels of the recording, and point the requests at it"""
+    users: Set[str] = set()
+    channels: Set[str] = set()
+    for _, _, payload in requests:
+        _collect_ids(payload, users, channels)
+    users -= bot_user_ids
+    fake.users = [{**make_user(i), "id": user_id} for i, user_id in enumerate(sorted(users))]
+    # the first fake channel is #general, which the plugins post notifications to
+    fake.channels = [make_channel(0)] + [
+        {**make_channel(i), "id": channel_id} for i, channel_id in enumerate(sorted(channels), start=1)
+    ]
+    prepared = []
+    for offset, type_, payload in requests:
+        serialized = json.dumps(_rewrite(payload, f"{fake.url}/response"))
+        for bot_user_id in bot_user_ids:
+            serialized = serialized.replace(bot_user_id, BOT_USER_ID)
+        prepared.append((offset, type_, json.loads(serialized)))
+    return prepared
+
+
+async def replay(fake: FakeSlack, requests: List[Request], speed: Optional[float]):
+    """Send the requests on the recorded schedule, scaled by `speed`, or as fast as possible when it's None"""
+    start = time.perf_counter()
+    for offset, type_, payload in requests:
+        if speed is not None:
+            delay = start + offset / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await fake.send(type_, payload)
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    requests, bot_user_ids = load(args.recording, args.max_gap)
+    fake = FakeSlack(users=0, channels=0, latency=args.latency)
+    base_url = await fake.start()
+    requests = prepare(requests, bot_user_ids, fake)
+    print(f"Replaying {len(requests)} requests, {len(fake.users)} users, {len(fake.channels)} channels")
+    machine, machine_task = await start_machine(fake, base_url)
+    if not args.slack_rate_limits:
+        lift_rate_limits()
+    recorder = Recorder()
+    recorder.instrument(machine)
+
+    start = time.perf_counter()
+    await replay(fake, requests, None if args.speed == "max" else float(args.speed))
+    try:
+        await recorder.wait_idle(fake, args.settle, args.timeout)
+    except TimeoutError as e:
+        print(f"  {e}", file=sys.stderr)
+    elapsed = time.perf_counter() - start - args.settle
+    await stop_machine(fake, machine, machine_task)
+
+    handlers = {
+        name: {
+            "events": len(durations),
+            "errors": recorder.errors[name],
+            "mean_ms": round(statistics.mean(durations) * 1000, 3),
+            "p50_ms": round(percentile(durations, 50) * 1000, 3),
+            "p95_ms": round(percentile(durations, 95) * 1000, 3),
+            "p99_ms": round(percentile(durations, 99) * 1000, 3),
+        }
+        for name, durations in sorted(recorder.durations.items())
+        if durations
+    }
+    return {
+        "meta": {
+            "recording": str(args.recording),
+            "requests": len(requests),
+            "speed": args.speed,
+            "duration_s": round(elapsed, 3),
+            "latency": args.latency,
+            "api_calls": dict(fake.calls),
+        },
+        "handlers": handlers,
+    }
+
+
+def compare(base: Dict[str, Any], current: Dict[str, Any], tolerance: float, min_delta_ms: float) -> List[str]:
+    """Print the timing differences per handler, returns the handlers whose p95 latency regressed"""
+    if base["meta"]["recording"] != current["meta"]["recording"] or base["meta"]["speed"] != current["meta"]["speed"]:
+        print("Warning: the runs replayed different recordings or at different speeds", file=sys.stderr)
+    regressions = []
+    print(f"{'handler':42} {'events':>13} {'p50 ms':>24} {'p95 ms':>24}")
+    for name in sorted(set(base["handlers"]) | set(current["handlers"])):
+        before, after = base["handlers"].get(name), current["handlers"].get(name)
+        if before is None or after is None:
+            print(f"{name:42} only in {'the second' if before is None else 'the first'} run")
+            continue
+        columns = [f"{before['events']:6}→{after['events']:<6}"]
+        for metric in ("p50_ms", "p95_ms"):
+            delta = after[metric] - before[metric]
+            relative = f"{delta / before[metric]:+7.1%}" if before[metric] else "    n/a"
+            columns.append(f"{before[metric]:8.3f}→{after[metric]:8.3f} {relative}")
+        regressed = (
+            after["p95_ms"] > before["p95_ms"] * (1 + tolerance) and after["p95_ms"] - before["p95_ms"] > min_delta_ms
+        )
+        if after["errors"] > before["errors"]:
+            regressed = True
+            columns.append(f"errors {before['errors']}→{after['errors']}")
+        print(f"{name:42} {' '.join(columns)}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="replay a recording")
+    run_parser.add_argument("recording", type=Path, help="recording made with KITCHENSINK_RECORD_EVENTS")
+    run_parser.add_argument("--speed", default="1", help="replay speed, a factor like 1 or 10, or max")
+    run_parser.add_argument("--max-gap", type=float, default=10.0, help="longest gap between requests, in seconds")
+    run_parser.add_argument("--latency", type=float, default=0.0, help="seconds every Web API call takes")
+    run_parser.add_argument("--slack-rate-limits", action="store_true", help="keep the API scheduler's rate limits")
+    run_parser.add_argument("--settle", type=float, default=1.0, help="seconds without handler activity to finish")
+    run_parser.add_argument("--timeout", type=float, default=300.0, help="seconds to wait for handlers to finish")
+    run_parser.add_argument("--output", type=Path, help="write the results to this JSON file")
+    compare_parser = commands.add_parser("compare", help="compare the results of two runs of the same recording")
+    compare_parser.add_argument("base", type=Path)
+    compare_parser.add_argument("current", type=Path)
+    compare_parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative p95 regression")
+    compare_parser.add_argument("--min-delta-ms", type=float, default=1.0, help="ignore latency regressions below this")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        regressions = compare(
+            json.loads(args.base.read_text()), json.loads(args.current.read_text()), args.tolerance, args.min_delta_ms
+        )
+        return 1 if regressions else 0
+
+    if args.speed != "max" and float(args.speed) <= 0:
+        parser.error("--speed should be a positive number or max")
+    results = asyncio.run(run(args))
+    for name, result in results["handlers"].items():
+        print(
+            f"{name:42} {result['events']:6} ev {result['errors']:4} err  mean {result['mean_ms']:8.3f}ms  "
+            f"p50 {result['p50_ms']:8.3f}ms  p95 {result['p95_ms']:8.3f}ms  p99 {result['p99_ms']:8.3f}ms"
+        )
+    print(f"Replayed {results['meta']['requests']} requests in {results['meta']['duration_s']}s")
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,39 @@
-from sm_kitchensink_plugin.listening_basics import ListeningBasics
-from sm_kitchensink_plugin.listening_advanced import ListeningAdvanced
-from sm_kitchensink_plugin.slash_commands import SlashCommands
-from sm_kitchensink_plugin.block_kit import BlockKit
-from sm_kitchensink_plugin.modals import Modals
+"""Kitchensink plugins for Slack Machine
+
+The plugin classes are loaded lazily: a plugin module is only imported when its class is first accessed, so a bot
+that only enables some of the plugins doesn't pay for importing the others.
+"""
+from importlib import import_module
+from typing import TYPE_CHECKING, Any, List
+
+_PLUGIN_MODULES = {
+    "ListeningBasics": "sm_kitchensink_plugin.listening_basics",
+    "ListeningAdvanced": "sm_kitchensink_plugin.listening_advanced",
+    "SlashCommands": "sm_kitchensink_plugin.slash_commands",
+    "BlockKit": "sm_kitchensink_plugin.block_kit",
+    "Modals": "sm_kitchensink_plugin.modals",
+}
+
+__all__ = list(_PLUGIN_MODULES)
+
+if TYPE_CHECKING:
+    from sm_kitchensink_plugin.block_kit import BlockKit
+    from sm_kitchensink_plugin.listening_advanced import ListeningAdvanced
+    from sm_kitchensink_plugin.listening_basics import ListeningBasics
+    from sm_kitchensink_plugin.modals import Modals
+    from sm_kitchensink_plugin.slash_commands import SlashCommands
+
+
+def __getattr__(name: str) -> Any:
+    module = _PLUGIN_MODULES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    cls = getattr(import_module(module), name)
+    # cache the class, so this function is only called once per plugin
+    globals()[name] = cls
+    return cls
+
+
+def __dir__() -> List[str]:
+    # Slack Machine finds the plugins in a module with dir(), so PLUGINS = ["sm_kitchensink_plugin"] loads them all
+    return sorted({*globals(), *_PLUGIN_MODULES})
@@ -0,0 +1,190 @@
+import asyncio
+import random
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+from structlog.stdlib import get_logger
+
+main_logger = get_logger(__name__)
+
+# Requests per minute for each Web API tier, see https://api.slack.com/apis/rate-limits
+TIER_LIMITS = {
+    1: 1,
+    2: 20,
+    3: 50,
+    4: 100,
+}
+
+# Tiers of the methods used by the kitchensink plugins. Methods that are not listed fall back to tier 3.
+METHOD_TIERS = {
+    "chat.postMessage": 4,
+    "chat.postEphemeral": 4,
+    "chat.update": 3,
+    "chat.delete": 3,
+    "chat.scheduleMessage": 3,
+    "reactions.add": 3,
+    "pins.add": 2,
+    "pins.remove": 2,
+    "views.open": 4,
+    "views.push": 4,
+    "views.update": 4,
+    "views.publish": 4,
+    "conversations.open": 3,
+    "conversations.info": 3,
+    "users.list": 2,
+    "conversations.list": 2,
+    "files.getUploadURLExternal": 4,
+    "files.completeUploadExternal": 4,
+}
+DEFAULT_TIER = 3
+
+# chat.postMessage is additionally limited to roughly one message per second per channel
+CHANNEL_RATE = 1.0
+
+
+class TokenBucket:
+    """Token bucket that makes callers wait until a token is available"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self, now: float):
+        if self._updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def idle(self) -> bool:
+        return (self._lock is None or not self._lock.locked()) and self.tokens >= self.capacity
+
+    async def acquire(self):
+        # The lock is held while waiting, so waiters are served one by one in FIFO order. It's created lazily so
+        # it's bound to the running event loop.
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            self._refill(loop.time())
+            # pause() can drain the bucket while we sleep, so the token is checked again after every sleep
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill(loop.time())
+            self.tokens -= 1
+
+    def try_acquire(self) -> bool:
+        """Take a token without waiting, returns False if none is available"""
+        self._refill(asyncio.get_running_loop().time())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def pause(self, seconds: float):
+        """Drain the bucket so the next token only becomes available after `seconds`"""
+        self._refill(asyncio.get_running_loop().time())
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class ApiScheduler:
+    """Schedules Slack Web API calls according to Slack's rate limits
+
+    Every call waits for a token of the tier of its method, and calls to chat.postMessage additionally wait for a
+    token of the channel they post to. Calls that are rate limited anyway are retried after the Retry-After period
+    that Slack returns, plus some jitter so retries of concurrent calls don't all hit Slack at the same time.
+    """
+
+    def __init__(self, max_retries: int = 3, max_jitter: float = 1.0, max_channel_buckets: int = 1000):
+        self.max_retries = max_retries
+        self.max_jitter = max_jitter
+        self.max_channel_buckets = max_channel_buckets
+        self._tier_buckets = {
+            tier: TokenBucket(rate=per_minute / 60, capacity=per_minute) for tier, per_minute in TIER_LIMITS.items()
+        }
+        self._channel_buckets: Dict[str, TokenBucket] = {}
+        self._queue_depth: Counter = Counter()
+        self._counters: Counter = Counter()
+
+    def _channel_bucket(self, channel: str) -> TokenBucket:
+        bucket = self._channel_buckets.get(channel)
+        if bucket is None:
+            if len(self._channel_buckets) >= self.max_channel_buckets:
+                self._channel_buckets = {c: b for c, b in self._channel_buckets.items() if not b.idle}
+            bucket = self._channel_buckets[channel] = TokenBucket(rate=CHANNEL_RATE, capacity=1)
+        return bucket
+
+    async def call(
+        self, method: str, send: Callable[[], Awaitable[Any]], channel: Optional[str] = None
+    ) -> Any:
+        """Perform an API call through the scheduler
+
+        :param method: name of the Web API method, e.g. ``chat.postMessage``
+        :param send: function that performs the actual call
+        :param channel: channel the call is targeting, if any
+        :return: whatever `send` returns
+        """
+        tier_bucket = self._tier_buckets[METHOD_TIERS.get(method, DEFAULT_TIER)]
+        attempt = 0
+        while True:
+            self._queue_depth[method] += 1
+            try:
+                await tier_bucket.acquire()
+                if method == "chat.postMessage" and channel is not None:
+                    await self._channel_bucket(channel).acquire()
+            finally:
+                self._queue_depth[method] -= 1
+            self._counters["calls"] += 1
+            try:
+                return await send()
+            except SlackApiError as e:
+                if e.response.get("error") != "ratelimited" or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self._counters["rate_limited"] += 1
+                retry_after = float(e.response.headers.get("Retry-After", 1))
+                tier_bucket.pause(retry_after)
+                delay = retry_after + random.uniform(0, self.max_jitter)
+                main_logger.warning("Slack API rate limit hit, retrying", method=method, delay=delay, attempt=attempt)
+                await asyncio.sleep(delay)
+
+    def share(self, fraction: float):
+        """Only use `fraction` of the rate limits of every tier, for processes that call Slack with the same token"""
+        self._tier_buckets = {
+            tier: TokenBucket(rate=per_minute * fraction / 60, capacity=max(1.0, per_minute * fraction))
+            for tier, per_minute in TIER_LIMITS.items()
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        """Current queue depth per method and the total number of calls and rate limited calls"""
+        return {
+            "queue_depth": {method: depth for method, depth in self._queue_depth.items() if depth},
+            "calls": self._counters["calls"],
+            "rate_limited": self._counters["rate_limited"],
+        }
+
+    def install(self, web_client: AsyncWebClient):
+        """Route all calls made through `web_client` via this scheduler
+
+        All methods of the Slack SDK web client, and therefore all methods of plugins and messages that send
+        something to Slack, end up in ``api_call``, so that's where the scheduler hooks in. Installing more than
+        once is a no-op.
+        """
+        if getattr(web_client, "_kitchensink_scheduler", None) is not None:
+            return
+        api_call = web_client.api_call
+
+        async def scheduled_api_call(api_method: str, **kwargs: Any):
+            payload = kwargs.get("json") or kwargs.get("data") or kwargs.get("params") or {}
+            channel = payload.get("channel") if isinstance(payload, dict) else None
+            return await self.call(api_method, lambda: api_call(api_method, **kwargs), channel=channel)
+
+        web_client.api_call = scheduled_api_call
+        web_client._kitchensink_scheduler = self
+
+
+scheduler = ApiScheduler()
@@ -0,0 +1,196 @@
+import asyncio
+import inspect
+from typing import TYPE_CHECKING, Any, Optional, Union
+
+from machine.clients.slack import SlackClient
+from machine.models import Channel, User
+from machine.plugins.base import MachineBasePlugin
+from machine.plugins.decorators import process
+from machine.storage import PluginStorage
+from machine.utils.collections import CaseInsensitiveDict
+from structlog.stdlib import get_logger
+
+from sm_kitchensink_plugin.channel_index import channel_index
+from sm_kitchensink_plugin.dispatch import every_shard
+from sm_kitchensink_plugin.metrics import TimedStorage, metrics
+
+if TYPE_CHECKING:
+    from sm_kitchensink_plugin.channel_writer import Notification
+
+main_logger = get_logger(__name__)
+
+_shared_helpers_started = False
+
+
+def start_shared_helpers(client: SlackClient, settings: CaseInsensitiveDict, storage: PluginStorage):
+    """Start the helpers that all kitchensink plugins share, which the first plugin that's initialized does"""
+    global _shared_helpers_started
+    if _shared_helpers_started:
+        return
+    _shared_helpers_started = True
+    from sm_kitchensink_plugin.api_scheduler import scheduler
+    from sm_kitchensink_plugin.channel_writer import channel_writer
+    from sm_kitchensink_plugin.command_executor import command_executor
+    from sm_kitchensink_plugin.dm_channels import dm_channels
+    from sm_kitchensink_plugin.event_bus import event_bus
+    from sm_kitchensink_plugin.idempotency import idempotency
+    from sm_kitchensink_plugin.leader import leader
+    from sm_kitchensink_plugin.leases import leases
+    from sm_kitchensink_plugin.log_pipeline import log_pipeline
+
+    log_pipeline.install(settings)
+    scheduler.install(client.web_client)
+    metrics.instrument_web_client(client.web_client)
+    # DM channels are stored in the shared namespace, so it doesn't matter which plugin's storage is used
+    dm_channels.install(client, storage)
+    channel_writer.install(client, float(settings.get("KITCHENSINK_NOTIFICATION_WINDOW", 1.0)))
+    leases.install(settings)
+    leader.install(float(settings.get("KITCHENSINK_LEADER_TTL", 15.0)))
+    idempotency.install(float(settings.get("KITCHENSINK_IDEMPOTENCY_TTL", 3600)))
+    command_executor.configure(
+        settings.get("KITCHENSINK_COMMAND_EXECUTOR", "thread"),
+        int(settings.get("KITCHENSINK_COMMAND_WORKERS", 4)),
+        int(settings.get("KITCHENSINK_COMMAND_QUEUE_SIZE", 100)),
+    )
+    if settings.get("KITCHENSINK_RECORD_EVENTS"):
+        from sm_kitchensink_plugin.recording import event_recorder
+
+        event_recorder.install(
+            client,
+            settings["KITCHENSINK_RECORD_EVENTS"],
+            redact=str(settings.get("KITCHENSINK_RECORD_REDACT", "true")).lower() != "false",
+        )
+    if settings.get("KITCHENSINK_EVENT_BROKER"):
+        event_bus.connect(settings["KITCHENSINK_EVENT_BROKER"])
+    metrics.start(settings)
+
+
+class KitchensinkPlugin(MachineBasePlugin):
+    """Base class for the kitchensink plugins
+
+    Routes every Slack Web API call the plugin makes, either directly or through messages, commands etc., through
+    the shared API scheduler, and resolves channel names through the shared channel index. Notifications are merged
+    per channel by the shared channel writer, and scheduled jobs marked with ``@leader_only`` only run on the replica
+    that is elected as leader. Methods decorated with ``@subscribe`` receive the events published on the event bus.
+    The handlers of subclasses are instrumented, see ``sm_kitchensink_plugin.metrics``, and logs are sampled and
+    written by a background thread, see ``sm_kitchensink_plugin.log_pipeline``.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        metrics.instrument_class(cls)
+
+    def __init__(self, client: SlackClient, settings: CaseInsensitiveDict, storage: PluginStorage):
+        super().__init__(client, settings, TimedStorage(storage))
+
+    async def init(self):
+        """Start the helpers that all plugins share, if this is the first plugin, and hook up this plugin
+
+        Subclasses that override this call it first.
+        """
+        # the helpers are imported where they're used, so importing a plugin only imports the modules it needs
+        from sm_kitchensink_plugin.event_bus import event_bus
+        from sm_kitchensink_plugin.leader import leader
+
+        start_shared_helpers(self._client, self.settings, self.storage)
+        functions = inspect.getmembers(type(self), inspect.isfunction)
+        if any(hasattr(fn, "__kitchensink_leader_only__") for _, fn in functions):
+            leader.on_elected(self.catch_up_scheduled_jobs)
+        for name, fn in functions:
+            for event, options in getattr(fn, "__kitchensink_subscriptions__", []):
+                event_bus.subscribe(event, getattr(self, name), **options)
+
+    def find_channel_by_name(self, channel_name: str) -> Optional[Channel]:
+        return channel_index.find(self.channels, channel_name)
+
+    @property
+    def notification_channel(self) -> Optional[Channel]:
+        """Channel the plugins post notifications to, #general unless configured otherwise"""
+        return self.find_channel_by_name(self.settings.get("KITCHENSINK_NOTIFICATION_CHANNEL", "#general"))
+
+    def notify(
+        self, text: str, channel: Optional[Union[Channel, str]] = None, immediate: bool = False
+    ) -> "asyncio.Future[Optional[Notification]]":
+        """Post a notification to `channel`, the notification channel by default
+
+        Notifications to the same channel are merged into a single message, unless `immediate` is set, see
+        ``sm_kitchensink_plugin.channel_writer``. The returned future doesn't have to be awaited, it resolves to the
+        posted notification or to None if posting failed.
+        """
+        if channel is None:
+            channel = self.notification_channel
+        if channel is None:
+            main_logger.warning("Notification channel not found, dropping notification")
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(None)
+            return future
+        from sm_kitchensink_plugin.channel_writer import channel_writer
+
+        channel_id = channel.id if isinstance(channel, Channel) else channel
+        return channel_writer.write(channel_id, text, immediate=immediate)
+
+    async def dm_channel(self, user: Union[User, str]) -> str:
+        """Id of the DM channel with `user`, which is cached, see ``sm_kitchensink_plugin.dm_channels``
+
+        Sending a DM doesn't need it, but updating or deleting a DM does.
+        """
+        from sm_kitchensink_plugin.dm_channels import dm_channels
+
+        return await dm_channels.get(user.id if isinstance(user, User) else user)
+
+    async def publish_event(self, event: str, **payload: Any):
+        """Publish an event on the event bus
+
+        Unlike ``emit``, events are queued per subscriber, see ``sm_kitchensink_plugin.event_bus``. This waits when
+        the queue of a subscriber with the `block` policy is full.
+        """
+        from sm_kitchensink_plugin.event_bus import event_bus
+
+        await event_bus.publish(event, payload)
+
+    async def update_notification(self, notification: "Notification", text: str) -> Optional["Notification"]:
+        """Replace the text of a notification, leaving the notifications it was merged with alone"""
+        from sm_kitchensink_plugin.channel_writer import channel_writer
+
+        return await channel_writer.update(notification, text)
+
+    async def catch_up_scheduled_jobs(self):
+        """Run the leader-only scheduled jobs that missed a tick, e.g. while the previous leader was failing over
+
+        Missed ticks are coalesced, so every job runs at most once.
+        """
+        from sm_kitchensink_plugin.leader import leader, missed_tick
+
+        if not leader.is_leader:
+            return
+        # the class is inspected rather than the instance, because that would evaluate all properties
+        for name, fn in inspect.getmembers(type(self), inspect.isfunction):
+            job = getattr(fn, "__kitchensink_leader_only__", None)
+            if job is None or fn.metadata.plugin_actions.schedule is None:
+                continue
+            method = getattr(self, name)
+            last_run = await self.storage.get(f"leader-job:{job}")
+            if last_run is not None and missed_tick(
+                method.metadata.plugin_actions.schedule, last_run, self.settings.get("TZ", "UTC")
+            ):
+                main_logger.info("Catching up on missed scheduled job", job=job, last_run=last_run)
+                try:
+                    await method()
+                except Exception:
+                    main_logger.exception("Catching up on scheduled job failed", job=job)
+
+    @process("channel_created")
+    @process("channel_rename")
+    @process("channel_archive")
+    @process("channel_unarchive")
+    @process("channel_deleted")
+    @process("channel_id_changed")
+    @process("group_rename")
+    @process("group_archive")
+    @process("group_unarchive")
+    @process("group_deleted")
+    @every_shard
+    async def invalidate_channel_index(self, event):
+        # Slack Machine updates its channel cache before plugins receive the event, so the index can be rebuilt
+        # from it right away
+        channel_index.invalidate()
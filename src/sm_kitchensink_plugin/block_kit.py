@@ -1,329 +1,393 @@
-import json
 import re
-from typing import cast
+from collections import Counter
+from typing import Optional
 
-from machine.plugins.base import MachineBasePlugin
 from machine.plugins.block_action import BlockAction
-from machine.plugins.decorators import (
-    respond_to,
-    listen_to,
-    action
-)
+from machine.plugins.decorators import action
 from machine.plugins.message import Message
 from slack_sdk.models import blocks
 from slack_sdk.models.blocks.basic_components import DispatchActionConfig
 from structlog.stdlib import get_logger, BoundLogger
 
+from sm_kitchensink_plugin.base import KitchensinkPlugin
+from sm_kitchensink_plugin.caching import LRUCache
+from sm_kitchensink_plugin.debounce import Debouncer
+from sm_kitchensink_plugin.idempotency import idempotent
+from sm_kitchensink_plugin.dispatch import listen_to, respond_to
+from sm_kitchensink_plugin.poll import PollEngine, PollKey
+from sm_kitchensink_plugin.templates import BlockTemplate
+
 main_logger = get_logger(__name__)
 
 
-class BlockKit(MachineBasePlugin):
-    """Block Kit"""
+def interactions_layout() -> list[blocks.Block]:
+    header = blocks.HeaderBlock(text="Interactivity 🎉")
+    message = blocks.SectionBlock(
+        text="Hey {at_sender}, you wanna see some interactive goodness? I can show you!"
+    )
 
-    @listen_to(r"^interactions")
-    async def interactions(self, msg: Message):
-        header = blocks.HeaderBlock(text="Interactivity 🎉")
-        message = blocks.SectionBlock(
-            text=f"Hey {msg.at_sender}, you wanna see some interactive goodness? I can show you!"
-        )
+    divider1 = blocks.DividerBlock()
 
-        divider1 = blocks.DividerBlock()
+    date_picker = blocks.DatePickerElement(action_id="pick_date")
+    date_picker_input = blocks.InputBlock(
+        label="Pick a date",
+        element=date_picker,
+        block_id="interaction_date_picker",
+        hint="Choose your date wisely...",
+    )
 
-        date_picker = blocks.DatePickerElement(action_id="pick_date")
-        date_picker_input = blocks.InputBlock(
-            label="Pick a date",
-            element=date_picker,
-            block_id="interaction_date_picker",
-            hint="Choose your date wisely...",
-        )
+    checkboxes = blocks.CheckboxesElement(
+        action_id="select_options",
+        options=[
+            blocks.Option(
+                value="apple",
+                label="apple",
+                text=blocks.MarkdownTextObject(text="*juicy apple*"),
+            ),
+            blocks.Option(value="orange", label="orange", text="fresh orange"),
+            blocks.Option(value="cherry", label="cherry", text="red cherry"),
+        ],
+    )
+    checkboxes_input = blocks.InputBlock(
+        label="Select some fruits",
+        element=checkboxes,
+        block_id="interaction_checkboxes",
+        hint="The fruits are healthy...",
+    )
 
-        checkboxes = blocks.CheckboxesElement(
-            action_id="select_options",
-            options=[
-                blocks.Option(
-                    value="apple",
-                    label="apple",
-                    text=blocks.MarkdownTextObject(text="*juicy apple*"),
-                ),
-                blocks.Option(value="orange", label="orange", text="fresh orange"),
-                blocks.Option(value="cherry", label="cherry", text="red cherry"),
-            ],
-        )
-        checkboxes_input = blocks.InputBlock(
-            label="Select some fruits",
-            element=checkboxes,
-            block_id="interaction_checkboxes",
-            hint="The fruits are healthy...",
-        )
+    email = blocks.EmailInputElement(
+        action_id="provide_email"
+    )
+    email_input = blocks.InputBlock(
+        label="Provide email address",
+        element=email,
+        block_id="interaction_email",
+        hint="Email is personal...",
+    )
 
-        email = blocks.EmailInputElement(
-            action_id="provide_email"
-        )
-        email_input = blocks.InputBlock(
-            label="Provide email address",
-            element=email,
-            block_id="interaction_email",
-            hint="Email is personal...",
-        )
+    multi_select_menu = blocks.StaticMultiSelectElement(
+        action_id="multi_select_menu_options",
+        options=[
+            blocks.Option(value="data", label="data", text="Data"),
+            blocks.Option(value="picard", label="picard", text="Picard"),
+            blocks.Option(value="worf", label="worf", text="Worf"),
+        ],
+    )
+    multi_select_menu_input = blocks.InputBlock(
+        label="Select favorite Star Trek characters",
+        element=multi_select_menu,
+        block_id="interaction_startrek",
+        hint="Next Generation...",
+    )
 
-        multi_select_menu = blocks.StaticMultiSelectElement(
-            action_id="multi_select_menu_options",
-            options=[
-                blocks.Option(value="data", label="data", text="Data"),
-                blocks.Option(value="picard", label="picard", text="Picard"),
-                blocks.Option(value="worf", label="worf", text="Worf"),
-            ],
-        )
-        multi_select_menu_input = blocks.InputBlock(
-            label="Select favorite Star Trek characters",
-            element=multi_select_menu,
-            block_id="interaction_startrek",
-            hint="Next Generation...",
-        )
+    number = blocks.NumberInputElement(
+        action_id="enter_number",
+        is_decimal_allowed=False,
+    )
+    number_input = blocks.InputBlock(
+        label="What is your favorite number?",
+        element=number,
+        block_id="interaction_number",
+        hint="42",
+    )
 
-        number = blocks.NumberInputElement(
-            action_id="enter_number",
-            is_decimal_allowed=False,
-        )
-        number_input = blocks.InputBlock(
-            label="What is your favorite number?",
-            element=number,
-            block_id="interaction_number",
-            hint="42",
-        )
+    overflow = blocks.OverflowMenuElement(
+        action_id="pick_overflow_option",
+        options=[
+            blocks.Option(value="one", label="one", text="One"),
+            blocks.Option(value="two", label="two", text="Two"),
+            blocks.Option(value="three", label="three", text="Three"),
+        ]
+    )
+    overflow_section = blocks.SectionBlock(
+        text="Pick a number",
+        accessory=overflow,
+        block_id="interaction_overflow",
+    )
 
-        overflow = blocks.OverflowMenuElement(
-            action_id="pick_overflow_option",
-            options=[
-                blocks.Option(value="one", label="one", text="One"),
-                blocks.Option(value="two", label="two", text="Two"),
-                blocks.Option(value="three", label="three", text="Three"),
-            ]
-        )
-        overflow_section = blocks.SectionBlock(
-            text="Pick a number",
-            accessory=overflow,
-            block_id="interaction_overflow",
-        )
+    plain_text = blocks.PlainTextInputElement(
+        action_id="provide_feelings",
+        dispatch_action_config=DispatchActionConfig(trigger_actions_on=["on_character_entered"]),
+    )
+    plain_text_input = blocks.InputBlock(
+        label="Your feelings",
+        element=plain_text,
+        block_id="interaction_feelings",
+        hint="Be honest...",
+    )
 
-        plain_text = blocks.PlainTextInputElement(
-            action_id="provide_feelings",
-            dispatch_action_config=DispatchActionConfig(trigger_actions_on=["on_character_entered"]),
-        )
-        plain_text_input = blocks.InputBlock(
-            label="Your feelings",
-            element=plain_text,
-            block_id="interaction_feelings",
-            hint="Be honest...",
-        )
+    radio_buttons = blocks.RadioButtonsElement(
+        action_id="select_radio_option",
+        options=[
+            blocks.Option(value="1", text="Strongly agree"),
+            blocks.Option(value="2", text="Agree"),
+            blocks.Option(value="3", text="Neither agree nor disagree"),
+            blocks.Option(value="4", text="Disagree"),
+            blocks.Option(value="5", text="Strongly disagree"),
+        ],
+    )
+    radio_buttons_input = blocks.InputBlock(
+        label="You enjoy this selection of input elements",
+        element=radio_buttons,
+        block_id="interaction_radio_buttons",
+    )
 
-        radio_buttons = blocks.RadioButtonsElement(
-            action_id="select_radio_option",
-            options=[
-                blocks.Option(value="1", text="Strongly agree"),
-                blocks.Option(value="2", text="Agree"),
-                blocks.Option(value="3", text="Neither agree nor disagree"),
-                blocks.Option(value="4", text="Disagree"),
-                blocks.Option(value="5", text="Strongly disagree"),
-            ],
-        )
-        radio_buttons_input = blocks.InputBlock(
-            label="You enjoy this selection of input elements",
-            element=radio_buttons,
-            block_id="interaction_radio_buttons",
-        )
+    select_menu = blocks.StaticSelectElement(
+        action_id="select_menu_options",
+        options=[
+            blocks.Option(value="A", label="A", text="AAAA"),
+            blocks.Option(value="B", label="B", text="BBBB"),
+            blocks.Option(value="C", label="C", text="CCCC"),
+        ],
+    )
+    select_menu_input = blocks.InputBlock(
+        label="What is your favorite character in the alphabet?",
+        element=select_menu,
+        block_id="interaction_alphabet",
+        hint="Choose wisely...",
+    )
 
-        select_menu = blocks.StaticSelectElement(
-            action_id="select_menu_options",
-            options=[
-                blocks.Option(value="A", label="A", text="AAAA"),
-                blocks.Option(value="B", label="B", text="BBBB"),
-                blocks.Option(value="C", label="C", text="CCCC"),
-            ],
-        )
-        select_menu_input = blocks.InputBlock(
-            label="What is your favorite character in the alphabet?",
-            element=select_menu,
-            block_id="interaction_alphabet",
-            hint="Choose wisely...",
-        )
+    time_picker = blocks.TimePickerElement(
+        action_id="pick_time",
+    )
+    time_picker_input = blocks.InputBlock(
+        label="Pick a time",
+        element=time_picker,
+        block_id="interaction_time_picker",
+        hint="Choose your time wisely...",
+    )
 
-        time_picker = blocks.TimePickerElement(
-            action_id="pick_time",
-        )
-        time_picker_input = blocks.InputBlock(
-            label="Pick a time",
-            element=time_picker,
-            block_id="interaction_time_picker",
-            hint="Choose your time wisely...",
-        )
+    url = blocks.UrlInputElement(
+        action_id="provide_url",
+        dispatch_action_config=DispatchActionConfig(trigger_actions_on=["on_character_entered"]),
+    )
+    url_input = blocks.InputBlock(
+        label="Provide a URL",
+        element=url,
+        block_id="interaction_url",
+        hint="URLs are cool...",
+    )
 
-        url = blocks.UrlInputElement(
-            action_id="provide_url",
-            dispatch_action_config=DispatchActionConfig(trigger_actions_on=["on_character_entered"]),
-        )
-        url_input = blocks.InputBlock(
-            label="Provide a URL",
-            element=url,
-            block_id="interaction_url",
-            hint="URLs are cool...",
-        )
+    channel_select = blocks.ChannelMultiSelectElement(
+        action_id="select_channel",
+    )
+    channel_select_input = blocks.InputBlock(
+        label="Select channels",
+        element=channel_select,
+        block_id="interaction_channels_select",
+        hint="Choose channels...",
+    )
 
-        channel_select = blocks.ChannelMultiSelectElement(
-            action_id="select_channel",
-        )
-        channel_select_input = blocks.InputBlock(
-            label="Select channels",
-            element=channel_select,
-            block_id="interaction_channels_select",
-            hint="Choose channels...",
-        )
+    conversation_select = blocks.ConversationSelectElement(
+        action_id="select_conversation",
+    )
+    conversation_select_input = blocks.InputBlock(
+        label="Select a conversation",
+        element=conversation_select,
+        block_id="interaction_conversation_select",
+        hint="Choose a conversation...",
+    )
 
-        conversation_select = blocks.ConversationSelectElement(
-            action_id="select_conversation",
-        )
-        conversation_select_input = blocks.InputBlock(
-            label="Select a conversation",
-            element=conversation_select,
-            block_id="interaction_conversation_select",
-            hint="Choose a conversation...",
-        )
+    divider2 = blocks.DividerBlock()
+
+    approve_button = blocks.ButtonElement(
+        text="Yes, please.",
+        action_id="interactions_approve",
+        value="{sender_id}",
+        style="primary",
+    )
+    deny_button = blocks.ButtonElement(
+        text="No, thank you.",
+        action_id="interactions_deny",
+        value="{sender_id}",
+        style="danger",
+    )
+
+    buttons = [approve_button, deny_button]
 
-        divider2 = blocks.DividerBlock()
+    actions = blocks.ActionsBlock(
+        block_id="interactions_confirmation", elements=buttons
+    )
 
-        approve_button = blocks.ButtonElement(
-            text="Yes, please.",
-            action_id="interactions_approve",
-            value=f"{msg.sender.id}",
-            style="primary",
+    return [
+        header,
+        message,
+        divider1,
+        date_picker_input,
+        checkboxes_input,
+        email_input,
+        multi_select_menu_input,
+        number_input,
+        overflow_section,
+        plain_text_input,
+        radio_buttons_input,
+        select_menu_input,
+        time_picker_input,
+        url_input,
+        channel_select_input,
+        conversation_select_input,
+        divider2,
+        actions,
+    ]
+
+
+# block id of the section of each lunch option in the poll, and the option it represents
+LUNCH_OPTIONS = {
+    "lunch_sushi": "sushi",
+    "lunch_hamburger": "hamburger",
+    "lunch_ramen": "ramen",
+}
+
+
+def format_votes(count: int) -> str:
+    if count == 0:
+        return "No votes"
+    return "1 vote" if count == 1 else f"{count} votes"
+
+
+def lunch_layout() -> list[blocks.Block]:
+    return [
+        blocks.SectionBlock(
+            text=blocks.MarkdownTextObject(
+                text='*Where should we order lunch from?* Poll by <fakeLink.toUser.com|Mark>'),
+            fields=[]
+        ),
+        blocks.DividerBlock(),
+        blocks.SectionBlock(
+            block_id="lunch_sushi",
+            text=blocks.MarkdownTextObject(
+                text=':sushi: *Ace Wasabi Rock-n-Roll Sushi Bar*\nThe best landlocked sushi restaurant.'
+            ),
+            fields=[],
+            accessory=blocks.ButtonElement(
+                action_id="sushi",
+                text=blocks.PlainTextObject(text='Vote', emoji=True),
+            )
+        ),
+        blocks.ContextBlock(
+            elements=[blocks.MarkdownTextObject(text='{sushi_votes}')]
+        ),
+        blocks.SectionBlock(
+            block_id="lunch_hamburger",
+            text=blocks.MarkdownTextObject(
+                text=':hamburger: *Super Hungryman Hamburgers*\nOnly for the hungriest of the hungry.'
+            ),
+            fields=[],
+            accessory=blocks.ButtonElement(
+                action_id="hamburger",
+                text=blocks.PlainTextObject(text='Vote', emoji=True),
+            )
+        ),
+        blocks.ContextBlock(
+            elements=[blocks.MarkdownTextObject(text='{hamburger_votes}')]
+        ),
+        blocks.SectionBlock(
+            block_id="lunch_ramen",
+            text=blocks.MarkdownTextObject(
+                text=':ramen: *Kagawa-Ya Udon Noodle Shop*\nDo you like to shop for noodles? We have noodles.'
+            ),
+            fields=[],
+            accessory=blocks.ButtonElement(
+                action_id="ramen",
+                text=blocks.PlainTextObject(text='Vote', emoji=True),
+            )
+        ),
+        blocks.ContextBlock(
+            elements=[blocks.MarkdownTextObject(text='{ramen_votes}')]
+        ),
+        blocks.DividerBlock(),
+        blocks.ActionsBlock(
+            elements=[
+                blocks.ButtonElement(text=blocks.PlainTextObject(text='Add a suggestion', emoji=True),
+                                     value='click_me_123')
+            ]
         )
-        deny_button = blocks.ButtonElement(
-            text="No, thank you.",
-            action_id="interactions_deny",
-            value=f"{msg.sender.id}",
-            style="danger",
+    ]
+
+
+class BlockKit(KitchensinkPlugin):
+    """Block Kit"""
+
+    _interactions_template: Optional[BlockTemplate] = None
+    _lunch_template: Optional[BlockTemplate] = None
+
+    async def init(self):
+        await super().init()
+        self.lunch_poll = PollEngine(self.storage, self.update_lunch_poll)
+        self.interactions_debouncer = Debouncer(
+            float(self.settings.get("KITCHENSINK_INTERACTIONS_WINDOW", 2.0)), self.log_interaction
         )
+        # notifications that log interactions, so later interactions update those instead of posting new ones
+        self.interaction_logs = LRUCache(maxsize=1000)
+        self.interaction_counters = Counter()
+
+    # The templates are built when they're first used rather than at startup, because building the layouts is
+    # relatively expensive. These are methods rather than properties, because Slack Machine evaluates all properties
+    # of a plugin when it registers the plugin's handlers.
+    def _get_interactions_template(self) -> BlockTemplate:
+        if self._interactions_template is None:
+            self._interactions_template = BlockTemplate(interactions_layout(), fields=["at_sender", "sender_id"])
+        return self._interactions_template
 
-        buttons = [approve_button, deny_button]
+    def _get_lunch_template(self) -> BlockTemplate:
+        if self._lunch_template is None:
+            self._lunch_template = BlockTemplate(
+                lunch_layout(), fields=[f"{option}_votes" for option in LUNCH_OPTIONS.values()]
+            )
+        return self._lunch_template
 
-        actions = blocks.ActionsBlock(
-            block_id="interactions_confirmation", elements=buttons
+    def render_lunch_poll(self, tally: Counter) -> list[dict]:
+        return self._get_lunch_template().render(
+            **{f"{option}_votes": format_votes(tally[option]) for option in LUNCH_OPTIONS.values()}
         )
 
+    @listen_to(r"^interactions")
+    async def interactions(self, msg: Message):
         await msg.reply(
             # providing text is strongly advised for i.e. mobile notifications
             text=f"Hey {msg.at_sender}, you wanna see some interactive goodness? I can show you!",
-            blocks=[
-                header,
-                message,
-                divider1,
-                date_picker_input,
-                checkboxes_input,
-                email_input,
-                multi_select_menu_input,
-                number_input,
-                overflow_section,
-                plain_text_input,
-                radio_buttons_input,
-                select_menu_input,
-                time_picker_input,
-                url_input,
-                channel_select_input,
-                conversation_select_input,
-                divider2,
-                actions,
-            ],
+            blocks=self._get_interactions_template().render(at_sender=msg.at_sender, sender_id=msg.sender.id),
         )
 
     @action(action_id=None, block_id=re.compile(r"interaction.*", re.IGNORECASE))
     async def interactions_logger(self, action: BlockAction, logger: BoundLogger):
         logger.info("Interaction triggered", triggered_action=action.triggered_action)
-        msg = f"{action.user.fmt_mention()} has triggered:\n```{action.triggered_action.model_dump_json(indent=2)}```"
-        await action.say(msg, ephemeral=False)
+        if action.payload.message is None:
+            return
+        # Text inputs trigger an action for every character that's entered, so interactions are coalesced per user
+        # and block and only the latest state is shown once the burst is over.
+        key = (action.payload.channel.id, action.payload.message.ts, action.user.id, action.triggered_action.block_id)
+        self.interactions_debouncer.trigger(key, action)
 
+    async def log_interaction(self, key: tuple, action: BlockAction, count: int):
+        self.interaction_counters["events"] += count
+        self.interaction_counters["coalesced"] += count - 1
+        msg = f"{action.user.fmt_mention()} has triggered:\n```{action.triggered_action.model_dump_json(indent=2)}```"
+        if count > 1:
+            msg += f"\n_{count} events were coalesced into this one_"
+        # Logs of different users and blocks are merged into one message, and every log is updated in place
+        notification = self.interaction_logs.get(key)
+        if notification is None:
+            notification = await self.notify(msg, channel=key[0])
+        else:
+            notification = await self.update_notification(notification, msg)
+        if notification is not None:
+            self.interaction_logs.set(key, notification)
 
     @respond_to(r"^order lunch")
     async def order_lunch(self, msg: Message):
-        blcks = [
-            blocks.SectionBlock(
-                text=blocks.MarkdownTextObject(
-                    text='*Where should we order lunch from?* Poll by <fakeLink.toUser.com|Mark>'),
-                fields=[]
-            ),
-            blocks.DividerBlock(),
-            blocks.SectionBlock(
-                block_id="lunch_sushi",
-                text=blocks.MarkdownTextObject(
-                    text=':sushi: *Ace Wasabi Rock-n-Roll Sushi Bar*\nThe best landlocked sushi restaurant.'
-                ),
-                fields=[],
-                accessory=blocks.ButtonElement(
-                    action_id="sushi",
-                    text=blocks.PlainTextObject(text='Vote', emoji=True),
-                )
-            ),
-            blocks.ContextBlock(
-                elements=[
-                    blocks.ImageElement(image_url='https://api.slack.com/img/blocks/bkb_template_images/profile_1.png',
-                                        alt_text='Michael Scott'),
-                    blocks.ImageElement(image_url='https://api.slack.com/img/blocks/bkb_template_images/profile_2.png',
-                                        alt_text='Dwight Schrute'),
-                    blocks.ImageElement(image_url='https://api.slack.com/img/blocks/bkb_template_images/profile_3.png',
-                                        alt_text='Pam Beasely'),
-                    blocks.PlainTextObject(text='3 votes', emoji=True)
-                ]
-            ),
-            blocks.SectionBlock(
-                block_id="lunch_hamburger",
-                text=blocks.MarkdownTextObject(
-                    text=':hamburger: *Super Hungryman Hamburgers*\nOnly for the hungriest of the hungry.'
-                ),
-                fields=[],
-                accessory=blocks.ButtonElement(
-                    action_id="hamburger",
-                    text=blocks.PlainTextObject(text='Vote', emoji=True),
-                )
-            ),
-            blocks.ContextBlock(
-                elements=[
-                    blocks.ImageElement(image_url='https://api.slack.com/img/blocks/bkb_template_images/profile_4.png',
-                                        alt_text='Angela'),
-                    blocks.ImageElement(image_url='https://api.slack.com/img/blocks/bkb_template_images/profile_2.png',
-                                        alt_text='Dwight Schrute'),
-                    blocks.PlainTextObject(text='2 votes', emoji=True)
-                ]
-            ),
-            blocks.SectionBlock(
-                block_id="lunch_ramen",
-                text=blocks.MarkdownTextObject(
-                    text=':ramen: *Kagawa-Ya Udon Noodle Shop*\nDo you like to shop for noodles? We have noodles.'
-                ),
-                fields=[],
-                accessory=blocks.ButtonElement(
-                    action_id="ramen",
-                    text=blocks.PlainTextObject(text='Vote', emoji=True),
-                )
-            ),
-            blocks.ContextBlock(
-                elements=[
-                    blocks.MarkdownTextObject(text='No votes')]
-            ),
-            blocks.DividerBlock(),
-            blocks.ActionsBlock(
-                elements=[
-                    blocks.ButtonElement(text=blocks.PlainTextObject(text='Add a suggestion', emoji=True),
-                                         value='click_me_123')
-                ]
-            )
-        ]
-        await msg.say("Vote for lunch", blocks=blcks)
+        await msg.say("Vote for lunch", blocks=self.render_lunch_poll(Counter()))
 
     @action(action_id=None, block_id=re.compile(r"lunch.*", re.IGNORECASE))
+    @idempotent(lambda action: f"{action.user.id}:{action.triggered_action.action_ts}")
     async def lunch_action(self, action: BlockAction, logger: BoundLogger):
         logger.info("Action triggered", triggered_action=action.triggered_action)
-        food_block = \
-            [block for block in action.payload.message.blocks if block.block_id == action.triggered_action.block_id][0]
-        food_block_section = cast(blocks.SectionBlock, food_block)
-        food_description = str(food_block_section.text.text)
-        msg = f"{action.user.fmt_mention()} has voted for '{food_description}'"
-        await action.say(msg, ephemeral=False)
+        option = LUNCH_OPTIONS.get(action.triggered_action.block_id)
+        if option is None or action.payload.message is None:
+            return
+        poll = (action.payload.channel.id, action.payload.message.ts)
+        await self.lunch_poll.vote(poll, action.user.id, option)
+
+    async def update_lunch_poll(self, poll: PollKey, tally: Counter):
+        channel, ts = poll
+        await self.update(channel, ts, text="Vote for lunch", blocks=self.render_lunch_poll(tally))
@@ -0,0 +1,111 @@
+import asyncio
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, Hashable, Optional, Set
+
+from machine.storage import PluginStorage
+from structlog.stdlib import get_logger
+
+main_logger = get_logger(__name__)
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Dictionary-like cache that holds at most `maxsize` items, evicting the least recently used item first"""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        try:
+            self._items.move_to_end(key)
+        except KeyError:
+            return default
+        return self._items[key]
+
+    def set(self, key: Hashable, value: Any):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        return self._items.pop(key, default)
+
+    def clear(self):
+        self._items.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class WriteThroughCache:
+    """In-memory cache in front of plugin storage
+
+    Values are read from storage only the first time a key is requested. Writes update the cache right away and are
+    written to storage in the background: all keys that changed within `flush_delay` seconds are written together,
+    and only their latest value is written.
+    """
+
+    def __init__(
+        self,
+        storage: PluginStorage,
+        prefix: str,
+        flush_delay: float = 1.0,
+        expires: Optional[timedelta] = None,
+    ):
+        self._storage = storage
+        self._prefix = prefix
+        self._flush_delay = flush_delay
+        self._expires = expires
+        self._values: Dict[str, Any] = {}
+        self._dirty: Set[str] = set()
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def _storage_key(self, key: str) -> str:
+        return f"{self._prefix}:{key}"
+
+    def lock(self, key: str) -> asyncio.Lock:
+        """Lock to serialize read-modify-write sequences on a single key"""
+        return self._locks.setdefault(key, asyncio.Lock())
+
+    async def get(self, key: str, default: Optional[Any] = None) -> Any:
+        value = self._values.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._values[key] = await self._storage.get(self._storage_key(key))
+        return default if value is None else value
+
+    def set(self, key: str, value: Any):
+        self._values[key] = value
+        self._dirty.add(key)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._flush_delay)
+        # values that change while flushing are written by the next flush
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Write all changed values to storage"""
+        dirty, self._dirty = self._dirty, set()
+        results = await asyncio.gather(
+            *(self._storage.set(self._storage_key(key), self._values[key], expires=self._expires) for key in dirty),
+            return_exceptions=True,
+        )
+        for key, result in zip(dirty, results):
+            if isinstance(result, Exception):
+                main_logger.error("Writing to storage failed", key=key, exc_info=result)
+                self._dirty.add(key)
+        if self._dirty:
+            self._schedule_flush()
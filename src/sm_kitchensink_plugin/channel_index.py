@@ -0,0 +1,56 @@
+from typing import Dict, Optional
+
+from machine.models import Channel
+
+
+class ChannelIndex:
+    """Index of channel names to channel ids, on top of Slack Machine's channel cache
+
+    Names are resolved by scanning all channels only the first time they are looked up. After that, lookups are a dict
+    lookup plus a check that the cached channel still exists under that name. The index should be invalidated when
+    channels are created, renamed, archived or deleted, so names that couldn't be resolved before are retried.
+    """
+
+    def __init__(self):
+        self._ids: Dict[str, Optional[str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(name: str) -> str:
+        return name[1:].lower() if name.startswith("#") else name.lower()
+
+    def find(self, channels: Dict[str, Channel], channel_name: str) -> Optional[Channel]:
+        """Find a channel by its name, irrespective of a preceding pound symbol. This does not include DMs.
+
+        :param channels: Slack Machine's channel cache, by channel id
+        :param channel_name: The name of the channel to retrieve.
+        :return: The channel if found, None otherwise.
+        """
+        name = self._normalize(channel_name)
+        if name in self._ids:
+            channel_id = self._ids[name]
+            if channel_id is None:
+                self.hits += 1
+                return None
+            channel = channels.get(channel_id)
+            if channel is not None and channel.name_normalized and channel.name_normalized.lower() == name:
+                self.hits += 1
+                return channel
+        self.misses += 1
+        found = None
+        for channel in channels.values():
+            if channel.name_normalized and channel.name_normalized.lower() == name:
+                found = channel
+                break
+        self._ids[name] = found.id if found is not None else None
+        return found
+
+    def invalidate(self):
+        self._ids.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._ids), "hits": self.hits, "misses": self.misses}
+
+
+channel_index = ChannelIndex()
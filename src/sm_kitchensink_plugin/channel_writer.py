@@ -0,0 +1,204 @@
+import asyncio
+from collections import Counter
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from machine.clients.slack import SlackClient
+from structlog.stdlib import get_logger
+
+from sm_kitchensink_plugin.caching import LRUCache
+
+main_logger = get_logger(__name__)
+
+# Slack accepts at most 50 blocks per message and 3000 characters per section block, and truncates the text of a
+# message beyond 40000 characters
+MAX_BLOCKS = 50
+MAX_SECTION_TEXT = 3000
+MAX_MESSAGE_TEXT = 40000
+
+
+class Notification(NamedTuple):
+    """A notification that was posted, as part of the message with timestamp `ts` in `channel`"""
+
+    channel: str
+    ts: str
+    index: int
+
+
+FENCE = "```"
+# a section that ends in a code block closes it on a line of its own, and the next section reopens it
+MAX_LINE = MAX_SECTION_TEXT - 2 * (len(FENCE) + 1)
+
+
+def _lines(text: str) -> Iterator[str]:
+    for line in text.split("\n"):
+        # only lines that don't fit in a section on their own are cut up
+        for start in range(0, max(len(line), 1), MAX_LINE):
+            yield line[start:start + MAX_LINE]
+
+
+def _sections(text: str) -> List[dict]:
+    """Sections that hold `text`, split on line boundaries so a code block is closed and reopened around a split"""
+    if not text:
+        return []
+    texts = []
+    lines: List[str] = []
+    length = -1
+    fenced = False
+    for line in _lines(text):
+        # the fences in a line open or close a code block in turn, so an odd number flips whether it is open
+        fenced_after = fenced != (line.count(FENCE) % 2 == 1)
+        if lines and length + 1 + len(line) + (len(FENCE) + 1 if fenced_after else 0) > MAX_SECTION_TEXT:
+            texts.append("\n".join(lines + [FENCE] if fenced else lines))
+            lines = [FENCE] if fenced else []
+            length = len(FENCE) if fenced else -1
+        lines.append(line)
+        length += 1 + len(line)
+        fenced = fenced_after
+    texts.append("\n".join(lines))
+    return [{"type": "section", "text": {"type": "mrkdwn", "text": text}} for text in texts]
+
+
+def render(texts: List[str]) -> Tuple[str, List[dict]]:
+    """Text and blocks of a message that holds `texts`, every text in its own section(s)"""
+    blocks = [section for text in texts for section in _sections(text)]
+    return "\n\n".join(texts), blocks
+
+
+def fits(texts: List[str]) -> bool:
+    text, blocks = render(texts)
+    return len(blocks) <= MAX_BLOCKS and len(text) <= MAX_MESSAGE_TEXT
+
+
+class ChannelWriter:
+    """Merges notifications to the same channel into as few messages as possible
+
+    Slack allows about one message per second per channel, so the notifications that are written to a channel within
+    `window` seconds are posted as a single message with a section per notification, in the order they were written.
+    When they don't fit within Slack's limits on the number of blocks and the size of the text, they're spread over
+    multiple messages. Notifications written with `immediate=True` are posted right away as a separate message, after
+    the notifications that were already waiting.
+
+    The notifications in recently posted messages are remembered, so a single notification can be updated without
+    touching the others in the same message.
+    """
+
+    def __init__(self, window: float = 1.0):
+        self.window = window
+        self._client: Optional[SlackClient] = None
+        self._pending: Dict[str, List[Tuple[str, asyncio.Future]]] = {}
+        self._timers: Dict[str, asyncio.Task] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._messages = LRUCache(maxsize=1000)
+        self._counters: Counter = Counter()
+
+    def install(self, client: SlackClient, window: Optional[float] = None):
+        """Post through `client`. Installing more than once is a no-op."""
+        if self._client is not None:
+            return
+        self._client = client
+        if window is not None:
+            self.window = window
+
+    def write(self, channel_id: str, text: str, immediate: bool = False) -> "asyncio.Future[Optional[Notification]]":
+        """Queue a notification
+
+        :return: future that resolves to the notification once it is posted, or None if posting failed
+        """
+        future = asyncio.get_running_loop().create_future()
+        text = text[:MAX_MESSAGE_TEXT]
+        self._counters["notifications"] += 1
+        if immediate:
+            timer = self._timers.pop(channel_id, None)
+            if timer is not None:
+                timer.cancel()
+            pending = self._pending.pop(channel_id, [])
+            self._spawn(self._post(channel_id, [pending, [(text, future)]]))
+            return future
+        pending = self._pending.get(channel_id)
+        if pending is None:
+            pending = self._pending[channel_id] = []
+            self._timers[channel_id] = self._spawn(self._flush_later(channel_id))
+        pending.append((text, future))
+        return future
+
+    async def update(self, notification: Notification, text: str) -> Optional[Notification]:
+        """Replace the text of a notification that was posted before
+
+        When the message it is part of isn't remembered anymore, or the new text doesn't fit in it, the text is
+        posted as a new notification instead.
+
+        :return: the updated notification, or None if updating failed
+        """
+        channel_id, ts, index = notification
+        text = text[:MAX_MESSAGE_TEXT]
+        async with self._lock(channel_id):
+            texts = self._messages.get((channel_id, ts))
+            updated = texts[:index] + [text] + texts[index + 1:] if texts is not None else None
+            if updated is not None and fits(updated):
+                message_text, blocks = render(updated)
+                try:
+                    await self._client.update(channel_id, ts, text=message_text, blocks=blocks)
+                except Exception:
+                    main_logger.exception("Updating notification failed", channel=channel_id, ts=ts)
+                    return None
+                # only remembered once Slack has it, so the message stays as it is in Slack when updating fails
+                self._messages.set((channel_id, ts), updated)
+                return notification
+        return await self.write(channel_id, text)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._counters, "pending": sum(len(pending) for pending in self._pending.values())}
+
+    def _lock(self, channel_id: str) -> asyncio.Lock:
+        return self._locks.setdefault(channel_id, asyncio.Lock())
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_later(self, channel_id: str):
+        await asyncio.sleep(self.window)
+        self._timers.pop(channel_id, None)
+        await self._post(channel_id, [self._pending.pop(channel_id, [])])
+
+    async def _post(self, channel_id: str, batches: List[List[Tuple[str, asyncio.Future]]]):
+        # posts to a channel are serialized, so they end up in the order they were written
+        async with self._lock(channel_id):
+            for batch in batches:
+                for message in self._split(batch):
+                    await self._send(channel_id, message)
+
+    @staticmethod
+    def _split(batch: List[Tuple[str, asyncio.Future]]) -> List[List[Tuple[str, asyncio.Future]]]:
+        messages: List[List[Tuple[str, asyncio.Future]]] = []
+        for item in batch:
+            if messages and fits([text for text, _ in messages[-1]] + [item[0]]):
+                messages[-1].append(item)
+            else:
+                messages.append([item])
+        return messages
+
+    async def _send(self, channel_id: str, message: List[Tuple[str, asyncio.Future]]):
+        texts = [text for text, _ in message]
+        text, blocks = render(texts)
+        try:
+            response = await self._client.send(channel_id, text=text, blocks=blocks)
+        except Exception:
+            main_logger.exception("Posting notifications failed", channel=channel_id, notifications=len(message))
+            self._counters["failed"] += len(message)
+            for _, future in message:
+                if not future.done():
+                    future.set_result(None)
+            return
+        ts = response["ts"]
+        self._messages.set((channel_id, ts), texts)
+        self._counters["messages"] += 1
+        for index, (_, future) in enumerate(message):
+            if not future.done():
+                future.set_result(Notification(channel_id, ts, index))
+
+
+channel_writer = ChannelWriter()
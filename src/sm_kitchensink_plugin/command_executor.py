@@ -0,0 +1,123 @@
+import asyncio
+import functools
+import time
+from collections import Counter
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from structlog.stdlib import get_logger
+
+from sm_kitchensink_plugin.metrics import metrics
+
+main_logger = get_logger(__name__)
+
+# Slack shows an error to the user when a slash command isn't acknowledged within 3 seconds
+ACK_DEADLINE = 3.0
+
+
+class ExecutorBusy(Exception):
+    """The command executor has no room for more work"""
+
+
+def _timed_call(fn: Callable[..., Any], args: Tuple[Any, ...]) -> Tuple[float, Any]:
+    # runs in the worker, so the wall clock time is comparable across processes
+    return time.time(), fn(*args)
+
+
+class CommandExecutor:
+    """Runs the blocking work of slash commands in a pool, so it doesn't block the event loop for other handlers
+
+    The pool is a thread pool, or a process pool for CPU-bound work that holds the GIL. Functions that run in a
+    process pool and their arguments and results have to be picklable, so they should be defined at module level. At
+    most `workers` jobs run at the same time and `queue_size` more wait for a worker. When that's full, submitting
+    raises ``ExecutorBusy`` rather than letting the backlog grow. The time jobs wait for a worker is recorded per
+    handler, see ``sm_kitchensink_plugin.metrics``.
+    """
+
+    def __init__(self, kind: str = "thread", workers: int = 4, queue_size: int = 100):
+        self.kind = kind
+        self.workers = workers
+        self.queue_size = queue_size
+        self._pool: Optional[Executor] = None
+        self._active = 0
+        self._counters: Counter = Counter()
+
+    def configure(self, kind: Optional[str] = None, workers: Optional[int] = None, queue_size: Optional[int] = None):
+        """Change the pool, configuring after the pool was started is a no-op"""
+        if self._pool is not None:
+            return
+        if kind is not None:
+            if kind not in ("thread", "process"):
+                raise ValueError(f"Unknown command executor: {kind}, expected thread or process")
+            self.kind = kind
+        if workers is not None:
+            self.workers = workers
+        if queue_size is not None:
+            self.queue_size = queue_size
+
+    def _get_pool(self) -> Executor:
+        if self._pool is None:
+            if self.kind == "process":
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="kitchensink-command")
+        return self._pool
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run `fn(*args)` in the pool and return its result
+
+        :raises ExecutorBusy: when all workers are busy and the queue is full
+        """
+        if self._active >= self.workers + self.queue_size:
+            self._counters["rejected"] += 1
+            raise ExecutorBusy(f"{self._active} commands are running or waiting")
+        self._active += 1
+        submitted = time.time()
+        try:
+            started, result = await asyncio.get_running_loop().run_in_executor(
+                self._get_pool(), _timed_call, fn, args
+            )
+        except Exception:
+            self._counters["failed"] += 1
+            raise
+        finally:
+            self._active -= 1
+        metrics.record_command_queue_wait(max(0.0, started - submitted))
+        self._counters["completed"] += 1
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._counters, "kind": self.kind, "active": self._active}
+
+
+def fast_ack(ack: Optional[str] = None):
+    """Acknowledge a slash command before the handler does any work
+
+    Apply below ``@command`` on a coroutine handler. The handler is turned into a generator that acknowledges the
+    command with `ack` as immediate response, or with an empty acknowledgement, and then runs the handler. Results
+    are posted with ``command.say``, which uses the response URL of the command. The handler should hand blocking
+    work to ``command_executor``; when that is busy the user is asked to try again later.
+    """
+
+    def fast_ack_decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(self, command, *args, **kwargs):
+            start = time.perf_counter()
+            yield ack
+            # resumed once Slack Machine sent the acknowledgement
+            elapsed = time.perf_counter() - start
+            metrics.record_command_ack(elapsed)
+            if elapsed > ACK_DEADLINE:
+                main_logger.warning("Slash command acknowledged too late", command=command.command, seconds=elapsed)
+            try:
+                await fn(self, command, *args, **kwargs)
+            except ExecutorBusy:
+                main_logger.warning("Command executor busy, rejected command", command=command.command)
+                await command.say("I'm too busy right now, please try again in a minute")
+
+        return wrapper
+
+    return fast_ack_decorator
+
+
+command_executor = CommandExecutor()
@@ -0,0 +1,53 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Set
+
+from structlog.stdlib import get_logger
+
+main_logger = get_logger(__name__)
+
+
+class Debouncer:
+    """Coalesces bursts of triggers per key into a single callback
+
+    The first trigger for a key opens a window of `window` seconds. Triggers for the same key that arrive while the
+    window is open only replace the value that was passed along. When the window closes, `callback` is called once with
+    the key, the latest value and the number of triggers that were coalesced.
+    """
+
+    def __init__(self, window: float, callback: Callable[[Hashable, Any, int], Awaitable[None]]):
+        self.window = window
+        self._callback = callback
+        self._pending: Dict[Hashable, List[Any]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def trigger(self, key: Hashable, value: Any = None):
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending[0] = value
+            pending[1] += 1
+            return
+        self._pending[key] = [value, 1]
+        task = asyncio.create_task(self._flush_later(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def _flush_later(self, key: Hashable):
+        await asyncio.sleep(self.window)
+        await self._flush(key)
+
+    async def _flush(self, key: Hashable):
+        value, count = self._pending.pop(key)
+        try:
+            await self._callback(key, value, count)
+        except Exception:
+            main_logger.exception("Debounced callback failed", key=key)
+
+    async def flush_all(self):
+        """Close all open windows right away"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*(self._flush(key) for key in list(self._pending)))
@@ -0,0 +1,119 @@
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from machine.storage import PluginStorage
+from structlog.stdlib import get_logger
+
+from sm_kitchensink_plugin.leader import leader
+from sm_kitchensink_plugin.leases import leases
+
+main_logger = get_logger(__name__)
+
+LOG_KEY = "modal-digest:current"
+LOCK_KEY = "kitchensink:modal-digest"
+# posting a digest happens under the lock, and can wait for the API scheduler
+LOCK_TTL = 60.0
+
+# responses are truncated and only this many distinct responses are kept per digest, so the log stays compact
+MAX_RESPONSE_LENGTH = 200
+MAX_RESPONSES = 1000
+
+
+class SubmissionDigest:
+    """Collects modal submissions and cancellations, and reports them in digests
+
+    Instead of keeping every submission, the log in plugin storage holds the number of submissions and cancellations
+    and how often every response was given since the last digest. A digest is passed to `on_digest` every `interval`
+    seconds and as soon as `size` submissions and cancellations have been collected, but only if there is anything to
+    report. Either can be disabled by setting it to 0.
+
+    Shards and replicas that share the storage update the log one at a time, under a lease, so they add to each
+    other's counts. Only the leader posts the periodic digest, whichever replica fills the log up posts that one.
+    """
+
+    def __init__(
+        self,
+        storage: PluginStorage,
+        on_digest: Callable[[str], Awaitable[None]],
+        interval: float = 3600,
+        size: int = 100,
+        top: int = 5,
+    ):
+        self._on_digest = on_digest
+        self.interval = interval
+        self.size = size
+        self.top = top
+        self._storage = storage
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start posting digests periodically"""
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._post_periodically())
+
+    @staticmethod
+    def _empty() -> Dict[str, Any]:
+        return {"since": None, "submissions": 0, "cancellations": 0, "responses": Counter()}
+
+    async def add_submission(self, response: Optional[str]):
+        await self._add("submissions", response)
+
+    async def add_cancellation(self):
+        await self._add("cancellations")
+
+    async def _add(self, field: str, response: Optional[str] = None):
+        async with leases.lock(LOCK_KEY, ttl=LOCK_TTL):
+            log = await self._storage.get(LOG_KEY) or self._empty()
+            log["since"] = log["since"] or time.time()
+            log[field] += 1
+            if response:
+                response = " ".join(response.split())[:MAX_RESPONSE_LENGTH]
+                if response in log["responses"] or len(log["responses"]) < MAX_RESPONSES:
+                    log["responses"][response] += 1
+            await self._storage.set(LOG_KEY, log)
+            if self.size > 0 and log["submissions"] + log["cancellations"] >= self.size:
+                try:
+                    await self._post(log)
+                except Exception:
+                    main_logger.exception("Posting modal digest failed")
+
+    async def post(self) -> bool:
+        """Post a digest of everything collected since the last one
+
+        :return: whether there was anything to report
+        """
+        async with leases.lock(LOCK_KEY, ttl=LOCK_TTL):
+            log = await self._storage.get(LOG_KEY)
+            if not log or not (log["submissions"] or log["cancellations"]):
+                return False
+            await self._post(log)
+            return True
+
+    async def _post(self, log: Dict[str, Any]):
+        # the log is only reset once the digest went out, so nothing gets lost when posting fails
+        await self._on_digest(self.render(log))
+        await self._storage.set(LOG_KEY, self._empty())
+
+    def render(self, log: Dict[str, Any]) -> str:
+        since = datetime.fromtimestamp(log["since"]).strftime("%Y-%m-%d %H:%M")
+        lines = [
+            f"*Modal digest* since {since}: {log['submissions']} submissions, {log['cancellations']} cancellations"
+        ]
+        top_responses = log["responses"].most_common(self.top)
+        if top_responses:
+            lines.append("Top responses:")
+            lines.extend(f"• {response} ({count})" for response, count in top_responses)
+        return "\n".join(lines)
+
+    async def _post_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not leader.is_leader:
+                continue
+            try:
+                await self.post()
+            except Exception:
+                main_logger.exception("Posting modal digest failed")
@@ -0,0 +1,191 @@
+"""Prefiltered message dispatch
+
+Slack Machine matches every incoming message against the regex of every ``listen_to`` and ``respond_to`` handler.
+The decorators in this module are drop-in replacements for the ones from ``machine.plugins.decorators``, but they
+register patterns in a shared index. The first time a message is matched, the index determines in a single pass which
+patterns can possibly match it:
+
+- patterns that match a literal exactly (``^reply$``) are looked up in a dictionary
+- patterns that start with a literal (``^list users``) are looked up by their first character
+- other patterns with a literal in them (``.*pin.*``) are found by a substring search for that literal
+
+Only those candidates run their full regex, all other patterns return no match right away.
+
+``every_shard`` marks the event handlers that run on every shard in sharded mode, see
+``sm_kitchensink_plugin.sharding``. It's defined here rather than there, so plugins don't import the sharding machinery.
+"""
+import re
+from typing import Callable, Dict, FrozenSet, List, Optional, Set, Tuple, cast
+
+from machine.plugins.decorators import DecoratedPluginFunc, P, R
+from machine.plugins.metadata import MatcherConfig, Metadata
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:  # pragma: no cover
+    import sre_parse
+
+_AT = sre_parse.AT
+_LITERAL = sre_parse.LITERAL
+
+
+class PrefilteredPattern:
+    """Compiled regex that only searches messages that the pattern index marks as candidates"""
+
+    def __init__(self, index: "PatternIndex", regex: re.Pattern):
+        self._index = index
+        self.regex = regex
+        self.pattern = regex.pattern
+        self.flags = regex.flags
+
+    def search(self, text: str, *args):
+        index = self._index
+        candidates = index._last_candidates if text is index._last_text else index.candidates(text)
+        if self in candidates:
+            return self.regex.search(text, *args)
+        return None
+
+    def __getattr__(self, name: str):
+        return getattr(self.regex, name)
+
+    def __repr__(self) -> str:
+        return f"PrefilteredPattern({self.pattern!r})"
+
+
+def _analyze(regex: re.Pattern) -> Tuple[str, Optional[str]]:
+    """Determine how a pattern can be prefiltered
+
+    :return: the kind of prefilter (exact, prefix, keyword or none) and the lowercased literal to filter on
+    """
+    try:
+        parsed = list(sre_parse.parse(regex.pattern, regex.flags))
+    except re.error:
+        return "none", None
+    multiline = bool(regex.flags & re.MULTILINE)
+    anchored = not multiline and parsed[:1] == [(_AT, sre_parse.AT_BEGINNING)]
+    # top level literals are required for a match, find the longest run of them
+    runs: List[Tuple[int, str]] = []
+    start, run = 0, ""
+    for i, (op, av) in enumerate(parsed):
+        if op == _LITERAL:
+            if not run:
+                start = i
+            run += chr(av)
+        else:
+            if run:
+                runs.append((start, run))
+            run = ""
+    if run:
+        runs.append((start, run))
+    runs = [(start, run) for start, run in runs if run.isascii()]
+    if not runs:
+        return "none", None
+    if anchored and runs[0][0] == 1:
+        literal = runs[0][1].lower()
+        if len(parsed) == len(literal) + 2 and parsed[-1] == (_AT, sre_parse.AT_END):
+            return "exact", literal
+        return "prefix", literal
+    return "keyword", max(runs, key=lambda r: len(r[1]))[1].lower()
+
+
+class PatternIndex:
+    """Combined matcher for a set of message patterns"""
+
+    def __init__(self):
+        self._exact: Dict[str, List[PrefilteredPattern]] = {}
+        self._prefixes: Dict[str, List[Tuple[str, PrefilteredPattern]]] = {}
+        self._keywords: Dict[str, List[PrefilteredPattern]] = {}
+        self._unfiltered: List[PrefilteredPattern] = []
+        self._last_text: Optional[str] = None
+        self._last_candidates: FrozenSet[PrefilteredPattern] = frozenset()
+
+    def add(self, regex: re.Pattern) -> PrefilteredPattern:
+        pattern = PrefilteredPattern(self, regex)
+        kind, literal = _analyze(regex)
+        if kind == "exact":
+            self._exact.setdefault(literal, []).append(pattern)
+        elif kind == "prefix":
+            self._prefixes.setdefault(literal[0], []).append((literal, pattern))
+        elif kind == "keyword":
+            self._keywords.setdefault(literal, []).append(pattern)
+        else:
+            self._unfiltered.append(pattern)
+        self._last_text = None
+        return pattern
+
+    def candidates(self, text: str) -> FrozenSet[PrefilteredPattern]:
+        """Patterns that can possibly match `text`
+
+        Slack Machine matches a message against all handlers in a row, so the candidates of the last text are cached.
+        """
+        if text is self._last_text or text == self._last_text:
+            return self._last_candidates
+        lowered = text.lower()
+        candidates: Set[PrefilteredPattern] = set(self._unfiltered)
+        # `$` also matches right before a trailing newline
+        candidates.update(self._exact.get(lowered[:-1] if lowered.endswith("\n") else lowered, ()))
+        if lowered:
+            for prefix, pattern in self._prefixes.get(lowered[0], ()):
+                if lowered.startswith(prefix):
+                    candidates.add(pattern)
+        # With only a handful of keywords, a substring search per keyword is a lot faster than scanning the message
+        # once with an alternation of all keywords, because Python's regex engine doesn't optimize alternations.
+        for keyword, patterns in self._keywords.items():
+            if keyword in lowered:
+                candidates.update(patterns)
+        self._last_text = text
+        self._last_candidates = frozenset(candidates)
+        return self._last_candidates
+
+    def search(self, text: str) -> Optional[re.Match]:
+        """Match of the first pattern that matches `text`, if any"""
+        for pattern in self.candidates(text):
+            match = pattern.regex.search(text)
+            if match is not None:
+                return match
+        return None
+
+
+index = PatternIndex()
+
+
+def listen_to(
+    regex: str, flags: int = re.IGNORECASE, handle_message_changed: bool = False
+) -> Callable[[Callable[P, R]], DecoratedPluginFunc[P, R]]:
+    """Prefiltered version of ``machine.plugins.decorators.listen_to``"""
+
+    def listen_to_decorator(f: Callable[P, R]) -> DecoratedPluginFunc[P, R]:
+        fn = cast(DecoratedPluginFunc, f)
+        fn.metadata = getattr(f, "metadata", Metadata())
+        fn.metadata.plugin_actions.listen_to.append(
+            MatcherConfig(index.add(re.compile(regex, flags)), handle_message_changed)
+        )
+        return fn
+
+    return listen_to_decorator
+
+
+def respond_to(
+    regex: str, flags: int = re.IGNORECASE, handle_message_changed: bool = False
+) -> Callable[[Callable[P, R]], DecoratedPluginFunc[P, R]]:
+    """Prefiltered version of ``machine.plugins.decorators.respond_to``"""
+
+    def respond_to_decorator(f: Callable[P, R]) -> DecoratedPluginFunc[P, R]:
+        fn = cast(DecoratedPluginFunc, f)
+        fn.metadata = getattr(f, "metadata", Metadata())
+        fn.metadata.plugin_actions.respond_to.append(
+            MatcherConfig(index.add(re.compile(regex, flags)), handle_message_changed)
+        )
+        return fn
+
+    return respond_to_decorator
+
+
+def every_shard(fn):
+    """Also run a ``@process`` handler on the shards that don't own the event, when sharding
+
+    For handlers of the events in ``sharding.CACHE_EVENTS`` that keep a process-local cache in sync, like the channel
+    index. Other handlers only run on the shard that owns the event.
+    """
+    fn.__kitchensink_every_shard__ = True
+    return fn
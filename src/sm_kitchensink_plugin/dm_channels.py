@@ -0,0 +1,109 @@
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from machine.clients.slack import SlackClient
+from machine.storage import PluginStorage
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+from structlog.stdlib import get_logger
+
+from sm_kitchensink_plugin.caching import LRUCache
+
+main_logger = get_logger(__name__)
+
+KEY_PREFIX = "kitchensink:dm-channel"
+
+
+def _is_user_id(value: Any) -> bool:
+    return isinstance(value, str) and value[:1] in ("U", "W")
+
+
+class DMChannelCache:
+    """Maps users to the id of their DM channel with the bot
+
+    Slack Machine posts DMs to the user id, and Slack resolves the DM channel, so sending a DM doesn't need one. Code
+    that needs the channel itself, e.g. to update or delete a DM later, gets it from this cache. The cache is warmed
+    lazily: from the responses to DMs the bot posts, which name the channel, and with ``conversations.open`` for users
+    that weren't sent a DM yet. Channels are kept in a local LRU cache in front of the shared namespace of plugin
+    storage, which all plugins and replicas see, and are forgotten when Slack reports them as ``channel_not_found``.
+    """
+
+    def __init__(self, local_size: int = 10000):
+        self._client: Optional[SlackClient] = None
+        self._storage: Optional[PluginStorage] = None
+        self._local = LRUCache(maxsize=local_size)
+        self._users_by_channel = LRUCache(maxsize=local_size)
+        self._counters: Counter = Counter()
+
+    def install(self, client: SlackClient, storage: PluginStorage):
+        """Resolve channels through `client` and store them in `storage`. Installing more than once is a no-op."""
+        if self._client is not None:
+            return
+        self._client = client
+        self._storage = storage
+        self._learn_from(client.web_client)
+
+    async def get(self, user_id: str) -> str:
+        """The id of the DM channel of the bot with a user"""
+        channel_id = self._local.get(user_id)
+        if channel_id is not None:
+            self._counters["hits_local"] += 1
+            return channel_id
+        channel_id = await self._storage.get(f"{KEY_PREFIX}:{user_id}", shared=True)
+        if channel_id is not None:
+            self._counters["hits_storage"] += 1
+            self._remember(user_id, channel_id)
+            return channel_id
+        self._counters["misses"] += 1
+        channel_id = await self._client.open_im(user_id)
+        await self.learn(user_id, channel_id)
+        return channel_id
+
+    async def learn(self, user_id: str, channel_id: str):
+        if self._local.get(user_id) == channel_id:
+            return
+        self._remember(user_id, channel_id)
+        self._counters["learned"] += 1
+        await self._storage.set(f"{KEY_PREFIX}:{user_id}", channel_id, shared=True)
+
+    async def invalidate(self, channel_id: str):
+        """Forget a channel, e.g. because Slack doesn't know it anymore"""
+        user_id = self._users_by_channel.pop(channel_id)
+        if user_id is None:
+            return
+        self._local.pop(user_id)
+        self._counters["invalidated"] += 1
+        await self._storage.delete(f"{KEY_PREFIX}:{user_id}", shared=True)
+
+    def _remember(self, user_id: str, channel_id: str):
+        self._local.set(user_id, channel_id)
+        self._users_by_channel.set(channel_id, user_id)
+
+    def _learn_from(self, web_client: AsyncWebClient):
+        api_call = web_client.api_call
+
+        async def learning_api_call(api_method: str, **kwargs: Any):
+            payload = kwargs.get("json") or kwargs.get("data") or kwargs.get("params") or {}
+            channel = payload.get("channel") if isinstance(payload, dict) else None
+            try:
+                response = await api_call(api_method, **kwargs)
+            except SlackApiError as e:
+                if e.response.get("error") == "channel_not_found" and channel in self._users_by_channel:
+                    await self.invalidate(channel)
+                raise
+            if _is_user_id(channel) and str(response.get("channel", "")).startswith("D"):
+                try:
+                    await self.learn(channel, response["channel"])
+                except Exception:
+                    main_logger.exception("Storing DM channel failed", user=channel)
+            return response
+
+        web_client.api_call = learning_api_call
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self._counters["hits_local"] + self._counters["hits_storage"]
+        lookups = hits + self._counters["misses"]
+        return {**self._counters, "hit_rate": round(hits / lookups, 3) if lookups else None}
+
+
+dm_channels = DMChannelCache()
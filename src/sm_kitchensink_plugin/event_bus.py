@@ -0,0 +1,261 @@
+"""Plugin event bus with bounded queues, and an optional broker to spread events over replicas
+
+Without a broker, events are delivered to the handlers in the process. With a broker, every event goes to the broker,
+which hands it to exactly one connected replica, like a work queue. Each event is handled once however many replicas
+run, and replicas that are all connected share the events between them. The broker doesn't know which replica
+subscribed to what, so every replica should load the same plugins. Events that arrive at a replica without
+subscribers are counted and logged as unhandled.
+
+Run the local broker stand-in with:
+python -m sm_kitchensink_plugin.event_bus [--host 127.0.0.1] [--port 7777] [--by-event]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import zlib
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from structlog.stdlib import get_logger
+
+main_logger = get_logger(__name__)
+
+Payload = Dict[str, Any]
+
+
+class Subscription:
+    """Delivers the events a handler subscribed to from a bounded queue, with a fixed number of workers
+
+    When the queue is full, publishing either waits for room (`block`) or drops the event (`drop`). With a
+    `batch_size` above 1, the handler is called with a list of up to `batch_size` payloads, collected for at most
+    `batch_window` seconds. Otherwise it's called with the payload as keyword arguments. A single worker handles the
+    events in the order they were published, among the events the replica got from the broker if there is one.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[..., Awaitable[None]],
+        queue_size: int = 1000,
+        workers: int = 1,
+        policy: str = "block",
+        batch_size: int = 1,
+        batch_window: float = 0.1,
+    ):
+        self.handler = handler
+        self.policy = policy
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.counters: Counter = Counter()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(workers)]
+
+    async def put(self, payload: Payload):
+        if self.policy == "drop":
+            try:
+                self.queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                self.counters["dropped"] += 1
+                return
+        else:
+            await self.queue.put(payload)
+        self.counters["queued"] += 1
+
+    async def _next_batch(self) -> List[Payload]:
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _work(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                if self.batch_size > 1:
+                    await self.handler(batch)
+                else:
+                    await self.handler(**batch[0])
+                self.counters["delivered"] += len(batch)
+            except Exception:
+                main_logger.exception("Event handler failed", handler=self.handler.__qualname__, events=len(batch))
+                self.counters["failed"] += len(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.counters, "pending": self.queue.qsize()}
+
+
+class BrokerTransport:
+    """Sends events to a broker, and delivers the events the broker handed to this replica
+
+    The broker protocol is a line of JSON per event over TCP, and the broker sends every line to one of the connected
+    clients, which can be the one that sent it. The connection is retried until it succeeds, events published while
+    it's down are delivered locally.
+    """
+
+    def __init__(self, host: str, port: int, on_event: Callable[[str, Payload], Awaitable[None]]):
+        self.host = host
+        self.port = port
+        self._on_event = on_event
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self.counters: Counter = Counter()
+        self._task = asyncio.create_task(self._run())
+
+    async def send(self, event: str, payload: Payload) -> bool:
+        """Send an event to the broker, returns whether it was sent"""
+        if self._writer is None:
+            self.counters["unsent"] += 1
+            return False
+        try:
+            self._writer.write(json.dumps({"event": event, "payload": payload}).encode() + b"\n")
+            await self._writer.drain()
+        except OSError:
+            self.counters["unsent"] += 1
+            return False
+        self.counters["sent"] += 1
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_connection(self.host, self.port)
+                main_logger.info("Connected to event broker", host=self.host, port=self.port)
+                async for line in reader:
+                    message = json.loads(line)
+                    self.counters["received"] += 1
+                    await self._on_event(message["event"], message["payload"])
+            except (OSError, ValueError) as exc:
+                main_logger.warning("Event broker connection failed", host=self.host, port=self.port, error=str(exc))
+            self._writer = None
+            await asyncio.sleep(1)
+
+
+class EventBus:
+    """Delivers events that plugins publish to the handlers that subscribed to them"""
+
+    def __init__(self):
+        self._subscriptions: Dict[str, List[Subscription]] = {}
+        self._transport: Optional[BrokerTransport] = None
+        self.counters: Counter = Counter()
+
+    def subscribe(self, event: str, handler: Callable[..., Awaitable[None]], **options: Any) -> Subscription:
+        """Subscribe `handler` to `event`, see ``Subscription`` for the options"""
+        subscription = Subscription(handler, **options)
+        self._subscriptions.setdefault(event, []).append(subscription)
+        return subscription
+
+    def connect(self, address: str):
+        """Exchange events with the broker at `address` (host:port). Connecting more than once is a no-op."""
+        if self._transport is not None:
+            return
+        host, _, port = address.rpartition(":")
+        self._transport = BrokerTransport(host or "127.0.0.1", int(port), self._deliver)
+
+    async def publish(self, event: str, payload: Payload):
+        """Publish an event, to be handled by one replica. With a broker, payloads should be JSON serializable."""
+        if self._transport is not None and await self._transport.send(event, payload):
+            return
+        await self._deliver(event, payload)
+
+    async def _deliver(self, event: str, payload: Payload):
+        subscriptions = self._subscriptions.get(event, [])
+        if not subscriptions:
+            self.counters["unhandled"] += 1
+            main_logger.warning("Event has no subscribers, so it's not handled", event_name=event)
+            return
+        for subscription in subscriptions:
+            await subscription.put(payload)
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {
+            event: [subscription.stats() for subscription in subscriptions]
+            for event, subscriptions in self._subscriptions.items()
+        }
+        if self._transport is not None:
+            stats["broker"] = dict(self._transport.counters)
+        if self.counters:
+            stats["unhandled"] = self.counters["unhandled"]
+        return stats
+
+
+def subscribe(event: str, **options: Any):
+    """Subscribe a plugin method to an event on the event bus
+
+    The options are passed on to ``Subscription``. The method is subscribed when the plugin is loaded, see
+    ``KitchensinkPlugin``.
+    """
+
+    def subscribe_decorator(fn):
+        fn.__kitchensink_subscriptions__ = [*getattr(fn, "__kitchensink_subscriptions__", []), (event, options)]
+        return fn
+
+    return subscribe_decorator
+
+
+async def serve_broker(host: str = "127.0.0.1", port: int = 7777, by_event: bool = False) -> asyncio.AbstractServer:
+    """Local stand-in for a message broker, that sends every line it receives to one client, in turn
+
+    :param by_event: send all lines of an event to the same client instead, by a hash of the event name, so handlers
+        that batch events get all of them
+    """
+    clients: List[asyncio.StreamWriter] = []
+    turn = itertools.count()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        clients.append(writer)
+        try:
+            async for line in reader:
+                first = zlib.crc32(json.loads(line)["event"].encode()) if by_event else next(turn)
+                # the sender is connected, so there's always a client to take the line
+                for offset in range(len(clients)):
+                    client = clients[(first + offset) % len(clients)]
+                    try:
+                        client.write(line)
+                        await client.drain()
+                        break
+                    except OSError:
+                        continue
+        except (OSError, ValueError):
+            pass
+        finally:
+            clients.remove(writer)
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def _run_broker(host: str, port: int, by_event: bool):
+    server = await serve_broker(host, port, by_event)
+    main_logger.info("Event broker listening", host=host, port=port, by_event=by_event)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local event broker for the kitchensink plugins")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument(
+        "--by-event", action="store_true", help="send all events with the same name to the same replica"
+    )
+    args = parser.parse_args()
+    asyncio.run(_run_broker(args.host, args.port, args.by_event))
+
+
+event_bus = EventBus()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import functools
+import time
+import uuid
+from collections import Counter
+from typing import Any, Callable, Dict, Optional
+
+from structlog.stdlib import get_logger
+
+from sm_kitchensink_plugin.caching import LRUCache
+from sm_kitchensink_plugin.leases import leases
+
+main_logger = get_logger(__name__)
+
+KEY_PREFIX = "kitchensink:idempotency"
+
+
+class IdempotencyGuard:
+    """Makes sure every event is handled only once across all replicas that share a storage backend
+
+    The first replica to claim the key of an event gets to handle it. A claim is a lease on the key that nobody
+    renews, taken atomically, see ``sm_kitchensink_plugin.leases``. Keys that were seen recently are remembered in a
+    local LRU cache, so retries and duplicates of hot events are suppressed without a round trip to storage.
+    """
+
+    def __init__(self, ttl: float = 3600, local_size: int = 10000):
+        self.ttl = ttl
+        self._installed = False
+        self._seen = LRUCache(maxsize=local_size)
+        self._counters: Counter = Counter()
+
+    def install(self, ttl: Optional[float] = None):
+        """Start claiming events across replicas. Installing more than once is a no-op."""
+        if self._installed:
+            return
+        self._installed = True
+        if ttl is not None:
+            self.ttl = ttl
+
+    async def claim(self, key: str) -> bool:
+        """Claim `key`, returns whether it wasn't claimed before and the event should be handled"""
+        expires_at = self._seen.get(key)
+        if expires_at is not None and expires_at > time.monotonic():
+            self._counters["suppressed_local"] += 1
+            return False
+        self._seen.set(key, time.monotonic() + self.ttl)
+        if not self._installed:
+            self._counters["claimed"] += 1
+            return True
+        try:
+            # every claim has a holder of its own, so claiming a key again never renews it
+            claimed = await leases.acquire(f"{KEY_PREFIX}:{key}", uuid.uuid4().hex, self.ttl)
+        except Exception:
+            # when storage is unavailable, handling an event twice is better than not handling it at all
+            main_logger.exception("Claiming event failed", key=key)
+            self._counters["errors"] += 1
+            return True
+        self._counters["claimed" if claimed else "suppressed_storage"] += 1
+        return claimed
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self._counters)
+
+
+def idempotent(key: Callable[..., Any]):
+    """Only handle an event once across replicas
+
+    `key` is called with the arguments of the handler, except `self`, and should return what identifies the event,
+    e.g. the channel and timestamp of a message. Keys are namespaced by handler, so different handlers of the same
+    event don't suppress each other. Apply below the decorators that register the handler.
+    """
+
+    def idempotent_decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(self, *args, **kwargs):
+            if not await idempotency.claim(f"{type(self).__name__}.{fn.__name__}:{key(*args)}"):
+                main_logger.debug("Suppressed duplicate event", handler=fn.__name__)
+                return
+            return await fn(self, *args, **kwargs)
+
+        return wrapper
+
+    return idempotent_decorator
+
+
+idempotency = IdempotencyGuard()
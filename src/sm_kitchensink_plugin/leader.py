@@ -0,0 +1,114 @@
+import asyncio
+import functools
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Optional, Set
+
+from apscheduler.triggers.cron import CronTrigger
+from structlog.stdlib import get_logger
+
+from sm_kitchensink_plugin.leases import leases
+
+main_logger = get_logger(__name__)
+
+LEASE_KEY = "kitchensink:leader"
+
+
+class LeaderElection:
+    """Elects one of the bot replicas that share a storage backend as the leader
+
+    Every replica tries to acquire a lease every `ttl / 3` seconds, and the leader renews it just as often.
+    When the leader goes away its lease expires, so another replica takes over within `ttl` plus one renewal
+    interval. A replica only considers itself the leader until `ttl` seconds after its last successful renewal
+    started, so it steps down before another replica can take over. The lease is taken atomically, see
+    ``sm_kitchensink_plugin.leases``.
+    """
+
+    def __init__(self, ttl: float = 15.0):
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._held_until = 0.0
+        self._was_leader = False
+        self._callbacks: List[Callable[[], Awaitable[None]]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._callback_tasks: Set[asyncio.Task] = set()
+
+    def install(self, ttl: Optional[float] = None):
+        """Start competing for the lease. Installing more than once is a no-op."""
+        if self._task is not None:
+            return
+        if ttl is not None:
+            self.ttl = ttl
+        self._task = asyncio.create_task(self._run())
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._held_until
+
+    def on_elected(self, callback: Callable[[], Awaitable[None]]):
+        """Call `callback` every time this replica becomes the leader, and right away if it is the leader already"""
+        self._callbacks.append(callback)
+        if self._was_leader:
+            self._call(callback)
+
+    def _call(self, callback: Callable[[], Awaitable[None]]):
+        task = asyncio.create_task(callback())
+        self._callback_tasks.add(task)
+        task.add_done_callback(self._callback_tasks.discard)
+
+    async def _run(self):
+        while True:
+            await self.try_acquire()
+            await asyncio.sleep(self.ttl / 3)
+
+    async def try_acquire(self) -> bool:
+        started = time.monotonic()
+        try:
+            acquired = await leases.acquire(LEASE_KEY, self.owner, self.ttl)
+        except Exception:
+            main_logger.exception("Acquiring the leader lease failed")
+            acquired = False
+        if acquired:
+            self._held_until = started + self.ttl
+        if self.is_leader and not self._was_leader:
+            main_logger.info("Elected as leader", owner=self.owner)
+            for callback in self._callbacks:
+                self._call(callback)
+        elif self._was_leader and not self.is_leader:
+            main_logger.info("Lost leadership", owner=self.owner)
+        self._was_leader = self.is_leader
+        return acquired
+
+
+def leader_only(fn):
+    """Only run a scheduled plugin method on the leader
+
+    Apply below ``@schedule``. Every run is recorded in plugin storage, so a replica that becomes the leader can catch
+    up on a tick that was missed during the failover, see ``KitchensinkPlugin.catch_up_scheduled_jobs``.
+    """
+
+    @functools.wraps(fn)
+    async def wrapper(self, *args, **kwargs):
+        if not leader.is_leader:
+            main_logger.debug("Not the leader, skipping scheduled job", job=fn.__name__)
+            return
+        started = datetime.now(timezone.utc)
+        await fn(self, *args, **kwargs)
+        await self.storage.set(f"leader-job:{fn.__name__}", started)
+
+    wrapper.__kitchensink_leader_only__ = fn.__name__
+    return wrapper
+
+
+def missed_tick(schedule: dict, last_run: datetime, tz: str) -> bool:
+    """Whether a job with cron `schedule` should have run since `last_run`"""
+    fields = {key: value for key, value in schedule.items() if value is not None}
+    trigger = CronTrigger(**{**fields, "timezone": fields.get("timezone", tz)})
+    next_run = trigger.get_next_fire_time(None, last_run + timedelta(microseconds=1))
+    return next_run is not None and next_run <= datetime.now(timezone.utc)
+
+
+leader = LeaderElection()
@@ -0,0 +1,149 @@
+"""Leases that bot replicas take atomically, for leader election, handling events only once and locking shared state
+
+A lease is a key that is held by one holder for a while. It can only be taken when nobody holds it, or renewed by
+the holder that has it. Slack Machine's storage backends can't take a key only if it's free, so the leases don't go
+through them, but through a primitive that is atomic for all replicas that share the storage:
+
+- with the Redis storage backend, a script on Redis, on a connection made from Slack Machine's Redis settings
+- with the memory storage backend, within the process, which is the only one that can see the storage anyway
+- in sharded mode, the dispatcher takes the leases of all shards, see ``sm_kitchensink_plugin.sharding``
+
+With other backends, the leases are taken within the process, which is only atomic with a single replica of the bot,
+so a warning is logged. Replicas that share such a backend could both take the same lease, and both become the leader
+or handle the same event, so with ``KITCHENSINK_MULTI_REPLICA`` set the bot refuses to start with them.
+"""
+import asyncio
+import contextlib
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, Mapping, Tuple
+
+from structlog.stdlib import get_logger
+
+main_logger = get_logger(__name__)
+
+MEMORY_STORAGE = "machine.storage.backends.memory.MemoryStorage"
+REDIS_STORAGE = "machine.storage.backends.redis.RedisStorage"
+
+# takes the lease if nobody holds it and renews it if the holder has it, atomically
+_REDIS_ACQUIRE = """
+local current = redis.call('get', KEYS[1])
+if not current then
+    redis.call('set', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+if current == ARGV[1] then
+    redis.call('pexpire', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# gives the lease up if the holder has it, atomically
+_REDIS_RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LocalLeases:
+    """Leases within the process, atomic because taking one doesn't await anything"""
+
+    def __init__(self):
+        self._leases: Dict[str, Tuple[str, float]] = {}
+        self._purge_at = 1000
+
+    async def acquire(self, key: str, holder: str, ttl: float) -> bool:
+        now = time.monotonic()
+        current = self._leases.get(key)
+        if current is not None and current[0] != holder and current[1] > now:
+            return False
+        self._leases[key] = (holder, now + ttl)
+        if len(self._leases) >= self._purge_at:
+            self._leases = {key: lease for key, lease in self._leases.items() if lease[1] > now}
+            self._purge_at = max(1000, 2 * len(self._leases))
+        return True
+
+    async def release(self, key: str, holder: str):
+        current = self._leases.get(key)
+        if current is not None and current[0] == holder:
+            del self._leases[key]
+
+
+class RedisLeases:
+    """Leases in Redis, on a connection of their own with the settings of Slack Machine's Redis storage backend"""
+
+    def __init__(self, settings: Mapping[str, Any]):
+        # redis is an optional dependency of Slack Machine, only needed with the Redis storage backend
+        from machine.utils.redis import gen_config_dict
+        from redis.asyncio import Redis
+
+        self._redis = Redis(**gen_config_dict(settings))
+        self._key_prefix = settings.get("REDIS_KEY_PREFIX", "SM")
+
+    async def acquire(self, key: str, holder: str, ttl: float) -> bool:
+        return bool(await self._redis.eval(_REDIS_ACQUIRE, 1, f"{self._key_prefix}:{key}", holder, int(ttl * 1000)))
+
+    async def release(self, key: str, holder: str):
+        await self._redis.eval(_REDIS_RELEASE, 1, f"{self._key_prefix}:{key}", holder)
+
+
+class Leases:
+    """Takes leases with the primitive that fits the storage backend, see the module docstring"""
+
+    def __init__(self):
+        # anything with an acquire() and release() like LocalLeases
+        self._leases: Any = None
+
+    def install(self, settings: Mapping[str, Any], local: Any = None):
+        """Pick the primitive for the storage backend in `settings`. Installing more than once is a no-op.
+
+        :param local: leases to use instead of the ones within the process, e.g. the leases of a shard
+        """
+        if self._leases is not None:
+            return
+        backend = settings.get("STORAGE_BACKEND", MEMORY_STORAGE)
+        if backend == REDIS_STORAGE:
+            self._leases = RedisLeases(settings)
+            return
+        if backend != MEMORY_STORAGE:
+            if str(settings.get("KITCHENSINK_MULTI_REPLICA", "false")).lower() == "true":
+                raise ValueError(
+                    f"Replicas of the bot that share {backend} could take the same lease, and both become the leader "
+                    "or handle the same event. Use Redis to run multiple replicas."
+                )
+            main_logger.warning(
+                "Taking leases within the process, only run a single replica of the bot with this storage backend",
+                backend=backend,
+            )
+        self._leases = local if local is not None else LocalLeases()
+
+    async def acquire(self, key: str, holder: str, ttl: float) -> bool:
+        """Take the lease `key` for `ttl` seconds if nobody holds it, or renew it if `holder` has it
+
+        :return: whether `holder` has the lease now
+        """
+        return await self._leases.acquire(key, holder, ttl)
+
+    async def release(self, key: str, holder: str):
+        """Give up the lease `key` if `holder` has it"""
+        await self._leases.release(key, holder)
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key: str, ttl: float = 10.0, poll: float = 0.05) -> AsyncIterator[None]:
+        """Hold the lease `key` while the block runs, after waiting until nobody holds it
+
+        The lease expires after `ttl` seconds, so a replica that goes away while holding it doesn't block the others.
+        """
+        holder = uuid.uuid4().hex
+        while not await self.acquire(key, holder, ttl):
+            await asyncio.sleep(poll)
+        try:
+            yield
+        finally:
+            await self.release(key, holder)
+
+
+leases = Leases()
@@ -1,78 +1,251 @@
-from datetime import datetime, timedelta
+import asyncio
+import time
+from collections import Counter
+from typing import List, Optional
 
-from machine.plugins.base import MachineBasePlugin
+from machine.models import User
 from machine.plugins.decorators import (
     process,
-    listen_to,
-    on,
     require_any_role,
     schedule
 )
 from machine.plugins.message import Message
+from slack_sdk.errors import SlackApiError
 from structlog.stdlib import get_logger
 
+from sm_kitchensink_plugin.api_scheduler import TokenBucket, scheduler
+from sm_kitchensink_plugin.base import KitchensinkPlugin
+from sm_kitchensink_plugin.caching import LRUCache, WriteThroughCache
+from sm_kitchensink_plugin.channel_index import channel_index
+from sm_kitchensink_plugin.channel_writer import channel_writer
+from sm_kitchensink_plugin.command_executor import command_executor
+from sm_kitchensink_plugin.dispatch import listen_to
+from sm_kitchensink_plugin.dm_channels import dm_channels
+from sm_kitchensink_plugin.event_bus import event_bus, subscribe
+from sm_kitchensink_plugin.idempotency import idempotency, idempotent
+from sm_kitchensink_plugin.leader import leader_only
+from sm_kitchensink_plugin.log_pipeline import log_pipeline
+from sm_kitchensink_plugin.profiling import memory_tracker, profiler
+from sm_kitchensink_plugin.scheduled_replies import ScheduledReplies
+
 main_logger = get_logger(__name__)
 
+# how long `profile start` profiles when no duration is given, and at most
+PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 600
+
 
-class ListeningAdvanced(MachineBasePlugin):
+class ListeningAdvanced(KitchensinkPlugin):
     """Listening Advanced (events, scheduled messages, etc.)"""
 
+    async def init(self):
+        await super().init()
+        # Reactions are mirrored by a background worker that works through a bounded queue, so popular messages
+        # can't flood the Slack API. When reactions come in faster than `KITCHENSINK_REACTION_RATE` per second,
+        # they're either delayed or dropped, depending on `KITCHENSINK_REACTION_POLICY`.
+        self.reaction_queue = asyncio.Queue(maxsize=int(self.settings.get("KITCHENSINK_REACTION_QUEUE_SIZE", 1000)))
+        rate = float(self.settings.get("KITCHENSINK_REACTION_RATE", 1.0))
+        self.reaction_bucket = TokenBucket(rate=rate, capacity=max(rate, 1))
+        self.reaction_policy = self.settings.get("KITCHENSINK_REACTION_POLICY", "delay").lower()
+        self.mirrored_reactions = LRUCache(maxsize=10000)
+        self.reaction_counters = Counter()
+        self._reaction_worker = asyncio.create_task(self.mirror_reactions())
+        # the message the bot pinned last, per channel
+        self.pinned_items = WriteThroughCache(self.storage, "pinned-item")
+        # Replies that are due within `KITCHENSINK_LOCAL_SCHEDULE_HORIZON` seconds are sent by the bot itself, later
+        # ones are scheduled through Slack
+        self.scheduled_replies = ScheduledReplies(
+            self.storage, self._client, horizon=float(self.settings.get("KITCHENSINK_LOCAL_SCHEDULE_HORIZON", 300))
+        )
+        await self.scheduled_replies.start()
+        profiler.interval = float(self.settings.get("KITCHENSINK_PROFILE_INTERVAL", profiler.interval))
+        # set to stop the running profiler before its duration is up
+        self.profile_stopped: Optional[asyncio.Event] = None
+        self._profile_task: Optional[asyncio.Task] = None
+
     @listen_to(r"^do secret stuff")
     @require_any_role(["admin"])
     async def admin(self, msg: Message):
         await msg.say("You're an admin, so you are allowed to do secret things!", ephemeral=True)
 
-    @on("my-plugin-event")
-    async def plugin_event_handle(self, name: str = ""):
-        channel = self.find_channel_by_name("#general")
-        await self.say(channel, f"I've received my-plugin-event from {name}")
+    @listen_to(r"^profile start(?:\s+(?P<seconds>\d+))?$")
+    @require_any_role(["admin"])
+    async def profile_start(self, msg: Message, seconds: Optional[str] = None):
+        """profile start [seconds]: profile the bot for a while, the result is sent to you as a flamegraph file"""
+        if profiler.running:
+            await msg.say("The profiler is running already, stop it with `profile stop`", ephemeral=True)
+            return
+        duration = min(int(seconds or PROFILE_SECONDS), MAX_PROFILE_SECONDS)
+        profiler.start()
+        self.profile_stopped = asyncio.Event()
+        self._profile_task = asyncio.create_task(self.send_profile(msg.sender, duration, self.profile_stopped))
+        await msg.say(f"Profiling for {duration} seconds, I'll send you the result in a DM", ephemeral=True)
+
+    @listen_to(r"^profile stop$")
+    @require_any_role(["admin"])
+    async def profile_stop(self, msg: Message):
+        """profile stop: stop profiling early, the result is sent to the admin that started it"""
+        if not profiler.running or self.profile_stopped is None:
+            await msg.say("The profiler isn't running", ephemeral=True)
+            return
+        self.profile_stopped.set()
+        await msg.say("Stopping the profiler", ephemeral=True)
+
+    async def send_profile(self, user: User, duration: float, stopped: asyncio.Event):
+        try:
+            await asyncio.wait_for(stopped.wait(), duration)
+        except asyncio.TimeoutError:
+            pass
+        # the sampling thread finishes its current sample first
+        await asyncio.to_thread(profiler.stop)
+        try:
+            channel = await self.dm_channel(user)
+            if not profiler.stacks:
+                await self.say(channel, "The profiler didn't take any samples")
+                return
+            started = time.strftime("%Y%m%d-%H%M%S", time.gmtime(profiler.started))
+            await self.web_client.files_upload_v2(
+                channel=channel,
+                content=profiler.folded(),
+                filename=f"profile-{started}.folded",
+                title=f"Profile of {started}",
+                initial_comment=(
+                    f"{profiler.samples} samples over {profiler.stopped - profiler.started:.0f} seconds, every "
+                    f"{profiler.interval * 1000:g}ms. Open it in speedscope, or render it with flamegraph.pl"
+                ),
+            )
+        except Exception:
+            main_logger.exception("Sending profile failed", user=user.id)
+
+    @listen_to(r"^memory snapshot$")
+    @require_any_role(["admin"])
+    async def memory_snapshot(self, msg: Message):
+        """memory snapshot: trace allocations, and get the growth per handler since the previous snapshot in a DM"""
+        # taking and comparing snapshots of a large heap takes a while
+        report = await asyncio.to_thread(memory_tracker.snapshot)
+        if report is None:
+            await msg.say(
+                "Tracing allocations now. Send `memory snapshot` again to see what grew since, and `memory stop` when "
+                "you're done, because tracing slows the bot down",
+                ephemeral=True,
+            )
+            return
+        await self.web_client.files_upload_v2(
+            channel=await self.dm_channel(msg.sender),
+            content=report,
+            filename=f"memory-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}.txt",
+            title="Allocation growth by handler",
+        )
+        await msg.say("I've sent you the allocation growth in a DM", ephemeral=True)
+
+    @listen_to(r"^memory stop$")
+    @require_any_role(["admin"])
+    async def memory_stop(self, msg: Message):
+        """memory stop: stop tracing allocations"""
+        if not memory_tracker.tracing:
+            await msg.say("Allocations aren't being traced", ephemeral=True)
+            return
+        memory_tracker.stop()
+        await msg.say("Stopped tracing allocations", ephemeral=True)
+
+    # Triggers come in bursts, so they're handled in batches from a bounded queue, and dropped when it's full
+    @subscribe("my-plugin-event", queue_size=1000, policy="drop", batch_size=50, batch_window=1.0)
+    async def plugin_event_handle(self, events: List[dict]):
+        senders = Counter(event.get("name", "") for event in events)
+        names = ", ".join(name if count == 1 else f"{name} ({count}x)" for name, count in senders.items())
+        self.notify(f"I've received my-plugin-event from {names}")
 
     @listen_to(r"^trigger my-plugin-event")
+    @idempotent(lambda msg: f"{msg.channel.id}:{msg.ts}")
     async def trigger_plugin_event(self, msg: Message):
         main_logger.info("Triggering my-plugin-event")
-        self.emit("my-plugin-event", name=msg.sender.name)
+        await self.publish_event("my-plugin-event", name=msg.sender.name)
 
     @listen_to(r"^wait$")
     async def wait(self, msg: Message):
         """wait: the bot replies to you using a scheduled message"""
         await msg.reply("wait for it", in_thread=True)
-        dt = datetime.now() + timedelta(seconds=10)
-        await msg.reply_scheduled(dt, "hello after 10 seconds", in_thread=True)
+        await self.scheduled_replies.schedule(
+            msg.sender.id, "hello after 10 seconds", 10, channel=msg.channel.id, thread_ts=msg.ts
+        )
 
     @listen_to(r"^dm reply scheduled$")
     async def dm_scheduled(self, msg: Message):
         """dm reply scheduled: the bot replies to you at a later moment, in a DM"""
         await msg.reply_dm("wait for it")
-        dt = datetime.now() + timedelta(seconds=10)
-        await msg.reply_dm_scheduled(
-            dt, "sure I'll reply to you in a DM after 10 seconds"
-        )
+        await self.scheduled_replies.schedule(msg.sender.id, "sure I'll reply to you in a DM after 10 seconds", 10)
+
+    @listen_to(r"^cancel scheduled$")
+    async def cancel_scheduled(self, msg: Message):
+        """cancel scheduled: cancel the scheduled replies the bot still has to send you"""
+        cancelled = await self.scheduled_replies.cancel(msg.sender.id)
+        await msg.reply(f"Cancelled {cancelled} scheduled replies", in_thread=True)
 
     @schedule(minute="*/10")
+    @leader_only
     async def scheduled_action(self):
-        channel = self.find_channel_by_name("#general")
-        await self.say(channel, "I'm doing this on a schedule (`*/10`)")
+        self.notify("I'm doing this on a schedule (`*/10`)")
 
     @listen_to(r".*pin.*")
+    @idempotent(lambda msg: f"{msg.channel.id}:{msg.ts}")
     async def pin_message(self, msg: Message):
         """... pin ...: pin the message"""
         await msg.say("I will pin this message for you!")
-        pinned_item = await self.storage.get("pinned-item")
-        if pinned_item is not None:
-            await self.unpin_message(msg.channel, pinned_item)
-        await msg.pin_message()
-        await self.storage.set("pinned-item", msg.ts)
+        async with self.pinned_items.lock(msg.channel.id):
+            pinned_item = await self.pinned_items.get(msg.channel.id)
+            if pinned_item is not None:
+                await self.unpin_message(msg.channel, pinned_item)
+            await msg.pin_message()
+            self.pinned_items.set(msg.channel.id, msg.ts)
 
     @process("reaction_added")
     async def match_reaction(self, event):
         """If a user reacts to a message, the bot adds the same reaction"""
-        main_logger.info(event)
-        main_logger.info("bot info", bot_info=self.bot_info)
-        if not event["user"] == self.bot_info["user_id"]:
-            emoji = event["reaction"]
-            channel = event["item"]["channel"]
-            ts = event["item"]["ts"]
-            await self.react(channel, ts, emoji)
+        # checked before the event is claimed, so the reactions the bot mirrors itself don't cost a storage write
+        if event["user"] == self.bot_info["user_id"] or event["item"].get("type") != "message":
+            return
+        await self.queue_reaction(event)
+
+    @idempotent(lambda event: f"{event['user']}:{event['reaction']}:{event['event_ts']}")
+    async def queue_reaction(self, event):
+        main_logger.debug("Reaction added", reaction_event=event)
+        key = (event["item"]["channel"], event["item"]["ts"], event["reaction"])
+        # every emoji is mirrored only once per message, no matter how many people use it
+        if key in self.mirrored_reactions:
+            self.reaction_counters["deduplicated"] += 1
+            return
+        try:
+            self.reaction_queue.put_nowait(key)
+        except asyncio.QueueFull:
+            self.reaction_counters["dropped"] += 1
+            return
+        self.mirrored_reactions.set(key, True)
+
+    async def mirror_reactions(self):
+        while True:
+            channel, ts, emoji = await self.reaction_queue.get()
+            try:
+                if self.reaction_policy == "drop":
+                    if not self.reaction_bucket.try_acquire():
+                        self.reaction_counters["dropped"] += 1
+                        self.mirrored_reactions.pop((channel, ts, emoji))
+                        continue
+                else:
+                    await self.reaction_bucket.acquire()
+                await self.react(channel, ts, emoji)
+                self.reaction_counters["mirrored"] += 1
+            except SlackApiError as e:
+                if e.response.get("error") == "already_reacted":
+                    self.reaction_counters["deduplicated"] += 1
+                else:
+                    main_logger.exception("Mirroring reaction failed", channel=channel, ts=ts, emoji=emoji)
+                    # forgotten, so the next time someone uses the emoji it's mirrored after all
+                    self.mirrored_reactions.pop((channel, ts, emoji))
+            except Exception:
+                main_logger.exception("Mirroring reaction failed", channel=channel, ts=ts, emoji=emoji)
+                self.mirrored_reactions.pop((channel, ts, emoji))
+            finally:
+                self.reaction_queue.task_done()
 
     @listen_to(r"show bot info")
     async def info(self, msg: Message):
@@ -80,3 +253,23 @@ class ListeningAdvanced(MachineBasePlugin):
         await msg.say(
             f"Bot info: {self.bot_info}, base url: {self.web_client.base_url}"
         )
+
+    @listen_to(r"^show cache stats$")
+    async def cache_stats(self, msg: Message):
+        """show cache stats: show hit and miss counts of the caches of the kitchensink plugins"""
+        await msg.say(f"Channel index: {channel_index.stats()}")
+
+    @listen_to(r"^show api stats$")
+    async def api_stats(self, msg: Message):
+        """show api stats: show queue depth and rate limiting stats of the Slack API scheduler"""
+        await msg.say(
+            f"API scheduler stats: {scheduler.stats()}\n"
+            f"Reaction mirroring: {dict(self.reaction_counters)}, queued: {self.reaction_queue.qsize()}\n"
+            f"Notifications: {channel_writer.stats()}\n"
+            f"Idempotency: {idempotency.stats()}\n"
+            f"Event bus: {event_bus.stats()}\n"
+            f"Scheduled replies: {self.scheduled_replies.stats()}\n"
+            f"Command executor: {command_executor.stats()}\n"
+            f"Logging: {log_pipeline.stats()}\n"
+            f"DM channels: {dm_channels.stats()}"
+        )
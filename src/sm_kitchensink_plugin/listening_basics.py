@@ -1,18 +1,156 @@
-from machine.plugins.base import MachineBasePlugin
+import json
+from typing import Optional
+
+from machine.models import User
+from machine.plugins.block_action import BlockAction
 from machine.plugins.decorators import (
-    respond_to,
-    listen_to
+    action,
+    process
 )
 from machine.plugins.message import Message
 from slack_sdk.models import blocks
 from structlog.stdlib import get_logger, BoundLogger
 
+from sm_kitchensink_plugin.base import KitchensinkPlugin
+from sm_kitchensink_plugin.dispatch import every_shard, listen_to, respond_to
+from sm_kitchensink_plugin.templates import BlockTemplate
+from sm_kitchensink_plugin.user_directory import Key, UserDirectory
+
 main_logger = get_logger(__name__)
 
 
-class ListeningBasics(MachineBasePlugin):
+def blocks_layout() -> list[blocks.Block]:
+    return [
+        blocks.SectionBlock(
+            text="*Markdown formatted* text with _italics_ if we want",
+            fields=["*Left*", "*Right*", "line 2 left", "line 2 right"],
+            accessory=blocks.ImageElement(
+                image_url="https://placecats.com/700/500", alt_text="cute kitten"
+            ),
+        )
+    ]
+
+
+def blocks_raw_layout() -> list[dict]:
+    return [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "Hello, Assistant to the Regional Manager Dwight! *Michael Scott* wants to know where you'd like to take the Paper Company investors to dinner tonight.\n\n *Please select a restaurant:*",
+            },
+        },
+        {"type": "divider"},
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "*Kin Khao*\n:star::star::star::star: 1638 reviews\n The sticky rice also goes wonderfully with the caramelized pork belly, which is absolutely melt-in-your-mouth and so soft.",
+            },
+            "accessory": {
+                "type": "image",
+                "image_url": "https://s3-media2.fl.yelpcdn.com/bphoto/korel-1YjNtFtJlMTaC26A/o.jpg",
+                "alt_text": "alt text for image",
+            },
+            "fields": [
+                {"type": "mrkdwn", "text": "*Priority*"},
+                {"type": "mrkdwn", "text": "*Type*"},
+                {"type": "plain_text", "text": "High"},
+                {"type": "mrkdwn", "text": "String"},
+            ],
+        },
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "*Farmhouse Thai Cuisine*\n:star::star::star::star: 1528 reviews\n They do have some vegan options, like the roti and curry, plus they have a ton of salad stuff and noodles can be ordered without meat!! They have something for everyone here",
+            },
+            "accessory": {
+                "type": "image",
+                "image_url": "https://s3-media3.fl.yelpcdn.com/bphoto/c7ed05m9lC2EmA3Aruue7A/o.jpg",
+                "alt_text": "alt text for image",
+            },
+        },
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "*Ler Ros*\n:star::star::star::star: 2082 reviews\n I would really recommend the  Yum Koh Moo Yang - Spicy lime dressing and roasted quick marinated pork shoulder, basil leaves, chili & rice powder.",
+            },
+            "accessory": {
+                "type": "image",
+                "image_url": "https://s3-media2.fl.yelpcdn.com/bphoto/DawwNigKJ2ckPeDeDM7jAg/o.jpg",
+                "alt_text": "alt text for image",
+            },
+        },
+        {"type": "divider"},
+        {
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Farmhouse",
+                        "emoji": True,
+                    },
+                    "value": "click_me_123",
+                },
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Kin Khao",
+                        "emoji": True,
+                    },
+                    "value": "click_me_123",
+                },
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Ler Ros",
+                        "emoji": True,
+                    },
+                    "value": "click_me_123",
+                },
+            ],
+        },
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "You can add an image next to text in this block.",
+            },
+            "accessory": {
+                "type": "image",
+                "image_url": "https://api.slack.com/img/blocks/bkb_template_images/plants.png",
+                "alt_text": "plants",
+            },
+        },
+    ]
+
+
+class ListeningBasics(KitchensinkPlugin):
     """Listening Basics"""
 
+    _user_directory: Optional[UserDirectory] = None
+    _blocks_template: Optional[BlockTemplate] = None
+    _blocks_raw_template: Optional[BlockTemplate] = None
+
+    # The templates are built when they're first used rather than at startup, because building the layouts is
+    # relatively expensive. These are methods rather than properties, because Slack Machine evaluates all properties
+    # of a plugin when it registers the plugin's handlers.
+    def _get_blocks_template(self) -> BlockTemplate:
+        if self._blocks_template is None:
+            self._blocks_template = BlockTemplate(blocks_layout())
+        return self._blocks_template
+
+    def _get_blocks_raw_template(self) -> BlockTemplate:
+        if self._blocks_raw_template is None:
+            self._blocks_raw_template = BlockTemplate(blocks_raw_layout())
+        return self._blocks_raw_template
+
     @listen_to(r"^greetings")
     async def greetings(self, msg: Message, logger: BoundLogger):
         """greetings: say hello to the bot"""
@@ -25,11 +163,63 @@ class ListeningBasics(MachineBasePlugin):
         """I love you: express your love to the bot, it might reciprocate"""
         await msg.react("heart")
 
-    @listen_to(r"^list users")
-    async def list_users(self, msg: Message):
-        """users: list all users in the Slack Workspace"""
-        users = [u.name for u in self.users.values()]
-        await msg.say(f"{len(users)} Users: {', '.join(users)}")
+    def _get_user_directory(self) -> UserDirectory:
+        # built on first use, like the templates
+        if self._user_directory is None:
+            self._user_directory = UserDirectory(self.users.values())
+        return self._user_directory
+
+    @process("team_join")
+    @process("user_change")
+    @every_shard
+    async def update_user_directory(self, event):
+        if self._user_directory is not None:
+            self._user_directory.upsert(User.model_validate(event["user"]))
+
+    def user_list_page(self, prefix: str, after: Optional[Key] = None) -> list[dict]:
+        directory = self._get_user_directory()
+        names, next_cursor = directory.page(prefix, after)
+        matching = f" starting with '{prefix}'" if prefix else ""
+        bx = [
+            {
+                "type": "section",
+                "text": {"type": "mrkdwn", "text": f"*{directory.count(prefix)} Users{matching}*"},
+            },
+            {"type": "section", "text": {"type": "plain_text", "text": ", ".join(names) or "-"}},
+        ]
+        if next_cursor is not None:
+            bx.append({
+                "type": "actions",
+                "elements": [{
+                    "type": "button",
+                    "action_id": "list_users_next",
+                    "text": {"type": "plain_text", "text": "Next page"},
+                    "value": json.dumps([prefix, *next_cursor]),
+                }],
+            })
+        return bx
+
+    @listen_to(r"^list users(?:\s+(?P<prefix>\S+))?")
+    async def list_users(self, msg: Message, prefix: Optional[str] = None):
+        """list users [prefix]: list the users in the Slack Workspace, optionally filtered by name prefix"""
+        await msg.say("Users", blocks=self.user_list_page(prefix or ""))
+
+    @action(action_id="list_users_next")
+    async def list_users_next_page(self, action: BlockAction):
+        prefix, *after = json.loads(action.triggered_action.value)
+        await action.say("Users", blocks=self.user_list_page(prefix, tuple(after)), ephemeral=False, replace_original=True)
+
+    @listen_to(r"^list all users$")
+    async def list_all_users(self, msg: Message):
+        """list all users: upload the names of all users in the Slack Workspace as a file"""
+        directory = self._get_user_directory()
+        content = "\n".join(name for _, name in directory.iter_names())
+        await self.web_client.files_upload_v2(
+            channel=msg.channel.id,
+            content=content,
+            filename="users.txt",
+            title=f"{len(directory)} Users",
+        )
 
     @listen_to(r"^reply$")
     async def reply_me(self, msg: Message):
@@ -59,115 +249,9 @@ class ListeningBasics(MachineBasePlugin):
     @listen_to(r"^show blocks$")
     async def blocks(self, msg: Message):
         """show blocks: show some rich messaging magic using Python block models"""
-        bx = [
-            blocks.SectionBlock(
-                text="*Markdown formatted* text with _italics_ if we want",
-                fields=["*Left*", "*Right*", "line 2 left", "line 2 right"],
-                accessory=blocks.ImageElement(
-                    image_url="https://placecats.com/700/500", alt_text="cute kitten"
-                ),
-            )
-        ]
-        await msg.say("fallback", blocks=bx)
+        await msg.say("fallback", blocks=self._get_blocks_template().render())
 
     @listen_to(r"^show blocks raw$")
     async def blocks_raw(self, msg: Message):
         """show blocks raw: show some rich messaging magic. Uses raw dict for specifying blocks"""
-        bx = [
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "Hello, Assistant to the Regional Manager Dwight! *Michael Scott* wants to know where you'd like to take the Paper Company investors to dinner tonight.\n\n *Please select a restaurant:*",
-                },
-            },
-            {"type": "divider"},
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "*Kin Khao*\n:star::star::star::star: 1638 reviews\n The sticky rice also goes wonderfully with the caramelized pork belly, which is absolutely melt-in-your-mouth and so soft.",
-                },
-                "accessory": {
-                    "type": "image",
-                    "image_url": "https://s3-media2.fl.yelpcdn.com/bphoto/korel-1YjNtFtJlMTaC26A/o.jpg",
-                    "alt_text": "alt text for image",
-                },
-                "fields": [
-                    {"type": "mrkdwn", "text": "*Priority*"},
-                    {"type": "mrkdwn", "text": "*Type*"},
-                    {"type": "plain_text", "text": "High"},
-                    {"type": "mrkdwn", "text": "String"},
-                ],
-            },
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "*Farmhouse Thai Cuisine*\n:star::star::star::star: 1528 reviews\n They do have some vegan options, like the roti and curry, plus they have a ton of salad stuff and noodles can be ordered without meat!! They have something for everyone here",
-                },
-                "accessory": {
-                    "type": "image",
-                    "image_url": "https://s3-media3.fl.yelpcdn.com/bphoto/c7ed05m9lC2EmA3Aruue7A/o.jpg",
-                    "alt_text": "alt text for image",
-                },
-            },
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "*Ler Ros*\n:star::star::star::star: 2082 reviews\n I would really recommend the  Yum Koh Moo Yang - Spicy lime dressing and roasted quick marinated pork shoulder, basil leaves, chili & rice powder.",
-                },
-                "accessory": {
-                    "type": "image",
-                    "image_url": "https://s3-media2.fl.yelpcdn.com/bphoto/DawwNigKJ2ckPeDeDM7jAg/o.jpg",
-                    "alt_text": "alt text for image",
-                },
-            },
-            {"type": "divider"},
-            {
-                "type": "actions",
-                "elements": [
-                    {
-                        "type": "button",
-                        "text": {
-                            "type": "plain_text",
-                            "text": "Farmhouse",
-                            "emoji": True,
-                        },
-                        "value": "click_me_123",
-                    },
-                    {
-                        "type": "button",
-                        "text": {
-                            "type": "plain_text",
-                            "text": "Kin Khao",
-                            "emoji": True,
-                        },
-                        "value": "click_me_123",
-                    },
-                    {
-                        "type": "button",
-                        "text": {
-                            "type": "plain_text",
-                            "text": "Ler Ros",
-                            "emoji": True,
-                        },
-                        "value": "click_me_123",
-                    },
-                ],
-            },
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "You can add an image next to text in this block.",
-                },
-                "accessory": {
-                    "type": "image",
-                    "image_url": "https://api.slack.com/img/blocks/bkb_template_images/plants.png",
-                    "alt_text": "plants",
-                },
-            },
-        ]
-        await msg.say("fallback", blocks=bx)
+        await msg.say("fallback", blocks=self._get_blocks_raw_template().render())
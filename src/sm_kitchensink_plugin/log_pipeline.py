@@ -0,0 +1,235 @@
+"""Non-blocking, sampled logging
+
+Slack Machine renders and writes every log record on the thread that logs it, and runs all structlog processors,
+including the one that looks up the call site, even for records below the log level. On hot handlers that means the
+event loop waits on formatting and writing logs. Once installed, this pipeline:
+
+- drops records below the log level before any processor runs
+- samples records per event, e.g. only 1 in 100 ``Reaction added`` records is logged, and caps the number of records
+  per event per second. Emitted records carry ``sample_rate`` or ``suppressed`` so the counts can be reconstructed
+- hands records to a background thread through a bounded queue, and drops them when the queue is full rather than
+  waiting. The values in a record, like event payloads, are only rendered on that thread, and only for records that
+  are emitted, so they shouldn't be changed after they're logged
+- moves the processors that don't need the calling thread to that thread as well: formatting positional arguments and
+  exceptions, and the timestamp, which is taken from the time the record was logged. What's left on the calling
+  thread for an emitted record is cheap, except for looking up the call site, which walks a few stack frames
+
+Sampling rates and rate caps are configured per event with ``KITCHENSINK_LOG_SAMPLING`` and
+``KITCHENSINK_LOG_RATE_LIMITS``, as a dict or a JSON object, on top of the defaults for the hot handlers.
+"""
+import atexit
+import datetime
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional
+
+import structlog
+from machine.utils.collections import CaseInsensitiveDict
+from structlog.processors import ExceptionRenderer, TimeStamper, UnicodeDecoder
+from structlog.stdlib import PositionalArgumentsFormatter, ProcessorFormatter, filter_by_level
+
+# 1 in N records of these events is logged
+DEFAULT_SAMPLING = {
+    "Reaction added": 100,
+}
+# at most N records of these events are logged per second
+DEFAULT_RATE_LIMITS = {
+    "Interaction triggered": 10,
+    "Action triggered": 10,
+    "Modal submission": 10,
+    "Modal closed": 10,
+}
+
+
+class Sampler:
+    """structlog processor that samples and rate limits records per event"""
+
+    def __init__(self, sampling: Dict[str, int], rate_limits: Dict[str, int]):
+        self.sampling = sampling
+        self.rate_limits = rate_limits
+        self._seen: Counter = Counter()
+        self._windows: Dict[str, List[float]] = {}
+        self._suppressed: Counter = Counter()
+        self.counters: Counter = Counter()
+
+    def __call__(self, logger: Any, method_name: str, event_dict: Dict[str, Any]) -> Dict[str, Any]:
+        event = event_dict.get("event")
+        if not isinstance(event, str):
+            return event_dict
+        rate = self.sampling.get(event)
+        if rate is not None and rate > 1:
+            seen = self._seen[event]
+            self._seen[event] = seen + 1
+            if seen % rate:
+                self.counters["sampled_out"] += 1
+                raise structlog.DropEvent
+            event_dict["sample_rate"] = rate
+        limit = self.rate_limits.get(event)
+        if limit is not None:
+            now = time.monotonic()
+            window = self._windows.setdefault(event, [now, 0.0])
+            if now - window[0] >= 1.0:
+                window[0], window[1] = now, 0.0
+            if window[1] >= limit:
+                self._suppressed[event] += 1
+                self.counters["rate_limited"] += 1
+                raise structlog.DropEvent
+            window[1] += 1.0
+            suppressed = self._suppressed.pop(event, 0)
+            if suppressed:
+                event_dict["suppressed"] = suppressed
+        return event_dict
+
+
+def capture_exc_info(logger: Any, method_name: str, event_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """Resolve ``exc_info=True`` to the exception that's being handled, which only the calling thread knows"""
+    if event_dict.get("exc_info") is True:
+        event_dict["exc_info"] = sys.exc_info()
+    return event_dict
+
+
+class RecordTimeStamper:
+    """Like structlog's ``TimeStamper``, but with the time the record was logged rather than the current time"""
+
+    def __init__(self, stamper: TimeStamper):
+        self.fmt, self.utc, self.key = stamper.fmt, stamper.utc, stamper.key
+
+    def __call__(self, logger: Any, method_name: str, event_dict: Dict[str, Any]) -> Dict[str, Any]:
+        created = event_dict["_record"].created
+        if self.fmt is None:
+            event_dict[self.key] = created
+            return event_dict
+        logged = datetime.datetime.fromtimestamp(created, tz=datetime.timezone.utc if self.utc else None)
+        if self.fmt.upper() == "ISO":
+            stamp = logged.isoformat()
+            event_dict[self.key] = stamp.replace("+00:00", "Z") if self.utc else stamp
+        else:
+            event_dict[self.key] = logged.strftime(self.fmt)
+        return event_dict
+
+
+class Deferred:
+    """Runs processors on the writer thread, for the records that were logged through structlog
+
+    Other records already went through them, as part of the formatter's pre-chain.
+    """
+
+    def __init__(self, processors: List[Any]):
+        self.processors = processors
+
+    def __call__(self, logger: Any, method_name: str, event_dict: Dict[str, Any]) -> Dict[str, Any]:
+        if event_dict.get("_from_structlog"):
+            for processor in self.processors:
+                event_dict = processor(logger, method_name, event_dict)
+        return event_dict
+
+
+def _deferrable(processor: Any) -> bool:
+    return isinstance(processor, (PositionalArgumentsFormatter, TimeStamper, ExceptionRenderer, UnicodeDecoder))
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Puts records on a bounded queue as they are, dropping them when the queue is full"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the standard QueueHandler formats the record right away, it's formatted by the writer thread instead
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # the queue can be full, and the writer thread empties it, so waiting for room is fine
+        self.queue.put(self._sentinel)
+
+
+def _mapping(value: Any) -> Dict[str, int]:
+    if not value:
+        return {}
+    if isinstance(value, str):
+        value = json.loads(value)
+    return {str(event): int(n) for event, n in value.items()}
+
+
+class LogPipeline:
+    """Moves log formatting and I/O off the calling thread, see the module docstring"""
+
+    def __init__(self, queue_size: int = 10000):
+        self.queue_size = queue_size
+        self.sampler: Optional[Sampler] = None
+        self._handler: Optional[NonBlockingQueueHandler] = None
+        self._listener: Optional[QueueListener] = None
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def install(self, settings: CaseInsensitiveDict):
+        """Put the pipeline in front of the handlers Slack Machine configured. Installing more than once is a no-op."""
+        with self._lock:
+            # without Slack Machine's logging configuration, records don't go through the standard library
+            if self._listener is not None or not isinstance(
+                structlog.get_config()["logger_factory"], structlog.stdlib.LoggerFactory
+            ):
+                return
+            self.queue_size = int(settings.get("KITCHENSINK_LOG_QUEUE_SIZE", self.queue_size))
+            self.sampler = Sampler(
+                {**DEFAULT_SAMPLING, **_mapping(settings.get("KITCHENSINK_LOG_SAMPLING"))},
+                {**DEFAULT_RATE_LIMITS, **_mapping(settings.get("KITCHENSINK_LOG_RATE_LIMITS"))},
+            )
+            root = logging.getLogger()
+            handlers = list(root.handlers)
+            # loggers that were used already hold on to the list of processors, so it's changed in place
+            processors = structlog.get_config()["processors"]
+            formatters = [handler.formatter for handler in handlers]
+            if (
+                formatters
+                and all(isinstance(formatter, ProcessorFormatter) for formatter in formatters)
+                and processors[-1] is ProcessorFormatter.wrap_for_formatter
+            ):
+                deferred = Deferred(
+                    [
+                        RecordTimeStamper(processor) if isinstance(processor, TimeStamper) else processor
+                        for processor in processors[:-1]
+                        if _deferrable(processor)
+                    ]
+                )
+                processors[:-1] = [capture_exc_info, *(p for p in processors[:-1] if not _deferrable(p))]
+                for formatter in formatters:
+                    formatter.processors = [deferred, *formatter.processors]
+            processors[0:0] = [filter_by_level, self.sampler]
+            self._handler = NonBlockingQueueHandler(queue.Queue(maxsize=self.queue_size))
+            for handler in handlers:
+                root.removeHandler(handler)
+            root.addHandler(self._handler)
+            self._listener = _Listener(self._handler.queue, *handlers, respect_handler_level=True)
+            self._listener.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Write the records that are still queued and stop the writer thread"""
+        with self._lock:
+            if self._listener is not None and not self._stopped:
+                self._stopped = True
+                self._listener.stop()
+
+    def stats(self) -> Dict[str, int]:
+        if self.sampler is None or self._handler is None:
+            return {}
+        return {**self.sampler.counters, "dropped": self._handler.dropped, "queued": self._handler.queue.qsize()}
+
+
+log_pipeline = LogPipeline()
@@ -0,0 +1,376 @@
+"""Instrumentation of the kitchensink plugins
+
+Every handler of a kitchensink plugin (every method with Slack Machine metadata or subscribed to the event bus with
+``@subscribe``, plus ``init``) is wrapped when its class is defined, so no handler has to be changed to be
+measured. Per handler, the following is recorded:
+
+- a latency histogram and the number of invocations that raised an error
+- the number of Slack Web API calls and the bytes sent and received, in total and per invocation
+- the time spent waiting on plugin storage
+- for slash commands, the time until they're acknowledged and the time their work waits for a worker of the command
+  executor, see ``sm_kitchensink_plugin.command_executor``
+
+API calls and storage access are attributed to the handler that is running through a context variable, so work done
+by tasks a handler starts counts towards that handler too. Plugins subscribe their handlers to the event bus as bound
+methods when they're initialized, see ``KitchensinkPlugin.init``, so the wrapped handlers are the ones that get called.
+A handler that takes a batch of events is measured once per batch.
+
+Metrics are exposed in the Prometheus text format when ``KITCHENSINK_METRICS_PORT`` is set, and a summary is logged
+every ``KITCHENSINK_METRICS_LOG_INTERVAL`` seconds.
+"""
+import asyncio
+import functools
+import inspect
+import json
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from machine.storage import PluginStorage
+from machine.utils.collections import CaseInsensitiveDict
+from slack_sdk.web.async_client import AsyncWebClient
+from structlog.stdlib import get_logger
+
+main_logger = get_logger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+API_CALL_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50)
+
+# Name under which work that doesn't happen on behalf of a handler is recorded
+NO_HANDLER = "none"
+
+
+class Histogram:
+    """Histogram with fixed buckets, like Prometheus histograms"""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """Upper bound and cumulative count of each bucket"""
+        result, total = [], 0
+        for bound, count in zip((*self.buckets, float("inf")), self.counts):
+            total += count
+            result.append(("+Inf" if bound == float("inf") else repr(bound), total))
+        return result
+
+
+class Invocation:
+    """What a single handler invocation did"""
+
+    __slots__ = ("handler", "api_calls")
+
+    def __init__(self, handler: str):
+        self.handler = handler
+        self.api_calls = 0
+
+
+_invocation: ContextVar[Optional[Invocation]] = ContextVar("kitchensink_invocation", default=None)
+
+
+def _size(data: Any) -> int:
+    if data is None:
+        return 0
+    if isinstance(data, (bytes, str)):
+        return len(data)
+    return len(json.dumps(data, default=str))
+
+
+def _labels(**labels: str) -> str:
+    return ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+
+def _is_handler(fn: Callable) -> bool:
+    return hasattr(fn, "metadata") or hasattr(fn, "__kitchensink_subscriptions__")
+
+
+class Metrics:
+    """Registry of the metrics of all kitchensink plugins"""
+
+    def __init__(self):
+        self.durations: Dict[str, Histogram] = {}
+        self.api_calls_per_invocation: Dict[str, Histogram] = {}
+        self.errors: Counter = Counter()
+        self.api_calls: Counter = Counter()
+        self.api_bytes: Counter = Counter()
+        self.storage_waits: Dict[Tuple[str, str], Histogram] = {}
+        self.command_acks: Dict[str, Histogram] = {}
+        self.command_queue_waits: Dict[str, Histogram] = {}
+        # the functions that were instrumented, by handler name
+        self.handlers: Dict[str, Callable] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._started = False
+
+    @staticmethod
+    def current_handler() -> str:
+        invocation = _invocation.get()
+        return invocation.handler if invocation is not None else NO_HANDLER
+
+    def _finish(self, invocation: Invocation, start: float, failed: bool):
+        handler = invocation.handler
+        if handler not in self.durations:
+            self.durations[handler] = Histogram()
+            self.api_calls_per_invocation[handler] = Histogram(API_CALL_BUCKETS)
+        self.durations[handler].observe(time.perf_counter() - start)
+        self.api_calls_per_invocation[handler].observe(invocation.api_calls)
+        if failed:
+            self.errors[handler] += 1
+
+    def instrument(self, fn: Callable, handler: str) -> Callable:
+        """Wrap a handler so its invocations are measured
+
+        The wrapper keeps the metadata, signature and kind (coroutine or async generator) of the handler, which is
+        what Slack Machine uses to register and call it.
+        """
+        if inspect.isasyncgenfunction(fn):
+
+            @functools.wraps(fn)
+            async def instrumented_generator(*args, **kwargs):
+                invocation, start, failed = Invocation(handler), time.perf_counter(), True
+                token = _invocation.set(invocation)
+                try:
+                    async for item in fn(*args, **kwargs):
+                        yield item
+                    failed = False
+                finally:
+                    _invocation.reset(token)
+                    self._finish(invocation, start, failed)
+
+            wrapper = instrumented_generator
+        else:
+
+            @functools.wraps(fn)
+            async def instrumented(*args, **kwargs):
+                invocation, start, failed = Invocation(handler), time.perf_counter(), True
+                token = _invocation.set(invocation)
+                try:
+                    result = await fn(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    _invocation.reset(token)
+                    self._finish(invocation, start, failed)
+
+            wrapper = instrumented
+        wrapper.__kitchensink_instrumented__ = fn
+        self.handlers[handler] = fn
+        return wrapper
+
+    def instrument_class(self, cls: type):
+        """Instrument all handlers of a plugin class, including the ones it inherits"""
+        for name in dir(cls):
+            fn = getattr(cls, name, None)
+            if not inspect.isfunction(fn) or (name != "init" and not _is_handler(fn)):
+                continue
+            if not (inspect.iscoroutinefunction(fn) or inspect.isasyncgenfunction(fn)):
+                continue
+            # handlers inherited from an instrumented class are instrumented again under the name of this class
+            fn = getattr(fn, "__kitchensink_instrumented__", fn)
+            setattr(cls, name, self.instrument(fn, f"{cls.__name__}.{name}"))
+
+    def record_api_call(self, method: str, sent: int, received: int):
+        invocation = _invocation.get()
+        handler = NO_HANDLER
+        if invocation is not None:
+            invocation.api_calls += 1
+            handler = invocation.handler
+        self.api_calls[(handler, method)] += 1
+        self.api_bytes[(handler, "sent")] += sent
+        self.api_bytes[(handler, "received")] += received
+
+    @staticmethod
+    def _observe(histograms: Dict[Any, Histogram], key: Any, value: float):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def record_storage_wait(self, operation: str, seconds: float):
+        self._observe(self.storage_waits, (self.current_handler(), operation), seconds)
+
+    def record_command_ack(self, seconds: float):
+        self._observe(self.command_acks, self.current_handler(), seconds)
+
+    def record_command_queue_wait(self, seconds: float):
+        self._observe(self.command_queue_waits, self.current_handler(), seconds)
+
+    def instrument_web_client(self, web_client: AsyncWebClient):
+        """Count the calls and bytes of all calls made through `web_client`, installing more than once is a no-op"""
+        if getattr(web_client, "_kitchensink_metrics", None) is not None:
+            return
+        api_call = web_client.api_call
+
+        async def measured_api_call(api_method: str, **kwargs: Any):
+            payload = kwargs.get("json") or kwargs.get("data") or kwargs.get("params")
+            received = 0
+            try:
+                response = await api_call(api_method, **kwargs)
+                received = _size(response.data)
+                return response
+            finally:
+                self.record_api_call(api_method, _size(payload), received)
+
+        web_client.api_call = measured_api_call
+        web_client._kitchensink_metrics = self
+
+    def expose(self) -> str:
+        """All metrics in the Prometheus text format"""
+        lines = [
+            "# HELP kitchensink_handler_duration_seconds Time it takes handlers to run",
+            "# TYPE kitchensink_handler_duration_seconds histogram",
+        ]
+        for handler, histogram in sorted(self.durations.items()):
+            lines.extend(self._histogram_lines("kitchensink_handler_duration_seconds", histogram, handler=handler))
+        lines += [
+            "# HELP kitchensink_handler_errors_total Handler invocations that raised an error",
+            "# TYPE kitchensink_handler_errors_total counter",
+        ]
+        for handler in sorted(self.durations):
+            lines.append(f"kitchensink_handler_errors_total{{{_labels(handler=handler)}}} {self.errors[handler]}")
+        lines += [
+            "# HELP kitchensink_handler_api_calls Slack API calls per handler invocation",
+            "# TYPE kitchensink_handler_api_calls histogram",
+        ]
+        for handler, histogram in sorted(self.api_calls_per_invocation.items()):
+            lines.extend(self._histogram_lines("kitchensink_handler_api_calls", histogram, handler=handler))
+        lines += [
+            "# HELP kitchensink_api_calls_total Slack API calls",
+            "# TYPE kitchensink_api_calls_total counter",
+        ]
+        for (handler, method), count in sorted(self.api_calls.items()):
+            lines.append(f"kitchensink_api_calls_total{{{_labels(handler=handler, method=method)}}} {count}")
+        lines += [
+            "# HELP kitchensink_api_bytes_total Bytes sent to and received from the Slack API",
+            "# TYPE kitchensink_api_bytes_total counter",
+        ]
+        for (handler, direction), count in sorted(self.api_bytes.items()):
+            lines.append(f"kitchensink_api_bytes_total{{{_labels(handler=handler, direction=direction)}}} {count}")
+        lines += [
+            "# HELP kitchensink_storage_wait_seconds Time spent waiting on plugin storage",
+            "# TYPE kitchensink_storage_wait_seconds histogram",
+        ]
+        for (handler, operation), histogram in sorted(self.storage_waits.items()):
+            lines.extend(self._histogram_lines(
+                "kitchensink_storage_wait_seconds", histogram, handler=handler, operation=operation
+            ))
+        lines += [
+            "# HELP kitchensink_command_ack_seconds Time until slash commands are acknowledged",
+            "# TYPE kitchensink_command_ack_seconds histogram",
+        ]
+        for handler, histogram in sorted(self.command_acks.items()):
+            lines.extend(self._histogram_lines("kitchensink_command_ack_seconds", histogram, handler=handler))
+        lines += [
+            "# HELP kitchensink_command_queue_wait_seconds Time slash command work waits for an executor worker",
+            "# TYPE kitchensink_command_queue_wait_seconds histogram",
+        ]
+        for handler, histogram in sorted(self.command_queue_waits.items()):
+            lines.extend(self._histogram_lines("kitchensink_command_queue_wait_seconds", histogram, handler=handler))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _histogram_lines(name: str, histogram: Histogram, **labels: str) -> List[str]:
+        label_str = _labels(**labels)
+        lines = [f'{name}_bucket{{{label_str},le="{bound}"}} {count}' for bound, count in histogram.cumulative()]
+        lines.append(f"{name}_sum{{{label_str}}} {histogram.sum}")
+        lines.append(f"{name}_count{{{label_str}}} {histogram.count}")
+        return lines
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Totals per handler"""
+        result: Dict[str, Dict[str, Any]] = {}
+
+        def entry(handler: str) -> Dict[str, Any]:
+            if handler not in result:
+                result[handler] = dict(
+                    invocations=0, errors=0, mean_ms=0.0, api_calls=0, api_bytes=0, storage_wait_ms=0.0
+                )
+            return result[handler]
+
+        for handler, histogram in self.durations.items():
+            entry(handler).update(
+                invocations=histogram.count,
+                errors=self.errors[handler],
+                mean_ms=round(histogram.sum / histogram.count * 1000, 3),
+            )
+        for (handler, _), count in self.api_calls.items():
+            entry(handler)["api_calls"] += count
+        for (handler, _), count in self.api_bytes.items():
+            entry(handler)["api_bytes"] += count
+        for (handler, _), histogram in self.storage_waits.items():
+            entry(handler)["storage_wait_ms"] += round(histogram.sum * 1000, 3)
+        return result
+
+    def start(self, settings: CaseInsensitiveDict):
+        """Start the Prometheus endpoint and the periodic summary, if configured. Starting more than once is a no-op"""
+        if self._started:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._started = True
+        port = settings.get("KITCHENSINK_METRICS_PORT")
+        if port:
+            self._tasks.append(loop.create_task(self._serve(int(port))))
+        interval = float(settings.get("KITCHENSINK_METRICS_LOG_INTERVAL", 300))
+        if interval > 0:
+            self._tasks.append(loop.create_task(self._log_summaries(interval)))
+
+    async def _serve(self, port: int):
+        from aiohttp import web
+
+        async def handle(_: web.Request) -> web.Response:
+            return web.Response(text=self.expose(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        main_logger.info("Serving metrics", url=f"http://127.0.0.1:{port}/metrics")
+
+    async def _log_summaries(self, interval: float):
+        last_total = 0
+        while True:
+            await asyncio.sleep(interval)
+            total = sum(histogram.count for histogram in self.durations.values())
+            if total != last_total:
+                main_logger.info("Handler metrics", handlers=self.summary())
+                last_total = total
+
+
+class TimedStorage:
+    """Plugin storage that records how long every call waits on the storage backend"""
+
+    def __init__(self, storage: PluginStorage):
+        self._storage = storage
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._storage, name)
+        if not inspect.iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await attr(*args, **kwargs)
+            finally:
+                metrics.record_storage_wait(name, time.perf_counter() - start)
+
+        # cache the wrapper, so __getattr__ is only called once per method
+        setattr(self, name, timed)
+        return timed
+
+
+metrics = Metrics()
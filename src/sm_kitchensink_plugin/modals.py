@@ -1,45 +1,104 @@
 import asyncio
+import hashlib
+import json
 
-from machine.plugins.base import MachineBasePlugin
+from machine.models import User
 from machine.plugins.command import Command
 from machine.plugins.decorators import (
     command,
     modal,
-    modal_closed
+    modal_closed,
+    process
 )
 from machine.plugins.modals import ModalSubmission, ModalClosure
 from slack_sdk.models import blocks
 from slack_sdk.models.views import View
 from structlog.stdlib import get_logger, BoundLogger
 
+from sm_kitchensink_plugin.base import KitchensinkPlugin
+from sm_kitchensink_plugin.command_executor import fast_ack
+from sm_kitchensink_plugin.digest import SubmissionDigest
+
 main_logger = get_logger(__name__)
 
 
-class Modals(MachineBasePlugin):
+class Modals(KitchensinkPlugin):
     """Modals (and home tab)"""
 
     async def init(self):
-        update_fns = []
-        for user in self.users.values():
-            home_blocks = [
-                blocks.HeaderBlock(
-                    text=blocks.PlainTextObject.from_str(
-                        f"Welcome {user.profile.display_name}"
-                    )
-                ),
-                blocks.DividerBlock(),
-                blocks.SectionBlock(
-                    text=blocks.MarkdownTextObject.from_str(
-                        "There is *so much* you can do here!"
-                    )
-                ),
-            ]
-            view = View(type="home", blocks=home_blocks)
-            update_fns.append(self.publish_home_tab(user=user, view=view))
+        await super().init()
+        # Submissions and cancellations of the modal are reported in digests rather than one post each, so a modal
+        # sent to the whole workspace doesn't flood the notification channel
+        self.digest = SubmissionDigest(
+            self.storage,
+            self.post_digest,
+            interval=float(self.settings.get("KITCHENSINK_MODAL_DIGEST_INTERVAL", 3600)),
+            size=int(self.settings.get("KITCHENSINK_MODAL_DIGEST_SIZE", 100)),
+        )
+        self.digest.start()
+        # In "lazy" mode (the default) home tabs are only published when a user opens them, so startup
+        # cost does not grow with the size of the workspace. "eager" publishes everyone's home tab at startup.
+        if self.settings.get("KITCHENSINK_HOME_TAB_MODE", "lazy").lower() != "eager":
+            return
+        update_fns = [self.update_home_tab(user) for user in self.users.values()]
         await asyncio.gather(*update_fns)
 
+    @staticmethod
+    def home_view(user: User) -> View:
+        home_blocks = [
+            blocks.HeaderBlock(
+                text=blocks.PlainTextObject.from_str(
+                    f"Welcome {user.profile.display_name}"
+                )
+            ),
+            blocks.DividerBlock(),
+            blocks.SectionBlock(
+                text=blocks.MarkdownTextObject.from_str(
+                    "There is *so much* you can do here!"
+                )
+            ),
+        ]
+        return View(type="home", blocks=home_blocks)
+
+    async def update_home_tab(self, user: User):
+        """Publish the home tab of a user, unless it didn't change since it was last published"""
+        view = self.home_view(user)
+        content_hash = hashlib.sha256(json.dumps(view.to_dict(), sort_keys=True).encode()).hexdigest()
+        key = f"home-tab-hash:{user.id}"
+        if await self.storage.get(key) == content_hash:
+            return
+        await self.publish_home_tab(user=user, view=view)
+        await self.storage.set(key, content_hash)
+
+    @process("app_home_opened")
+    async def home_tab_opened(self, event):
+        if event.get("tab", "home") != "home":
+            return
+        user = self.get_user_by_id(event["user"])
+        if user is not None:
+            await self.update_home_tab(user)
+
+    @process("user_change")
+    async def home_tab_user_changed(self, event):
+        # Only re-render for users that have seen their home tab already, others get it when they open it
+        user = User.model_validate(event["user"])
+        if await self.storage.has(f"home-tab-hash:{user.id}"):
+            await self.update_home_tab(user)
+
+    async def post_digest(self, digest: str):
+        # a digest already sums up many notifications, and submissions wait for it to be posted, so it's not merged
+        if await self.notify(digest, immediate=True) is None:
+            raise RuntimeError("Posting the modal digest failed")
+
     @command("/modal")
+    @fast_ack()
     async def modal_command(self, command: Command, logger: BoundLogger):
+        if command.text.strip().lower() == "digest":
+            if await self.digest.post():
+                await command.say("Posted the modal digest")
+            else:
+                await command.say("Nothing happened since the last modal digest")
+            return
         raw_modal = {
             "type": "modal",
             "callback_id": "my_modal",
@@ -148,10 +207,10 @@ class Modals(MachineBasePlugin):
         }
         logger.info("Modal submission", payload=submission.payload)
         value = submission.payload.view.state.values["modal_input"]["opinion"].value
-        await self.say(self.find_channel_by_name("#general"), f"Modal submitted! Your grand opinion: {value}")
+        await self.digest.add_submission(value)
 
     @modal_closed("my_modal")
     async def handle_modal_closed(self, closure: ModalClosure, logger: BoundLogger):
         logger.info("Modal closed", payload=closure.payload)
-        await self.say(self.find_channel_by_name("#general"), "Sadly the modal was closed")
+        await self.digest.add_cancellation()
         await closure.send_dm("You closed the modal. Are you sure you don't to submit your opinion?")
@@ -0,0 +1,76 @@
+import asyncio
+from collections import Counter
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, Tuple
+
+from machine.storage import PluginStorage
+
+from sm_kitchensink_plugin.caching import LRUCache
+from sm_kitchensink_plugin.debounce import Debouncer
+from sm_kitchensink_plugin.leases import leases
+
+PollKey = Tuple[str, str]
+
+
+class PollEngine:
+    """Keeps track of the votes of polls that are posted as messages
+
+    Polls are identified by the channel and timestamp of their message. Every user has at most one vote per poll,
+    voting again for the same option is a no-op and voting for another option moves the vote. Votes are persisted in
+    plugin storage, and after votes come in `on_change` is called with the new tally of the poll. That's debounced, so a
+    burst of votes results in a single call.
+
+    Votes aren't cached, a vote re-reads the votes of the poll from storage and writes them back under a lease, so
+    shards and replicas that share the storage keep each other's votes. Votes in the same process wait for each other
+    on a local lock first, the locks of the `active` most recently voted polls are kept.
+    """
+
+    def __init__(
+        self,
+        storage: PluginStorage,
+        on_change: Callable[[PollKey, Counter], Awaitable[None]],
+        window: float = 1.0,
+        expires: timedelta = timedelta(days=7),
+        active: int = 1000,
+    ):
+        self._storage = storage
+        self._on_change = on_change
+        self._expires = expires
+        self._locks = LRUCache(maxsize=active)
+        self._debouncer = Debouncer(window, self._changed)
+
+    @staticmethod
+    def _storage_key(poll: PollKey) -> str:
+        channel, ts = poll
+        return f"poll:{channel}:{ts}"
+
+    async def _load(self, poll: PollKey) -> Dict[str, str]:
+        return await self._storage.get(self._storage_key(poll)) or {}
+
+    def _lock(self, poll: PollKey) -> asyncio.Lock:
+        lock = self._locks.get(poll)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks.set(poll, lock)
+        return lock
+
+    async def vote(self, poll: PollKey, user_id: str, option: str) -> bool:
+        """Register the vote of a user
+
+        :return: whether the vote changed the tally of the poll
+        """
+        async with self._lock(poll), leases.lock(f"kitchensink:{self._storage_key(poll)}"):
+            votes = await self._load(poll)
+            if votes.get(user_id) == option:
+                return False
+            votes[user_id] = option
+            await self._storage.set(self._storage_key(poll), votes, expires=self._expires)
+        self._debouncer.trigger(poll)
+        return True
+
+    async def tally(self, poll: PollKey) -> Counter:
+        """Number of votes per option"""
+        return Counter((await self._load(poll)).values())
+
+    async def _changed(self, poll: PollKey, _, __):
+        await self._on_change(poll, await self.tally(poll))
@@ -0,0 +1,240 @@
+"""On-demand profiling of the running bot
+
+Two tools that can be turned on while the bot runs, rather than restarting it in debug mode:
+
+- ``SamplingProfiler`` samples the stacks of all threads from a background thread, at a fixed interval. The result is
+  a file in the folded stack format that flamegraph tools read, like ``flamegraph.pl`` and speedscope. Frames of
+  handlers are named after the plugin method, so the time spent per handler shows up as its own tower. Taking a
+  sample costs a few microseconds per thread, and nothing runs between samples
+- ``MemoryTracker`` traces allocations with ``tracemalloc``, and compares snapshots. The growth between two snapshots
+  is grouped by the handler that made the allocations, found by the innermost handler frame in their traceback.
+  Allocations made by tasks that a handler started are attributed to no handler. Tracing slows down every allocation,
+  so it only runs between the first snapshot and stopping it
+
+``ListeningAdvanced`` exposes both to admins, with ``profile start``, ``profile stop``, ``memory snapshot`` and
+``memory stop``. In sharded mode, the commands profile the shard that handles the channel they're sent in.
+"""
+import dis
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from types import CodeType, FrameType, FunctionType
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from structlog.stdlib import get_logger
+
+from sm_kitchensink_plugin.metrics import NO_HANDLER, metrics
+
+main_logger = get_logger(__name__)
+
+
+def _short_path(filename: str) -> str:
+    """`filename` relative to the entry of the import path it's in, e.g. sm_kitchensink_plugin/base.py"""
+    for entry in sorted((os.path.abspath(p) for p in sys.path if p), key=len, reverse=True):
+        if filename.startswith(entry + os.sep):
+            return filename[len(entry) + 1:]
+    return filename
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads every `interval` seconds, see the module docstring"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started: Optional[float] = None
+        self.stopped: Optional[float] = None
+        self._labels: Dict[CodeType, str] = {}
+        self._thread_names: Dict[int, str] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start sampling, starting a profiler that's running already raises ``RuntimeError``"""
+        if self.running:
+            raise RuntimeError("The profiler is running already")
+        self.stacks = Counter()
+        self.samples = 0
+        self.started, self.stopped = time.time(), None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="kitchensink-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.stopped = time.time()
+
+    def _label(self, code: CodeType) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            name = getattr(code, "co_qualname", code.co_name)
+            # semicolons separate the frames of a folded stack
+            label = self._labels[code] = f"{name} ({_short_path(code.co_filename)})".replace(";", ":")
+        return label
+
+    def _fold(self, thread: str, frame: Optional[FrameType]) -> str:
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.append(thread)
+        return ";".join(reversed(labels))
+
+    def _run(self):
+        ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if not frames.keys() <= self._thread_names.keys():
+                self._thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread, frame in frames.items():
+                if thread != ident:
+                    self.stacks[self._fold(self._thread_names.get(thread, str(thread)), frame)] += 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        """The sampled stacks in the folded format, a line per stack with the number of samples it was seen in"""
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+
+def _defined(fn: Callable, name: str) -> Optional[FunctionType]:
+    """The function a handler was defined as `name`, below the decorators that wrap it"""
+    seen = set()
+    candidates = [fn]
+    while candidates:
+        candidate = candidates.pop()
+        if id(candidate) in seen:
+            continue
+        seen.add(id(candidate))
+        if not isinstance(candidate, FunctionType):
+            continue
+        # wrappers may copy the name of the function they wrap, but not its code
+        if candidate.__code__.co_name == name:
+            return candidate
+        # not all decorators set __wrapped__, the function they wrap is in their closure then
+        candidates.extend(cell.cell_contents for cell in candidate.__closure__ or () if _filled(cell))
+        if hasattr(candidate, "__wrapped__"):
+            candidates.append(candidate.__wrapped__)
+    return None
+
+
+def _filled(cell) -> bool:
+    try:
+        cell.cell_contents
+    except ValueError:
+        return False
+    return True
+
+
+class HandlerLocator:
+    """Finds the handler a line of code belongs to, from the source lines of the instrumented handlers
+
+    Handlers that a plugin inherits are named after the class that defines them.
+    """
+
+    def __init__(self, handlers: Dict[str, Callable]):
+        self._ranges: Dict[str, List[Tuple[int, int, str]]] = {}
+        codes = set()
+        for handler, fn in handlers.items():
+            defined = _defined(fn, handler.rpartition(".")[2])
+            if defined is None or defined.__code__ in codes:
+                continue
+            code = defined.__code__
+            codes.add(code)
+            lines = [line for _, line in dis.findlinestarts(code) if line is not None]
+            self._ranges.setdefault(code.co_filename, []).append(
+                (code.co_firstlineno, max(lines, default=0), defined.__qualname__)
+            )
+
+    def find(self, frames: Iterable[tracemalloc.Frame]) -> str:
+        """The handler of the innermost frame that's part of one, `frames` go from the oldest to the most recent"""
+        for frame in reversed(list(frames)):
+            for first, last, name in self._ranges.get(frame.filename, ()):
+                if first <= frame.lineno <= last:
+                    return name
+        return NO_HANDLER
+
+
+def _format_size(size: int) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:+.0f} {unit}" if unit == "B" else f"{size:+.1f} {unit}"
+        size /= 1024
+    return f"{size:+.1f} GiB"
+
+
+class MemoryTracker:
+    """Compares ``tracemalloc`` snapshots, see the module docstring
+
+    :param frames: number of frames that are stored per allocation, handlers deeper than that aren't found
+    :param top: number of handlers and lines in a report
+    """
+
+    def __init__(self, frames: int = 25, top: int = 20):
+        self.frames = frames
+        self.top = top
+        self._previous: Optional[tracemalloc.Snapshot] = None
+        self._previous_at: Optional[float] = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def snapshot(self) -> Optional[str]:
+        """Take a snapshot, returns a report of the growth since the previous one, or None for the first one"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._previous = None
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ])
+        previous, previous_at = self._previous, self._previous_at
+        self._previous, self._previous_at = snapshot, time.time()
+        if previous is None:
+            return None
+        return self._report(snapshot, previous, time.time() - previous_at)
+
+    def _report(self, snapshot: tracemalloc.Snapshot, previous: tracemalloc.Snapshot, seconds: float) -> str:
+        locator = HandlerLocator(metrics.handlers)
+        sizes: Counter = Counter()
+        counts: Counter = Counter()
+        for diff in snapshot.compare_to(previous, "traceback"):
+            handler = locator.find(diff.traceback)
+            sizes[handler] += diff.size_diff
+            counts[handler] += diff.count_diff
+        traced = sum(stat.size for stat in snapshot.statistics("filename"))
+        lines = [
+            f"Allocation growth in the last {seconds:.0f}s, {_format_size(sum(sizes.values()))} of "
+            f"{traced / 2 ** 20:.1f} MiB traced",
+            "",
+            "By handler:",
+        ]
+        for handler, size in sorted(sizes.items(), key=lambda item: -abs(item[1]))[:self.top]:
+            lines.append(f"  {_format_size(size):>12} {counts[handler]:+9} blocks  {handler}")
+        lines += ["", "By line:"]
+        for diff in snapshot.compare_to(previous, "lineno")[:self.top]:
+            frame = diff.traceback[0]
+            lines.append(
+                f"  {_format_size(diff.size_diff):>12} {diff.count_diff:+9} blocks  "
+                f"{_short_path(frame.filename)}:{frame.lineno}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def stop(self):
+        tracemalloc.stop()
+        self._previous = self._previous_at = None
+
+
+profiler = SamplingProfiler()
+memory_tracker = MemoryTracker()
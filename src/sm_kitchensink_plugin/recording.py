@@ -0,0 +1,254 @@
+"""Recording of the events the kitchensink plugins handle, so production traffic can be replayed
+
+When ``KITCHENSINK_RECORD_EVENTS`` is set to a path, the messages that match a ``listen_to`` or ``respond_to`` pattern,
+``reaction_added`` events, block actions and slash commands are appended to that file. Replay a recording against the
+fake Slack with ``benchmarks/replay.py``.
+
+The file holds gzip compressed JSON lines, written as a gzip member per flush, so it can be appended to by later runs
+and read as a whole with ``gzip.open``. Every run starts with a header object with the user id of the bot, followed by
+a ``[time, type, payload]`` array per Socket Mode request.
+
+With redaction, which is on by default, text that users typed is masked: letters become ``x`` and digits become ``0``,
+so the text keeps its length and shape. Of a message, only the mention of the bot and the literal text of the patterns
+that match it are kept, like ``list users`` of ``^list users`` or ``pin`` of ``.*pin.*``, so the message still
+triggers the same handlers. Of block actions, the values and selected options of the actions and of the inputs in
+their message or view are masked as a whole, and so is the text of slash commands.
+"""
+import asyncio
+import atexit
+import functools
+import gzip
+import json
+import re
+import time
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from machine.clients.slack import SlackClient
+from slack_sdk.socket_mode.async_client import AsyncBaseSocketModeClient
+from slack_sdk.socket_mode.request import SocketModeRequest
+from structlog.stdlib import get_logger
+
+from sm_kitchensink_plugin.dispatch import index, sre_parse
+
+main_logger = get_logger(__name__)
+
+# Slack Machine strips a mention of the bot before matching respond_to patterns
+_MENTION = re.compile(r"^<@\w+>:? ?")
+_LETTER = re.compile(r"[^\W\d]")
+_DIGIT = re.compile(r"\d")
+# fields of a message that repeat its text or hold content that handlers don't use
+_RICH_FIELDS = ("blocks", "attachments", "files", "user_profile")
+
+
+def mask(text: str) -> str:
+    return _DIGIT.sub("0", _LETTER.sub("x", text))
+
+
+@functools.lru_cache(maxsize=None)
+def _literals(regex: re.Pattern) -> Tuple[re.Pattern, ...]:
+    """The runs of literal text at the top level of `regex`, in order, which every match contains"""
+    try:
+        parsed = list(sre_parse.parse(regex.pattern, regex.flags))
+    except re.error:
+        return ()
+    runs, run = [], ""
+    for op, av in parsed:
+        if op == sre_parse.LITERAL:
+            run += chr(av)
+        elif run:
+            runs.append(run)
+            run = ""
+    if run:
+        runs.append(run)
+    return tuple(re.compile(re.escape(run), regex.flags & re.IGNORECASE) for run in runs)
+
+
+def _literal_positions(match: re.Match) -> Iterator[int]:
+    """Positions of the literal text that `match` needs, found from left to right within the match"""
+    pos = match.start()
+    for literal in _literals(match.re):
+        found = literal.search(match.string, pos, match.end())
+        if found is None:
+            return
+        yield from range(found.start(), found.end())
+        pos = found.end()
+
+
+def _redact_message(event: Dict[str, Any], matches: List[re.Match], offset: int) -> Dict[str, Any]:
+    """Mask the text of a message, except the mention of the bot and the literal text that `matches` need"""
+    text = event["text"]
+    keep = [i < offset for i in range(len(text))]
+    for match in matches:
+        for i in _literal_positions(match):
+            keep[i + offset] = True
+    event = {key: value for key, value in event.items() if key not in _RICH_FIELDS}
+    event["text"] = "".join(char if kept else mask(char) for char, kept in zip(text, keep))
+    return event
+
+
+def _redact_option(option: Dict[str, Any]) -> Dict[str, Any]:
+    masked = {**option, "value": mask(option.get("value", ""))}
+    if isinstance(option.get("text"), dict):
+        masked["text"] = {**option["text"], "text": mask(option["text"].get("text", ""))}
+    return masked
+
+
+def _redact_element(element: Dict[str, Any]) -> Dict[str, Any]:
+    """Mask what a user typed or picked in a block element: its value and the selected options"""
+    masked = dict(element)
+    if isinstance(element.get("value"), str):
+        masked["value"] = mask(element["value"])
+    if isinstance(element.get("selected_option"), dict):
+        masked["selected_option"] = _redact_option(element["selected_option"])
+    if isinstance(element.get("selected_options"), list):
+        masked["selected_options"] = [_redact_option(option) for option in element["selected_options"]]
+    return masked
+
+
+def _redact_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    values = state.get("values", {})
+    masked = {
+        block: {action: _redact_element(element) for action, element in actions.items()}
+        for block, actions in values.items()
+    }
+    return {**state, "values": masked}
+
+
+def _redact_block_actions(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Mask the values of the actions, and of the inputs in the message or view the actions happened in"""
+    payload = {**payload, "actions": [_redact_element(action) for action in payload.get("actions", [])]}
+    if "state" in payload:
+        payload["state"] = _redact_state(payload["state"])
+    if isinstance(payload.get("view"), dict) and "state" in payload["view"]:
+        payload["view"] = {**payload["view"], "state": _redact_state(payload["view"]["state"])}
+    return payload
+
+
+def _search_all(text: str) -> List[re.Match]:
+    """Matches of all patterns that match `text`"""
+    matches = (pattern.regex.search(text) for pattern in index.candidates(text))
+    return [match for match in matches if match is not None]
+
+
+class EventRecorder:
+    """Appends the Socket Mode requests the kitchensink plugins handle to a compressed file
+
+    Requests are serialized as they come in, which is the only work done before Slack Machine gets to handle them.
+    Compressing and writing happens in a thread every `flush_interval` seconds, or as soon as `batch_size` requests
+    are waiting, and at exit.
+    """
+
+    def __init__(self, flush_interval: float = 5.0, batch_size: int = 1000):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.path: Optional[str] = None
+        self.redact = True
+        self._client: Optional[SlackClient] = None
+        self._lines: List[str] = []
+        self._header_written = False
+        self._started = time.time()
+        self._flushed: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._counters: Counter = Counter()
+
+    def install(self, client: SlackClient, path: str, redact: bool = True):
+        """Record the requests `client` receives to `path`. Installing more than once is a no-op."""
+        if self._client is not None:
+            return
+        self._client = client
+        self.path = path
+        self.redact = redact
+        self._started = time.time()
+        self._flushed = asyncio.Event()
+        client.register_handler(self._listen)
+        self._task = asyncio.create_task(self._flush_periodically())
+        atexit.register(self._flush_at_exit)
+        main_logger.info("Recording events", path=path, redact=redact)
+
+    async def _listen(self, _: AsyncBaseSocketModeClient, request: SocketModeRequest):
+        payload = self._select(request.type, request.payload)
+        if payload is None:
+            self._counters["skipped"] += 1
+            return
+        self._lines.append(json.dumps([round(time.time(), 3), request.type, payload], separators=(",", ":")))
+        self._counters["recorded"] += 1
+        if len(self._lines) >= self.batch_size:
+            self._flushed.set()
+
+    def _select(self, type_: str, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """The payload to record, redacted if needed, or None if the request isn't recorded"""
+        if type_ == "slash_commands":
+            return {**payload, "text": mask(payload.get("text", ""))} if self.redact else payload
+        if type_ == "interactive" and payload.get("type") == "block_actions":
+            return _redact_block_actions(payload) if self.redact else payload
+        if type_ != "events_api":
+            return None
+        event = payload.get("event", {})
+        if event.get("type") == "reaction_added":
+            return payload
+        if event.get("type") != "message" or "subtype" in event or "bot_id" in event or not event.get("text"):
+            return None
+        text, offset = event["text"], 0
+        matches = _search_all(text)
+        if not matches:
+            mention = _MENTION.match(text)
+            if mention is None:
+                return None
+            offset = mention.end()
+            matches = _search_all(text[offset:])
+            if not matches:
+                return None
+        if not self.redact:
+            return payload
+        return {**payload, "event": _redact_message(event, matches, offset)}
+
+    def _take_lines(self) -> List[str]:
+        lines, self._lines = self._lines, []
+        if lines and not self._header_written:
+            header = {"recording": 1, "bot_user_id": self._client.bot_info.get("user_id"), "started": self._started}
+            lines.insert(0, json.dumps(header))
+            self._header_written = True
+        return lines
+
+    async def _flush_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flushed.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flushed.clear()
+            await self.flush()
+
+    async def flush(self):
+        lines = self._take_lines()
+        if not lines:
+            return
+        try:
+            await asyncio.to_thread(self._write, lines)
+            self._counters["flushes"] += 1
+        except OSError:
+            main_logger.exception("Writing recorded events failed", path=self.path, events=len(lines))
+            self._counters["lost"] += len(lines)
+
+    def _flush_at_exit(self):
+        self._write(self._take_lines())
+
+    def _write(self, lines: List[str]):
+        if lines and self.path is not None:
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._counters, "pending": len(self._lines)}
+
+
+def read_recording(path: str) -> Iterator[Union[Dict[str, Any], List[Any]]]:
+    """The headers (dicts) and requests (``[time, type, payload]`` lists) in a recording, in order"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+event_recorder = EventRecorder()
@@ -0,0 +1,253 @@
+import asyncio
+import math
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from machine.clients.slack import SlackClient
+from machine.storage import PluginStorage
+from structlog.stdlib import get_logger
+
+from sm_kitchensink_plugin.leases import leases
+
+main_logger = get_logger(__name__)
+
+PENDING_KEY = "scheduled-replies:pending"
+LOCK_KEY = "kitchensink:scheduled-replies"
+
+
+class TimerWheel:
+    """Hierarchical timer wheel
+
+    The first level has `slots` slots of `tick` seconds, and every next level has `slots` slots that each span a full
+    revolution of the level below. Timers are put in the lowest level that reaches their deadline, and move down a
+    level when the level below comes around to them. Adding and cancelling a timer is O(1), and advancing the wheel
+    costs O(1) per tick plus the timers that move down or expire.
+    """
+
+    def __init__(self, tick: float = 0.1, slots: int = 64, levels: int = 3):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self._wheel: List[List[Dict[Hashable, int]]] = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._where: Dict[Hashable, Tuple[int, int]] = {}
+        self._origin = time.monotonic()
+        self._current = 0
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def add(self, key: Hashable, delay: float):
+        """Expire `key` after `delay` seconds, replacing the timer `key` already had"""
+        self.cancel(key)
+        now = self._now()
+        if not self._where:
+            # the wheel isn't advanced while it's empty, so catch up, there's nothing to expire
+            self._current = max(self._current, now)
+        self._place(key, max(self._current, now) + max(1, math.ceil(delay / self.tick)))
+
+    def cancel(self, key: Hashable) -> bool:
+        where = self._where.pop(key, None)
+        if where is None:
+            return False
+        level, index = where
+        del self._wheel[level][index][key]
+        return True
+
+    def _place(self, key: Hashable, deadline: int):
+        for level in range(self.levels):
+            span = self.slots ** level
+            if deadline // span - self._current // span < self.slots:
+                index = (deadline // span) % self.slots
+                break
+        else:
+            # beyond the range of the wheel, park it in the last slot of the top level until that comes around
+            index = (self._current // span + self.slots - 1) % self.slots
+        self._wheel[level][index][key] = deadline
+        self._where[key] = (level, index)
+
+    def _now(self) -> int:
+        return int((time.monotonic() - self._origin) / self.tick)
+
+    def advance(self) -> List[Hashable]:
+        """Move the wheel to the current time, returns the keys that expired"""
+        target = self._now()
+        if not self._where:
+            self._current = max(self._current, target)
+            return []
+        expired = []
+        while self._current < target:
+            self._current += 1
+            for level in range(self.levels - 1, 0, -1):
+                span = self.slots ** level
+                if self._current % span == 0:
+                    slot = self._wheel[level][(self._current // span) % self.slots]
+                    timers = list(slot.items())
+                    slot.clear()
+                    for key, deadline in timers:
+                        del self._where[key]
+                        self._place(key, deadline)
+            slot = self._wheel[0][self._current % self.slots]
+            for key in list(slot):
+                del self._where[key]
+            expired.extend(slot)
+            slot.clear()
+        return expired
+
+
+class ScheduledReplies:
+    """Sends messages after a delay, without the Slack API for short delays
+
+    Messages that are due within `horizon` seconds are kept in a timer wheel and posted when they're due. Messages that
+    are due later are scheduled with `chat.scheduleMessage`. Pending messages are persisted in plugin storage, so
+    they're still sent after a restart. A user can have only one pending message with the same text, and can cancel
+    their pending messages.
+
+    Shards and replicas that share the storage change the pending messages one at a time, under a lease, so they don't
+    overwrite each other's. Every one of them restores all pending messages when it starts, and a message is claimed
+    by taking it out of storage when it's due, so it's sent once, by whichever claims it first.
+    """
+
+    def __init__(self, storage: PluginStorage, client: SlackClient, horizon: float = 300, tick: float = 0.1):
+        self._client = client
+        self.horizon = horizon
+        self._storage = storage
+        self._items: Dict[str, Dict[str, Any]] = {}
+        self._by_user_text: Dict[Tuple[str, str], str] = {}
+        self._wheel = TimerWheel(tick)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.counters: Counter = Counter()
+
+    async def start(self):
+        """Restore the pending messages from storage and start sending them"""
+        for item in (await self._storage.get(PENDING_KEY) or {}).values():
+            self._track(item)
+        if self._items:
+            main_logger.info("Restored scheduled replies", pending=len(self._items))
+        self._task = asyncio.create_task(self._run())
+
+    async def schedule(
+        self, user_id: str, text: str, delay: float, channel: Optional[str] = None, thread_ts: Optional[str] = None
+    ) -> bool:
+        """Send `text` to `channel`, or in a DM to the user when no channel is given, after `delay` seconds
+
+        :return: whether the message was scheduled, False if the user already has a pending message with that text
+        """
+        if (user_id, text) in self._by_user_text:
+            self.counters["deduplicated"] += 1
+            return False
+        async with leases.lock(LOCK_KEY):
+            pending = await self._storage.get(PENDING_KEY) or {}
+            if any(item["user"] == user_id and item["text"] == text for item in pending.values()):
+                self.counters["deduplicated"] += 1
+                return False
+            post_at = time.time() + delay
+            item = {
+                "id": uuid.uuid4().hex,
+                "user": user_id,
+                "text": text,
+                "channel": channel,
+                "thread_ts": thread_ts,
+                "post_at": post_at,
+            }
+            if delay > self.horizon:
+                when = datetime.fromtimestamp(post_at, tz=timezone.utc)
+                if channel is None:
+                    response = await self._client.send_dm_scheduled(when, user_id, text)
+                else:
+                    response = await self._client.send_scheduled(when, channel, text, thread_ts=thread_ts)
+                # kept until it's due, so it can be cancelled and deduplicated
+                item["scheduled_message"] = (response["channel"], response["scheduled_message_id"])
+                self.counters["scheduled_slack"] += 1
+            else:
+                self.counters["scheduled_local"] += 1
+            pending[item["id"]] = item
+            await self._storage.set(PENDING_KEY, pending)
+        self._track(item)
+        return True
+
+    async def cancel(self, user_id: str, text: Optional[str] = None) -> int:
+        """Cancel the pending messages of a user, or only the one with `text`
+
+        :return: the number of cancelled messages
+        """
+        async with leases.lock(LOCK_KEY):
+            pending = await self._storage.get(PENDING_KEY) or {}
+            items = [item for item in pending.values() if item["user"] == user_id and text in (None, item["text"])]
+            if items:
+                for item in items:
+                    del pending[item["id"]]
+                await self._storage.set(PENDING_KEY, pending)
+        for item in items:
+            self._untrack(item)
+            self._wheel.cancel(item["id"])
+            if "scheduled_message" in item:
+                channel, scheduled_message_id = item["scheduled_message"]
+                try:
+                    await self._client.web_client.chat_deleteScheduledMessage(
+                        channel=channel, scheduled_message_id=scheduled_message_id
+                    )
+                except Exception:
+                    main_logger.exception("Deleting scheduled message failed", scheduled_message=scheduled_message_id)
+        self.counters["cancelled"] += len(items)
+        return len(items)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.counters, "pending": len(self._items)}
+
+    def _track(self, item: Dict[str, Any]):
+        self._items[item["id"]] = item
+        self._by_user_text[(item["user"], item["text"])] = item["id"]
+        self._wheel.add(item["id"], item["post_at"] - time.time())
+        self._wakeup.set()
+
+    def _untrack(self, item: Dict[str, Any]):
+        self._items.pop(item["id"], None)
+        self._by_user_text.pop((item["user"], item["text"]), None)
+
+    async def _claim(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Take the items that are still pending out of storage, the others were sent or cancelled elsewhere"""
+        async with leases.lock(LOCK_KEY):
+            pending = await self._storage.get(PENDING_KEY) or {}
+            claimed = [item for item in items if pending.pop(item["id"], None) is not None]
+            if claimed:
+                await self._storage.set(PENDING_KEY, pending)
+        return claimed
+
+    async def _run(self):
+        while True:
+            if not self._wheel:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            await asyncio.sleep(self._wheel.tick)
+            expired = [self._items[key] for key in self._wheel.advance()]
+            if not expired:
+                continue
+            for item in expired:
+                self._untrack(item)
+            try:
+                claimed = await self._claim(expired)
+            except Exception:
+                main_logger.exception("Claiming scheduled replies failed", replies=len(expired))
+                self.counters["failed"] += len(expired)
+                continue
+            self.counters["sent_elsewhere"] += len(expired) - len(claimed)
+            for item in claimed:
+                await self._send(item)
+
+    async def _send(self, item: Dict[str, Any]):
+        if "scheduled_message" in item:
+            # Slack posted it already
+            return
+        try:
+            if item["channel"] is None:
+                await self._client.send_dm(item["user"], item["text"])
+            else:
+                await self._client.send(item["channel"], item["text"], thread_ts=item["thread_ts"])
+            self.counters["sent"] += 1
+        except Exception:
+            main_logger.exception("Sending scheduled reply failed", user=item["user"])
+            self.counters["failed"] += 1
@@ -0,0 +1,500 @@
+"""Sharded event execution: Slack Machine in several processes, handling the events of a channel in order
+
+Slack Machine handles all events on a single event loop, so CPU-bound handlers are limited to one core. In sharded
+mode a dispatcher process holds the Socket Mode connection, and hands every request to one of N shard processes by a
+hash of its channel, or of its user for requests outside a channel like home tab and modal events. Every shard runs
+Slack Machine with all plugins, and handles the requests of a channel one at a time, in the order Slack sent them.
+Requests of different channels run concurrently, like they do without sharding, but a slow handler holds up the
+requests in its channel that come after it. The dispatcher acknowledges events right away, slash commands and
+interactions are acknowledged by their handlers in the shard.
+
+State is kept consistent across shards:
+
+- events that change Slack Machine's user and channel caches are sent to every shard. The shard that owns the event
+  handles it, the others only update their caches and run the handlers marked with ``@every_shard`` from
+  ``sm_kitchensink_plugin.dispatch``
+- with the default memory storage backend, the shards use the storage backend of the dispatcher. Other backends are
+  shared by the shards like they are by replicas of the bot
+- the dispatcher takes the leases of the shards, see ``sm_kitchensink_plugin.leases``, unless they're in Redis
+- plugin events go through a broker that the dispatcher runs, unless ``KITCHENSINK_EVENT_BROKER`` is set. It hands
+  all events of a name to one shard, so every event is handled once, and batched like it is without sharding
+- every shard uses 1/N of the Slack API rate limits
+
+Run with: python -m sm_kitchensink_plugin.sharding [--shards N]
+"""
+import argparse
+import asyncio
+import functools
+import itertools
+import multiprocessing
+import os
+import pickle
+import socket
+import struct
+import sys
+import zlib
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Type
+
+from machine.clients.slack import SlackClient
+from machine.core import Machine
+from machine.settings import import_settings
+from machine.storage.backends.base import MachineBaseStorage
+from machine.utils.collections import CaseInsensitiveDict
+from machine.utils.logging import configure_logging
+from machine.utils.module_loading import import_string
+from slack_sdk.socket_mode.aiohttp import SocketModeClient
+from slack_sdk.socket_mode.request import SocketModeRequest
+from slack_sdk.socket_mode.response import SocketModeResponse
+from slack_sdk.web.async_client import AsyncWebClient
+from structlog.stdlib import get_logger
+
+from sm_kitchensink_plugin.api_scheduler import scheduler
+from sm_kitchensink_plugin.event_bus import serve_broker
+from sm_kitchensink_plugin.leases import LocalLeases, leases
+
+main_logger = get_logger(__name__)
+
+MEMORY_STORAGE = "machine.storage.backends.memory.MemoryStorage"
+STORAGE_METHODS = ("get", "set", "has", "delete", "size")
+
+# events that change Slack Machine's user and channel caches, they're sent to every shard
+CACHE_EVENTS = frozenset({
+    "team_join",
+    "user_change",
+    "channel_created",
+    "channel_deleted",
+    "channel_rename",
+    "channel_archive",
+    "channel_unarchive",
+    "channel_id_changed",
+    "group_deleted",
+    "group_rename",
+    "group_archive",
+    "group_unarchive",
+    "member_joined_channel",
+})
+
+_HEADER = struct.Struct("!I")
+# whether the shard handling the current request owns it, or only updates its caches
+_owner: ContextVar[bool] = ContextVar("kitchensink_shard_owner", default=True)
+
+
+def _id(value: Any) -> Optional[str]:
+    return value.get("id") if isinstance(value, dict) else value
+
+
+def shard_key(type_: str, payload: Dict[str, Any]) -> Optional[str]:
+    """The channel a Socket Mode request belongs to, or its user for requests that aren't tied to a channel"""
+    if type_ == "events_api":
+        event = payload.get("event", {})
+        item = event.get("item") if isinstance(event.get("item"), dict) else {}
+        channel = _id(event.get("channel")) or item.get("channel") or event.get("channel_id") or event.get(
+            "old_channel_id"
+        )
+        return channel or _id(event.get("user"))
+    if type_ == "slash_commands":
+        return payload.get("channel_id") or payload.get("user_id")
+    channel = _id(payload.get("channel")) or (payload.get("container") or {}).get("channel_id")
+    return channel or _id(payload.get("user"))
+
+
+def shard_for(key: Optional[str], shards: int) -> int:
+    # crc32 rather than hash(), which differs between processes
+    return zlib.crc32(key.encode()) % shards if key else 0
+
+
+class Link:
+    """Pickled messages over a socket between the dispatcher and a shard, which trust each other"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._drain_lock = asyncio.Lock()
+
+    def write(self, message: Tuple[Any, ...]):
+        # messages are written right away, so they're sent in the order they're written
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        self._writer.write(_HEADER.pack(len(data)) + data)
+
+    async def drain(self):
+        async with self._drain_lock:
+            await self._writer.drain()
+
+    async def send(self, message: Tuple[Any, ...]):
+        self.write(message)
+        await self.drain()
+
+    async def receive(self) -> Tuple[Any, ...]:
+        (size,) = _HEADER.unpack(await self._reader.readexactly(_HEADER.size))
+        return pickle.loads(await self._reader.readexactly(size))
+
+    def close(self):
+        self._writer.close()
+
+
+class ShardStorage(MachineBaseStorage):
+    """Storage backend of a shard, that makes every call on the storage backend of the dispatcher"""
+
+    def __init__(self, settings: CaseInsensitiveDict, call: Callable[..., Awaitable[Any]]):
+        super().__init__(settings)
+        self._call = call
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._call("get", key)
+
+    async def set(self, key: str, value: bytes, expires: Optional[int] = None):
+        await self._call("set", key, value, expires)
+
+    async def delete(self, key: str):
+        await self._call("delete", key)
+
+    async def has(self, key: str) -> bool:
+        return await self._call("has", key)
+
+    async def size(self) -> int:
+        return await self._call("size")
+
+    async def close(self):
+        pass
+
+
+class ShardLeases:
+    """Leases of a shard, that the dispatcher takes, so they're atomic across the shards"""
+
+    def __init__(self, call: Callable[..., Awaitable[Any]]):
+        self._call = call
+
+    async def acquire(self, key: str, holder: str, ttl: float) -> bool:
+        return await self._call("acquire", key, holder, ttl)
+
+    async def release(self, key: str, holder: str):
+        await self._call("release", key, holder)
+
+
+class ShardSocketModeClient:
+    """Stands in for the Socket Mode client in a shard, requests come from the dispatcher and responses go to it"""
+
+    def __init__(self, web_client: AsyncWebClient, link: Link):
+        self.web_client = web_client
+        self.socket_mode_request_listeners: List[Callable[..., Awaitable[None]]] = []
+        self.closed = False
+        self._link = link
+
+    async def send_socket_mode_response(self, response: Any):
+        # a shard that only updates its caches leaves responding to the shard that owns the request
+        if not _owner.get():
+            return
+        if isinstance(response, SocketModeResponse):
+            response = response.to_dict()
+        await self._link.send(("response", response))
+
+    async def connect(self):
+        # Slack Machine connects once all plugins are loaded and their handlers are registered
+        await self._link.send(("ready",))
+
+    async def close(self):
+        self.closed = True
+
+
+class ShardMachine(Machine):
+    """Slack Machine in a shard process, that gets its requests from the dispatcher, see the module docstring"""
+
+    def __init__(
+        self,
+        settings: CaseInsensitiveDict,
+        shard: int,
+        shards: int,
+        sock: socket.socket,
+        shared_storage: bool,
+        base_url: str,
+    ):
+        settings = CaseInsensitiveDict(settings)
+        # every shard serves its own metrics and records its own events
+        if settings.get("KITCHENSINK_METRICS_PORT"):
+            settings["KITCHENSINK_METRICS_PORT"] = int(settings["KITCHENSINK_METRICS_PORT"]) + shard
+        if settings.get("KITCHENSINK_RECORD_EVENTS"):
+            settings["KITCHENSINK_RECORD_EVENTS"] = f"{settings['KITCHENSINK_RECORD_EVENTS']}.{shard}"
+        super().__init__(settings)
+        self.shard = shard
+        self.shards = shards
+        self._sock = sock
+        self._shared_storage = shared_storage
+        self._base_url = base_url
+        self._link: Optional[Link] = None
+        self._tails: Dict[Optional[str], asyncio.Task] = {}
+        self._calls: Dict[int, asyncio.Future] = {}
+        self._call_ids = itertools.count()
+
+    async def _setup_storage(self):
+        if self._shared_storage:
+            await super()._setup_storage()
+        else:
+            self._storage_backend = ShardStorage(self._settings, self._call_storage)
+        # before the plugins are loaded, so they use these leases where they'd take them within the process
+        leases.install(self._settings, local=ShardLeases(self._call_storage))
+
+    async def _setup_slack_clients(self):
+        # all shards call Slack with the same token
+        scheduler.share(1 / self.shards)
+        web_client = AsyncWebClient(
+            token=self._settings["SLACK_BOT_TOKEN"], base_url=self._base_url, proxy=self._settings.get("HTTP_PROXY")
+        )
+        self._socket_mode_client = ShardSocketModeClient(web_client, self._link)
+        self._client = SlackClient(self._socket_mode_client, self._tz)
+        await self._client.setup()
+
+    async def _call_storage(self, method: str, *args: Any) -> Any:
+        call_id = next(self._call_ids)
+        future = self._calls[call_id] = asyncio.get_running_loop().create_future()
+        await self._link.send(("call", call_id, method, args))
+        return await future
+
+    async def run(self):
+        reader, writer = await asyncio.open_connection(sock=self._sock)
+        self._link = Link(reader, writer)
+        receiving = asyncio.create_task(self._receive())
+        running = asyncio.create_task(super().run())
+        await asyncio.wait([receiving, running], return_when=asyncio.FIRST_COMPLETED)
+        receiving.cancel()
+        running.cancel()
+        await asyncio.gather(receiving, running, return_exceptions=True)
+        if not running.cancelled() and running.exception() is not None:
+            raise running.exception()
+
+    async def _receive(self):
+        try:
+            while True:
+                message = await self._link.receive()
+                if message[0] == "result":
+                    _, call_id, error, result = message
+                    future = self._calls.pop(call_id, None)
+                    if future is None or future.done():
+                        continue
+                    if error is not None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(result)
+                elif message[0] == "request":
+                    _, key, owner, request = message
+                    self._enqueue(key, owner, request)
+        except asyncio.IncompleteReadError:
+            main_logger.info("Dispatcher went away, stopping shard", shard=self.shard)
+
+    def _enqueue(self, key: Optional[str], owner: bool, request: SocketModeRequest):
+        task = asyncio.create_task(self._handle(request, owner, self._tails.get(key)))
+        self._tails[key] = task
+        task.add_done_callback(functools.partial(self._release, key))
+
+    def _release(self, key: Optional[str], task: asyncio.Task):
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _handle(self, request: SocketModeRequest, owner: bool, previous: Optional[asyncio.Task]):
+        if previous is not None:
+            await asyncio.wait([previous])
+        _owner.set(owner)
+        listeners = self._socket_mode_client.socket_mode_request_listeners if owner else [self._update_caches]
+        for listener in listeners:
+            try:
+                await listener(self._socket_mode_client, request)
+            except Exception:
+                main_logger.exception("Handling request failed", shard=self.shard, type=request.type)
+
+    async def _update_caches(self, client: ShardSocketModeClient, request: SocketModeRequest):
+        await self._client._process_users_channels(client, request)
+        event = request.payload["event"]
+        for handler in self._registered_actions.process.get(event["type"], {}).values():
+            if getattr(handler, "__kitchensink_every_shard__", False):
+                await handler(event)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"shard": self.shard, "shards": self.shards, "busy_keys": len(self._tails)}
+
+
+def run_shard(shard_class: Type[ShardMachine], *args: Any):
+    """Entry point of a shard process"""
+    asyncio.run(shard_class(*args).run())
+
+
+class ShardDispatcher:
+    """Holds the Socket Mode connection and hands every request to the shard that owns it, see the module docstring
+
+    :param settings: Slack Machine settings, loaded like Slack Machine does when not given
+    :param shards: number of shard processes, ``KITCHENSINK_SHARDS`` or the number of CPUs when not given
+    :param base_url: base url of the Slack Web API
+    :param shard_class: Slack Machine class that the shards run
+    """
+
+    def __init__(
+        self,
+        settings: Optional[CaseInsensitiveDict] = None,
+        shards: Optional[int] = None,
+        base_url: str = AsyncWebClient.BASE_URL,
+        shard_class: Type[ShardMachine] = ShardMachine,
+    ):
+        self._settings = settings
+        self.shards = shards
+        self.base_url = base_url
+        self.shard_class = shard_class
+        self._storage: Optional[MachineBaseStorage] = None
+        self._leases = LocalLeases()
+        self._broker: Optional[asyncio.AbstractServer] = None
+        self._socket_mode_client: Optional[SocketModeClient] = None
+        self._processes: List[multiprocessing.Process] = []
+        self._links: List[Link] = []
+        self._ready: List[asyncio.Event] = []
+        self._unanswered: Set[str] = set()
+        self._call_tasks: Set[asyncio.Task] = set()
+        self._closing = False
+
+    async def run(self):
+        if self._settings is None:
+            self._settings, _ = import_settings(os.environ.get("SM_SETTINGS_MODULE", "local_settings"))
+        configure_logging(self._settings)
+        settings = CaseInsensitiveDict(self._settings)
+        if self.shards is None:
+            self.shards = int(settings.get("KITCHENSINK_SHARDS", os.cpu_count() or 1))
+
+        backend = settings.get("STORAGE_BACKEND", MEMORY_STORAGE)
+        shared_storage = backend != MEMORY_STORAGE
+        if not shared_storage:
+            _, cls = import_string(backend)[0]
+            self._storage = cls(settings)
+            await self._storage.init()
+        if not settings.get("KITCHENSINK_EVENT_BROKER"):
+            self._broker = await serve_broker("127.0.0.1", 0, by_event=True)
+            settings["KITCHENSINK_EVENT_BROKER"] = f"127.0.0.1:{self._broker.sockets[0].getsockname()[1]}"
+
+        context = multiprocessing.get_context("spawn")
+        serving = []
+        for shard in range(self.shards):
+            ours, theirs = socket.socketpair()
+            # not a daemon, so shards can run the command executor's process pool
+            process = context.Process(
+                target=run_shard,
+                args=(self.shard_class, settings, shard, self.shards, theirs, shared_storage, self.base_url),
+                name=f"kitchensink-shard-{shard}",
+            )
+            process.start()
+            theirs.close()
+            self._processes.append(process)
+            self._links.append(Link(*await asyncio.open_connection(sock=ours)))
+            self._ready.append(asyncio.Event())
+            serving.append(asyncio.create_task(self._serve(shard)))
+        main_logger.info("Starting shards", shards=self.shards, shared_storage=shared_storage)
+
+        ready = asyncio.create_task(asyncio.wait([asyncio.create_task(event.wait()) for event in self._ready]))
+        done, _ = await asyncio.wait([ready, *serving], return_when=asyncio.FIRST_COMPLETED)
+        if ready in done:
+            self._socket_mode_client = SocketModeClient(
+                app_token=settings["SLACK_APP_TOKEN"],
+                web_client=AsyncWebClient(
+                    token=settings["SLACK_BOT_TOKEN"], base_url=self.base_url, proxy=settings.get("HTTP_PROXY")
+                ),
+                proxy=settings.get("HTTP_PROXY"),
+            )
+            self._socket_mode_client.socket_mode_request_listeners.append(self._route)
+            await self._socket_mode_client.connect()
+            main_logger.info("Connected to Slack", shards=self.shards)
+            done, _ = await asyncio.wait(serving, return_when=asyncio.FIRST_COMPLETED)
+        ready.cancel()
+        stopped = [shard for shard, task in enumerate(serving) if task in done]
+        raise RuntimeError(f"Shard {stopped[0]} stopped")
+
+    async def _route(self, client: SocketModeClient, request: SocketModeRequest):
+        key = shard_key(request.type, request.payload)
+        owner = shard_for(key, self.shards)
+        event_type = request.payload.get("event", {}).get("type") if request.type == "events_api" else None
+        shards = range(self.shards) if event_type in CACHE_EVENTS else [owner]
+        if request.type != "events_api":
+            self._unanswered.add(request.envelope_id)
+        for shard in shards:
+            self._links[shard].write(("request", key, shard == owner, request))
+        if request.type == "events_api":
+            # Slack Machine acknowledges events without a payload before handling them, so a shard that's still busy
+            # with an earlier event in the same channel doesn't need to be waited for
+            await client.send_socket_mode_response(SocketModeResponse(envelope_id=request.envelope_id))
+        for shard in shards:
+            await self._links[shard].drain()
+
+    async def _serve(self, shard: int):
+        link = self._links[shard]
+        try:
+            while True:
+                message = await link.receive()
+                if message[0] == "response":
+                    response = message[1]
+                    # only the first response to a request counts, the rest are duplicate acknowledgements
+                    if response.get("envelope_id") in self._unanswered:
+                        self._unanswered.discard(response["envelope_id"])
+                        await self._socket_mode_client.send_socket_mode_response(response)
+                elif message[0] == "call":
+                    task = asyncio.create_task(self._call_storage(link, *message[1:]))
+                    self._call_tasks.add(task)
+                    task.add_done_callback(self._call_tasks.discard)
+                elif message[0] == "ready":
+                    self._ready[shard].set()
+        except asyncio.IncompleteReadError:
+            if not self._closing:
+                main_logger.error("Shard stopped", shard=shard, exitcode=self._processes[shard].exitcode)
+
+    async def _call_storage(self, link: Link, call_id: int, method: str, args: Tuple[Any, ...]):
+        error, result = None, None
+        try:
+            if method == "acquire":
+                result = await self._leases.acquire(*args)
+            elif method == "release":
+                result = await self._leases.release(*args)
+            elif method in STORAGE_METHODS:
+                result = await getattr(self._storage, method)(*args)
+            else:
+                raise ValueError(f"Unknown storage method: {method}")
+        except Exception as e:
+            error = e
+        try:
+            link.write(("result", call_id, error, result))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            link.write(("result", call_id, RuntimeError(repr(error)), None))
+        try:
+            await link.drain()
+        except ConnectionError:
+            # the shard went away, which is reported by _serve
+            pass
+
+    async def close(self):
+        self._closing = True
+        if self._socket_mode_client is not None:
+            await self._socket_mode_client.close()
+        for link in self._links:
+            link.close()
+        for process in self._processes:
+            # shards stop when the dispatcher closes their link
+            await asyncio.to_thread(process.join, 10)
+            if process.is_alive():
+                process.terminate()
+        if self._broker is not None:
+            self._broker.close()
+        if self._storage is not None:
+            await self._storage.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Slack Machine with the kitchensink plugins in several processes")
+    parser.add_argument("--shards", type=int, help="number of shard processes, by default KITCHENSINK_SHARDS or CPUs")
+    args = parser.parse_args()
+    # like slack-machine, the settings module is looked up in the current working directory
+    sys.path.insert(0, os.getcwd())
+    dispatcher = ShardDispatcher(shards=args.shards)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(dispatcher.run())
+    except KeyboardInterrupt:
+        main_logger.info("Stopping shards")
+    finally:
+        loop.run_until_complete(dispatcher.close())
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,26 @@
-from machine.plugins.base import MachineBasePlugin
 from machine.plugins.command import Command
 from machine.plugins.decorators import (
     command
 )
 from structlog.stdlib import get_logger, BoundLogger
 
+from sm_kitchensink_plugin.base import KitchensinkPlugin
+from sm_kitchensink_plugin.command_executor import command_executor, fast_ack
+
 main_logger = get_logger(__name__)
 
 
-class SlashCommands(MachineBasePlugin):
+def render_greeting(text: str) -> str:
+    # stands in for the blocking work a real command does, like rendering a report. It runs in the command executor,
+    # which can be a process pool, so it's a plain function at module level
+    return f"Well hello there! You sent me: {text}"
+
+
+class SlashCommands(KitchensinkPlugin):
     """Slash Commands"""
 
     @command("/hello")
+    @fast_ack("Immediate response")
     async def hello_command(self, command: Command, logger: BoundLogger):
         logger.info("command triggered", command=command.command, text=command.text)
-        yield "Immediate response"
-        await command.say(text=f"Well hello there! You sent me: {command.text}")
+        await command.say(text=await command_executor.run(render_greeting, command.text))
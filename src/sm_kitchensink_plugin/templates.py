@@ -0,0 +1,56 @@
+import copy
+from typing import Any, Dict, List, Sequence, Tuple, Union
+
+from slack_sdk.models.blocks import Block
+
+
+class BlockTemplate:
+    """Block Kit layout that is validated and serialized once, and then rendered many times
+
+    Variable parts of the layout are written as ``{name}`` placeholders in any string of the layout, and every name
+    must be listed in `fields`. Rendering only copies the dicts and lists on the path to a placeholder, the rest of the
+    serialized layout is shared between renders, so the result should be treated as read-only.
+    """
+
+    def __init__(self, layout: Sequence[Union[Block, Dict[str, Any]]], fields: Sequence[str] = ()):
+        self._blocks = [block.to_dict() if isinstance(block, Block) else block for block in layout]
+        self._fields = tuple(fields)
+        self._slots: List[Tuple[Tuple[Any, ...], str, Tuple[str, ...]]] = []
+        self._find_slots(self._blocks, ())
+
+    def _find_slots(self, node: Any, path: Tuple[Any, ...]):
+        if isinstance(node, dict):
+            items = node.items()
+        elif isinstance(node, list):
+            items = enumerate(node)
+        else:
+            if isinstance(node, str):
+                names = tuple(name for name in self._fields if f"{{{name}}}" in node)
+                if names:
+                    self._slots.append((path, node, names))
+            return
+        for key, value in items:
+            self._find_slots(value, path + (key,))
+
+    def render(self, **values: Any) -> List[Dict[str, Any]]:
+        """Fill in the placeholders of the layout
+
+        :param values: value for every field of the template
+        :return: list of serialized blocks, ready to be sent to Slack
+        """
+        if not self._slots:
+            return self._blocks
+        root = list(self._blocks)
+        copies: Dict[Tuple[Any, ...], Any] = {(): root}
+        for path, text, names in self._slots:
+            parent = root
+            for depth in range(1, len(path)):
+                node = copies.get(path[:depth])
+                if node is None:
+                    node = copies[path[:depth]] = copy.copy(parent[path[depth - 1]])
+                    parent[path[depth - 1]] = node
+                parent = node
+            for name in names:
+                text = text.replace(f"{{{name}}}", str(values[name]))
+            parent[path[-1]] = text
+        return root
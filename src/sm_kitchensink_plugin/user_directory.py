@@ -0,0 +1,73 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from machine.models import User
+
+# Sort key of a user in the directory: the lowercased name, with the user id as tie breaker
+Key = Tuple[str, str]
+
+
+class UserDirectory:
+    """Sorted index of the names of the users in the workspace
+
+    Supports looking up users by (case-insensitive) name prefix and paging through the results using the key of the
+    last user on a page as cursor, so pages stay consistent when users join or change their name in the meantime.
+    """
+
+    def __init__(self, users: Iterable[User] = ()):
+        self._names: Dict[str, str] = {user.id: user.name for user in users}
+        self._keys: List[Key] = sorted((name.lower(), user_id) for user_id, name in self._names.items())
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def upsert(self, user: User):
+        """Add a user to the directory, or update their name"""
+        old_name = self._names.get(user.id)
+        if old_name == user.name:
+            return
+        if old_name is not None:
+            del self._keys[bisect_left(self._keys, (old_name.lower(), user.id))]
+        self._names[user.id] = user.name
+        insort(self._keys, (user.name.lower(), user.id))
+
+    def _range(self, prefix: str) -> Tuple[int, int]:
+        prefix = prefix.lower()
+        # "\U0010ffff" is the highest possible character, so it sorts after every name that starts with the prefix
+        return bisect_left(self._keys, (prefix,)), bisect_left(self._keys, (prefix + "\U0010ffff",))
+
+    def count(self, prefix: str = "") -> int:
+        start, end = self._range(prefix)
+        return end - start
+
+    def iter_names(self, prefix: str = "", after: Optional[Key] = None) -> Iterator[Tuple[Key, str]]:
+        """Iterate over the users whose name starts with `prefix`, in alphabetical order
+
+        :param prefix: prefix of the names to return
+        :param after: key of the last user that was already returned, if any
+        :return: iterator of the key and name of each user
+        """
+        start, end = self._range(prefix)
+        if after is not None:
+            start = max(start, bisect_right(self._keys, after))
+        for i in range(start, end):
+            key = self._keys[i]
+            yield key, self._names[key[1]]
+
+    def page(
+        self, prefix: str = "", after: Optional[Key] = None, max_names: int = 100, max_chars: int = 2900
+    ) -> Tuple[List[str], Optional[Key]]:
+        """Get a page of names that fits in a single message section
+
+        :return: the names on the page and the cursor of the next page, which is None if this is the last page
+        """
+        names: List[str] = []
+        size = 0
+        last_key = None
+        for key, name in self.iter_names(prefix, after):
+            if len(names) == max_names or size + len(name) + 2 > max_chars:
+                return names, last_key
+            names.append(name)
+            size += len(name) + 2
+            last_key = key
+        return names, None
@@ -0,0 +1,96 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+from sm_kitchensink_plugin.channel_writer import (
+    FENCE,
+    MAX_BLOCKS,
+    MAX_SECTION_TEXT,
+    ChannelWriter,
+    Notification,
+    _sections,
+)
+
+
+def section_texts(text: str) -> list:
+    return [section["text"]["text"] for section in _sections(text)]
+
+
+def test_short_text_is_one_section():
+    assert section_texts("hello\nworld") == ["hello\nworld"]
+    assert section_texts("") == []
+
+
+def test_text_is_split_on_line_boundaries():
+    lines = [f"line {i} " + "x" * 90 for i in range(100)]
+    texts = section_texts("\n".join(lines))
+    assert len(texts) > 1
+    assert all(len(text) <= MAX_SECTION_TEXT for text in texts)
+    assert "\n".join(texts).split("\n") == lines
+
+
+def test_line_longer_than_a_section_is_cut_up():
+    texts = section_texts("y" * (MAX_SECTION_TEXT * 2))
+    assert all(len(text) <= MAX_SECTION_TEXT for text in texts)
+    assert "".join(texts) == "y" * (MAX_SECTION_TEXT * 2)
+
+
+def test_split_code_block_is_closed_and_reopened():
+    code = [f"print({i})  # " + "z" * 80 for i in range(100)]
+    texts = section_texts("\n".join(["Output:", FENCE, *code, FENCE, "done"]))
+    assert len(texts) > 1
+    for text in texts:
+        assert len(text) <= MAX_SECTION_TEXT
+        # every section has balanced fences, so it renders as code on its own
+        assert text.count(FENCE) % 2 == 0
+    assert texts[0].startswith("Output:\n" + FENCE) and texts[0].endswith("\n" + FENCE)
+    assert all(text.startswith(FENCE + "\n") for text in texts[1:])
+    assert texts[-1].endswith(FENCE + "\ndone")
+    assert [line for text in texts for line in text.split("\n") if line.startswith("print")] == code
+
+
+def test_inline_code_block_does_not_open_a_fence():
+    texts = section_texts("\n".join(["run ```ls``` first"] + ["w" * 100] * 60))
+    assert len(texts) > 1
+    assert not texts[1].startswith(FENCE)
+
+
+def writer() -> ChannelWriter:
+    client = MagicMock()
+    client.send = AsyncMock(side_effect=[{"ts": f"{i}.0"} for i in range(1, 10)])
+    client.update = AsyncMock()
+    channel_writer = ChannelWriter(window=0.01)
+    channel_writer.install(client)
+    return channel_writer
+
+
+def test_notifications_within_window_are_posted_as_one_message():
+    async def main():
+        channel_writer = writer()
+        notifications = await asyncio.gather(*(channel_writer.write("C1", f"note {i}") for i in range(3)))
+        assert notifications == [Notification("C1", "1.0", i) for i in range(3)]
+        channel_writer._client.send.assert_awaited_once()
+        assert len(channel_writer._client.send.await_args.kwargs["blocks"]) == 3
+
+    asyncio.run(main())
+
+
+def test_notifications_beyond_block_limit_are_spread_over_messages():
+    async def main():
+        channel_writer = writer()
+        notifications = await asyncio.gather(
+            *(channel_writer.write("C1", f"note {i}") for i in range(MAX_BLOCKS + 1))
+        )
+        assert channel_writer._client.send.await_count == 2
+        assert notifications[-1] == Notification("C1", "2.0", 0)
+
+    asyncio.run(main())
+
+
+def test_update_replaces_one_notification_in_its_message():
+    async def main():
+        channel_writer = writer()
+        first, _ = await asyncio.gather(channel_writer.write("C1", "one"), channel_writer.write("C1", "two"))
+        assert await channel_writer.update(first, "uno") == first
+        assert channel_writer._client.update.await_args.kwargs["text"] == "uno\n\ntwo"
+
+    asyncio.run(main())
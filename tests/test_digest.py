@@ -0,0 +1,66 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock
+
+import pytest
+from machine.storage import PluginStorage
+from machine.storage.backends.memory import MemoryStorage
+
+from sm_kitchensink_plugin.digest import LOG_KEY, SubmissionDigest
+from sm_kitchensink_plugin.leader import leader
+from sm_kitchensink_plugin.leases import leases
+
+
+@pytest.fixture
+def storage() -> PluginStorage:
+    # replicas in the same process share the local leases, like replicas on Redis share the Redis leases
+    leases.install({})
+    return PluginStorage("Modals", MemoryStorage({}))
+
+
+@pytest.fixture
+def not_leader(monkeypatch):
+    monkeypatch.setattr(leader, "_held_until", 0.0)
+
+
+def test_replicas_add_to_each_others_counts(storage):
+    async def main():
+        replicas = [SubmissionDigest(storage, AsyncMock(), interval=0, size=0) for _ in range(3)]
+        await asyncio.gather(*(digest.add_submission("pizza") for digest in replicas for _ in range(10)))
+        await replicas[0].add_cancellation()
+        log = await storage.get(LOG_KEY)
+        assert (log["submissions"], log["cancellations"], log["responses"]["pizza"]) == (30, 1, 30)
+
+    asyncio.run(main())
+
+
+def test_full_log_is_posted_once_with_all_counts(storage):
+    async def main():
+        posted = AsyncMock()
+        replicas = [SubmissionDigest(storage, posted, interval=0, size=10) for _ in range(2)]
+        await asyncio.gather(*(digest.add_submission("sushi") for digest in replicas for _ in range(5)))
+        posted.assert_awaited_once()
+        assert "10 submissions" in posted.await_args.args[0]
+        assert (await storage.get(LOG_KEY))["submissions"] == 0
+
+    asyncio.run(main())
+
+
+def test_only_leader_posts_periodic_digest(storage, monkeypatch, not_leader):
+    async def main():
+        follower_posted, leader_posted = AsyncMock(), AsyncMock()
+        follower = SubmissionDigest(storage, follower_posted, interval=0.05, size=0)
+        await follower.add_submission("salad")
+        follower.start()
+        await asyncio.sleep(0.15)
+        follower_posted.assert_not_awaited()
+        # replicas in this process share the leader election, so only one of them runs at a time
+        follower._task.cancel()
+        monkeypatch.setattr(leader, "_held_until", time.monotonic() + 60)
+        leading = SubmissionDigest(storage, leader_posted, interval=0.05, size=0)
+        leading.start()
+        await asyncio.sleep(0.15)
+        leader_posted.assert_awaited_once()
+        assert "1 submissions" in leader_posted.await_args.args[0]
+
+    asyncio.run(main())
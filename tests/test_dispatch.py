@@ -0,0 +1,68 @@
+import re
+
+import pytest
+
+from sm_kitchensink_plugin.dispatch import PatternIndex, _analyze
+
+PATTERNS = [
+    r"^reply$",
+    r"^list users",
+    r".*pin.*",
+    r"^show (?P<what>cache|api) stats$",
+    r"hello|hi",
+    r"^reply in thread",
+    r"(?m)^deploy",
+    r"^über$",
+    r"",
+]
+TEXTS = [
+    "reply",
+    "REPLY",
+    "reply\n",
+    "reply please",
+    "list users",
+    "List Users active",
+    "please pin this",
+    "PINNED",
+    "show cache stats",
+    "show disk stats",
+    "hi there",
+    "reply in thread",
+    "first line\ndeploy now",
+    "über",
+    "",
+]
+
+
+@pytest.mark.parametrize(
+    "pattern, expected",
+    [
+        (r"^reply$", ("exact", "reply")),
+        (r"^List Users", ("prefix", "list users")),
+        (r".*pin.*", ("keyword", "pin")),
+        (r"cat|dog", ("none", None)),
+        (r"(?m)^deploy", ("keyword", "deploy")),
+    ],
+)
+def test_patterns_are_prefiltered_by_their_literals(pattern, expected):
+    assert _analyze(re.compile(pattern, re.IGNORECASE)) == expected
+
+
+@pytest.mark.parametrize("flags", [0, re.IGNORECASE])
+def test_prefiltered_patterns_match_like_their_regex(flags):
+    index = PatternIndex()
+    pairs = [(re.compile(pattern, flags), index.add(re.compile(pattern, flags))) for pattern in PATTERNS]
+    for text in TEXTS:
+        for regex, prefiltered in pairs:
+            expected = regex.search(text)
+            match = prefiltered.search(text)
+            assert (match and match.group()) == (expected and expected.group()), (regex.pattern, text)
+
+
+def test_only_candidates_run_their_regex():
+    index = PatternIndex()
+    reply, list_users, pin = (index.add(re.compile(p, re.IGNORECASE)) for p in (r"^reply$", r"^list users", r"pin"))
+    assert index.candidates("Reply") == {reply}
+    assert index.candidates("list users now") == {list_users}
+    assert index.candidates("spinning") == {pin}
+    assert index.candidates("nothing to see") == frozenset()
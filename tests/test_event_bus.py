@@ -0,0 +1,130 @@
+import asyncio
+import json
+
+from sm_kitchensink_plugin.event_bus import EventBus, Subscription, serve_broker
+
+
+def test_drop_policy_drops_events_when_queue_is_full():
+    async def main():
+        release = asyncio.Event()
+        handled = []
+
+        async def handler(n):
+            await release.wait()
+            handled.append(n)
+
+        subscription = Subscription(handler, queue_size=2, policy="drop")
+        for n in range(5):
+            await subscription.put({"n": n})
+        # putting doesn't yield to the worker, so the queue holds the first two
+        assert subscription.counters["dropped"] == 3
+        release.set()
+        await subscription.queue.join()
+        assert handled == [0, 1]
+
+    asyncio.run(main())
+
+
+def test_block_policy_waits_for_room():
+    async def main():
+        release = asyncio.Event()
+
+        async def handler(n):
+            await release.wait()
+
+        subscription = Subscription(handler, queue_size=1, policy="block")
+        await subscription.put({"n": 0})
+        await asyncio.sleep(0)
+        await subscription.put({"n": 1})
+        blocked = asyncio.create_task(subscription.put({"n": 2}))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        release.set()
+        await asyncio.wait_for(blocked, 1)
+        await subscription.queue.join()
+        assert subscription.stats() == {"queued": 3, "delivered": 3, "pending": 0}
+
+    asyncio.run(main())
+
+
+def test_batches_collect_events_within_window():
+    async def main():
+        batches = []
+
+        async def handler(batch):
+            batches.append([payload["n"] for payload in batch])
+
+        subscription = Subscription(handler, batch_size=3, batch_window=0.05)
+        for n in range(4):
+            await subscription.put({"n": n})
+        await subscription.queue.join()
+        assert batches == [[0, 1, 2], [3]]
+
+    asyncio.run(main())
+
+
+def test_event_without_subscribers_is_counted_as_unhandled():
+    async def main():
+        bus = EventBus()
+        await bus.publish("nobody-listens", {})
+        assert bus.stats() == {"unhandled": 1}
+
+    asyncio.run(main())
+
+
+async def connect(port: int):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    return reader, writer
+
+
+async def received(reader: asyncio.StreamReader) -> list:
+    events = []
+    while True:
+        try:
+            line = await asyncio.wait_for(reader.readline(), 0.1)
+        except asyncio.TimeoutError:
+            return events
+        events.append(json.loads(line)["event"])
+
+
+def test_broker_hands_each_event_to_one_client_in_turn():
+    async def main():
+        server = await serve_broker("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        clients = [await connect(port) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        sender = clients[0][1]
+        for n in range(4):
+            sender.write(json.dumps({"event": f"e{n}", "payload": {}}).encode() + b"\n")
+        await sender.drain()
+        events = [await received(reader) for reader, _ in clients]
+        assert sorted(events[0] + events[1]) == ["e0", "e1", "e2", "e3"]
+        assert len(events[0]) == len(events[1]) == 2
+        for _, writer in clients:
+            writer.close()
+        server.close()
+
+    asyncio.run(main())
+
+
+def test_broker_by_event_sends_an_event_to_the_same_client():
+    async def main():
+        server = await serve_broker("127.0.0.1", 0, by_event=True)
+        port = server.sockets[0].getsockname()[1]
+        clients = [await connect(port) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        sender = clients[0][1]
+        for n in range(12):
+            sender.write(json.dumps({"event": f"e{n % 4}", "payload": {}}).encode() + b"\n")
+        await sender.drain()
+        events = [await received(reader) for reader, _ in clients]
+        assert sum(len(client_events) for client_events in events) == 12
+        for client_events in events:
+            for event in set(client_events):
+                # every line of an event went to this client
+                assert client_events.count(event) == 3
+        for _, writer in clients:
+            writer.close()
+        server.close()
+
+    asyncio.run(main())
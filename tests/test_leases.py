@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+import pytest
+
+from sm_kitchensink_plugin import leases as leases_module
+from sm_kitchensink_plugin.leader import LeaderElection
+from sm_kitchensink_plugin.leases import Leases, LocalLeases, leases
+
+SQLITE_STORAGE = "machine.storage.backends.sqlite.SQLiteStorage"
+
+
+def test_lease_is_held_by_one_holder_until_it_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(leases_module.time, "monotonic", lambda: now[0])
+    local = LocalLeases()
+
+    async def main():
+        assert await local.acquire("key", "a", 10)
+        assert not await local.acquire("key", "b", 10)
+        # the holder renews it
+        now[0] += 9
+        assert await local.acquire("key", "a", 10)
+        now[0] += 9
+        assert not await local.acquire("key", "b", 10)
+        now[0] += 2
+        assert await local.acquire("key", "b", 10)
+
+    asyncio.run(main())
+
+
+def test_only_the_holder_releases_a_lease():
+    local = LocalLeases()
+
+    async def main():
+        assert await local.acquire("key", "a", 10)
+        await local.release("key", "b")
+        assert not await local.acquire("key", "b", 10)
+        await local.release("key", "a")
+        assert await local.acquire("key", "b", 10)
+
+    asyncio.run(main())
+
+
+def test_lock_runs_blocks_one_at_a_time():
+    shared = Leases()
+    shared.install({})
+    running, overlaps = [], []
+
+    async def critical_section():
+        async with shared.lock("key", poll=0.001):
+            overlaps.append(len(running))
+            running.append(1)
+            await asyncio.sleep(0.005)
+            running.pop()
+
+    async def main():
+        await asyncio.gather(*(critical_section() for _ in range(10)))
+
+    asyncio.run(main())
+    assert overlaps == [0] * 10
+
+
+def test_other_backends_take_leases_within_the_process_by_default():
+    shared = Leases()
+    shared.install({"STORAGE_BACKEND": SQLITE_STORAGE})
+    assert isinstance(shared._leases, LocalLeases)
+
+
+def test_other_backends_are_refused_with_multiple_replicas():
+    with pytest.raises(ValueError):
+        Leases().install({"STORAGE_BACKEND": SQLITE_STORAGE, "KITCHENSINK_MULTI_REPLICA": "true"})
+
+
+def test_leases_of_a_shard_are_used_instead_of_the_local_ones():
+    shard_leases = LocalLeases()
+    shared = Leases()
+    shared.install({"STORAGE_BACKEND": SQLITE_STORAGE}, local=shard_leases)
+    assert shared._leases is shard_leases
+
+
+def test_one_replica_is_elected_and_another_takes_over_when_it_goes_away(monkeypatch):
+    now = [1000.0]
+    # the leases and the leader election read the same clock
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    leases.install({})
+
+    async def main():
+        first, second = LeaderElection(ttl=15), LeaderElection(ttl=15)
+        assert await first.try_acquire()
+        assert not await second.try_acquire()
+        assert first.is_leader and not second.is_leader
+        # the first replica stops renewing the lease
+        now[0] += 16
+        assert not first.is_leader
+        assert await second.try_acquire()
+        assert second.is_leader
+
+    asyncio.run(main())
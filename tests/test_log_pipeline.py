@@ -0,0 +1,82 @@
+import io
+import json
+import logging
+
+import pytest
+import structlog
+from machine.utils.logging import configure_logging
+from structlog.processors import ExceptionRenderer, TimeStamper
+
+from sm_kitchensink_plugin.log_pipeline import LogPipeline, capture_exc_info
+
+
+@pytest.fixture
+def output():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    # like at startup, Slack Machine's handler is the only one
+    for handler in handlers:
+        root.removeHandler(handler)
+    configure_logging({"LOGLEVEL": "INFO"})
+    stream = io.StringIO()
+    root.handlers[0].setStream(stream)
+    root.handlers[0].formatter.processors[-1] = structlog.processors.JSONRenderer()
+    yield stream
+    structlog.reset_defaults()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def install(settings: dict) -> LogPipeline:
+    # pytest captures logs with handlers of its own while a test runs
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if not isinstance(handler.formatter, structlog.stdlib.ProcessorFormatter):
+            root.removeHandler(handler)
+    pipeline = LogPipeline()
+    pipeline.install(settings)
+    return pipeline
+
+
+def records(stream: io.StringIO) -> list:
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_timestamp_and_exceptions_are_rendered_on_the_writer_thread(output):
+    pipeline = install({})
+    processors = structlog.get_config()["processors"]
+    assert capture_exc_info in processors
+    assert not any(isinstance(processor, (TimeStamper, ExceptionRenderer)) for processor in processors)
+
+    logger = structlog.stdlib.get_logger("test")
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("Handling %s failed", "reaction", user="U1")
+    logger.debug("Not logged")
+    logging.getLogger("stdlib").warning("From the %s", "standard library")
+    pipeline.stop()
+
+    handled, foreign = records(output)
+    assert handled["event"] == "Handling reaction failed"
+    assert "ValueError: boom" in handled["exception"]
+    assert handled["func_name"] == "test_timestamp_and_exceptions_are_rendered_on_the_writer_thread"
+    assert handled["timestamp"].endswith("Z")
+    assert foreign["event"] == "From the standard library"
+    assert "timestamp" in foreign
+
+
+def test_sampled_out_records_are_dropped(output):
+    pipeline = install({"KITCHENSINK_LOG_SAMPLING": {"Sampled": 10}})
+    logger = structlog.stdlib.get_logger("test")
+    for _ in range(20):
+        logger.info("Sampled")
+    pipeline.stop()
+
+    logged = records(output)
+    assert len(logged) == 2
+    assert all(record["sample_rate"] == 10 for record in logged)
+    assert pipeline.stats()["sampled_out"] == 18
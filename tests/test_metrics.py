@@ -0,0 +1,44 @@
+import asyncio
+
+from machine.plugins.decorators import listen_to
+
+from sm_kitchensink_plugin.event_bus import EventBus, subscribe
+from sm_kitchensink_plugin.metrics import Metrics
+
+
+class Plugin:
+    @listen_to(r"^hello")
+    async def hello(self, msg):
+        pass
+
+    @subscribe("order-placed", batch_size=10, batch_window=0.01)
+    async def orders(self, batch):
+        raise ValueError("out of stock")
+
+    async def helper(self):
+        pass
+
+
+def test_handlers_and_subscribed_methods_are_instrumented():
+    metrics = Metrics()
+    metrics.instrument_class(Plugin)
+    assert sorted(metrics.handlers) == ["Plugin.hello", "Plugin.orders"]
+    # the decorators' metadata stays on the wrapper, so Slack Machine and the event bus still find the handlers
+    assert Plugin.hello.metadata.plugin_actions.listen_to
+    assert Plugin.orders.__kitchensink_subscriptions__ == [("order-placed", {"batch_size": 10, "batch_window": 0.01})]
+
+
+def test_subscribed_bound_method_is_measured_per_batch():
+    metrics = Metrics()
+    metrics.instrument_class(Plugin)
+
+    async def main():
+        bus = EventBus()
+        subscription = bus.subscribe("order-placed", Plugin().orders, batch_size=10, batch_window=0.01)
+        for n in range(3):
+            await bus.publish("order-placed", {"n": n})
+        await subscription.queue.join()
+
+    asyncio.run(main())
+    assert metrics.summary()["Plugin.orders"]["invocations"] == 1
+    assert metrics.summary()["Plugin.orders"]["errors"] == 1
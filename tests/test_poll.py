@@ -0,0 +1,56 @@
+import asyncio
+from collections import Counter
+from unittest.mock import AsyncMock
+
+import pytest
+from machine.storage import PluginStorage
+from machine.storage.backends.memory import MemoryStorage
+
+from sm_kitchensink_plugin.leases import leases
+from sm_kitchensink_plugin.poll import PollEngine
+
+POLL = ("C1", "1.0")
+
+
+@pytest.fixture
+def storage() -> PluginStorage:
+    # replicas in the same process share the local leases, like replicas on Redis share the Redis leases
+    leases.install({})
+    return PluginStorage("BlockKit", MemoryStorage({}))
+
+
+def test_vote_moves_and_repeated_vote_is_a_no_op(storage):
+    async def main():
+        engine = PollEngine(storage, AsyncMock(), window=0.01)
+        assert await engine.vote(POLL, "U1", "pizza")
+        assert not await engine.vote(POLL, "U1", "pizza")
+        assert await engine.vote(POLL, "U1", "sushi")
+        assert await engine.tally(POLL) == Counter({"sushi": 1})
+
+    asyncio.run(main())
+
+
+def test_replicas_keep_each_others_votes(storage):
+    async def main():
+        changed = AsyncMock()
+        replicas = [PollEngine(storage, changed, window=0.05) for _ in range(3)]
+        await asyncio.gather(
+            *(replicas[i % 3].vote(POLL, f"U{i}", "pizza" if i % 2 else "sushi") for i in range(30))
+        )
+        assert await replicas[0].tally(POLL) == Counter({"pizza": 15, "sushi": 15})
+        await asyncio.sleep(0.1)
+        # every replica reports the tally once after the burst, with the votes of all replicas
+        assert changed.await_count == 3
+        assert all(call.args == (POLL, Counter({"pizza": 15, "sushi": 15})) for call in changed.await_args_list)
+
+    asyncio.run(main())
+
+
+def test_locks_are_kept_for_recently_voted_polls_only(storage):
+    async def main():
+        engine = PollEngine(storage, AsyncMock(), window=0.01, active=2)
+        for i in range(5):
+            await engine.vote(("C1", f"{i}.0"), "U1", "pizza")
+        assert len(engine._locks) == 2
+
+    asyncio.run(main())
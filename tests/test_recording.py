@@ -0,0 +1,74 @@
+import json
+import re
+
+import pytest
+
+import sm_kitchensink_plugin.listening_advanced  # noqa: F401, registers the patterns
+import sm_kitchensink_plugin.listening_basics  # noqa: F401, registers the patterns
+from sm_kitchensink_plugin.recording import EventRecorder, mask
+
+
+def message(text: str) -> dict:
+    return {"type": "events_api", "event": {"type": "message", "text": text, "user": "U1", "ts": "1.0"}}
+
+
+def recorded_text(text: str, redact: bool = True):
+    recorder = EventRecorder()
+    recorder.redact = redact
+    payload = recorder._select("events_api", message(text))
+    return None if payload is None else payload["event"]["text"]
+
+
+def test_mask_keeps_shape():
+    assert mask("Call me at 555-1234, ok?") == "xxxx xx xx 000-0000, xx?"
+
+
+def test_text_outside_keyword_is_masked():
+    text = "my ssn is 123-45-6789, happy shopping"
+    recorded = recorded_text(text)
+    assert recorded == "xx xxx xx 000-00-0000, xxxxx xxxxpinx"
+    assert re.search(r".*pin.*", recorded)
+
+
+def test_prefix_is_kept_and_group_masked():
+    assert recorded_text("list users alice") == "list users xxxxx"
+
+
+def test_mention_is_kept():
+    assert recorded_text("<@U0BOT> I love you, Bob") == "<@U0BOT> I love you, xxx"
+
+
+def test_literals_of_all_matching_patterns_are_kept():
+    assert recorded_text("greetings from the pinball club") == "greetings xxxx xxx pinxxxx xxxx"
+
+
+@pytest.mark.parametrize("text", ["nothing to see here", ""])
+def test_unmatched_message_is_not_recorded(text):
+    assert recorded_text(text) is None
+
+
+def test_text_is_kept_without_redaction():
+    assert recorded_text("my ssn is 123-45-6789, happy shopping", redact=False) == (
+        "my ssn is 123-45-6789, happy shopping"
+    )
+
+
+def test_block_actions_record_no_typed_text():
+    secret = "my secret password 1234"
+    picked = {"text": {"type": "plain_text", "text": secret}, "value": secret}
+    element = {"type": "plain_text_input", "value": secret}
+    payload = {
+        "type": "block_actions",
+        "actions": [
+            {"action_id": "input", "block_id": "b1", "type": "plain_text_input", "value": secret},
+            {"action_id": "select", "block_id": "b2", "type": "static_select", "selected_option": picked},
+            {"action_id": "multi", "block_id": "b3", "type": "multi_static_select", "selected_options": [picked]},
+        ],
+        "state": {"values": {"b1": {"input": element}, "b2": {"select": {"selected_option": picked}}}},
+        "view": {"id": "V1", "state": {"values": {"b3": {"multi": {"selected_options": [picked]}}}}},
+    }
+    recorded = EventRecorder()._select("interactive", payload)
+    assert secret not in json.dumps(recorded)
+    assert recorded["actions"][0]["value"] == "xx xxxxxx xxxxxxxx 0000"
+    assert recorded["actions"][0]["action_id"] == "input"
+    assert secret in json.dumps(payload)
@@ -0,0 +1,131 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from machine.storage import PluginStorage
+from machine.storage.backends.memory import MemoryStorage
+
+from sm_kitchensink_plugin import scheduled_replies
+from sm_kitchensink_plugin.leases import leases
+from sm_kitchensink_plugin.scheduled_replies import PENDING_KEY, ScheduledReplies, TimerWheel
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(scheduled_replies.time, "monotonic", clock)
+    return clock
+
+
+def test_timer_expires_after_delay(clock):
+    wheel = TimerWheel(tick=0.1)
+    wheel.add("a", 10)
+    clock.now += 9.9
+    assert wheel.advance() == []
+    clock.now += 0.2
+    assert wheel.advance() == ["a"]
+    assert len(wheel) == 0
+
+
+def test_timer_added_after_idle_period_waits_full_delay(clock):
+    wheel = TimerWheel(tick=0.1)
+    # nothing advances the wheel while it has no timers
+    clock.now += 60
+    wheel.add("a", 10)
+    clock.now += 0.1
+    assert wheel.advance() == []
+    clock.now += 9.8
+    assert wheel.advance() == []
+    clock.now += 0.2
+    assert wheel.advance() == ["a"]
+
+
+def test_timer_added_while_wheel_lags_behind_waits_full_delay(clock):
+    wheel = TimerWheel(tick=0.1)
+    wheel.add("a", 1)
+    clock.now += 60
+    wheel.add("b", 10)
+    assert wheel.advance() == ["a"]
+    clock.now += 9.9
+    assert wheel.advance() == []
+    clock.now += 0.2
+    assert wheel.advance() == ["b"]
+
+
+def test_cancelled_timer_does_not_expire(clock):
+    wheel = TimerWheel(tick=0.1)
+    wheel.add("a", 1)
+    assert wheel.cancel("a")
+    clock.now += 2
+    assert wheel.advance() == []
+
+
+def replica(storage: PluginStorage) -> ScheduledReplies:
+    client = MagicMock()
+    client.send = AsyncMock()
+    client.send_dm = AsyncMock()
+    return ScheduledReplies(storage, client, tick=0.01)
+
+
+def sent(*replicas: ScheduledReplies) -> list:
+    calls = []
+    for replies in replicas:
+        calls += replies._client.send.await_args_list + replies._client.send_dm.await_args_list
+    return sorted(call.args[1] for call in calls)
+
+
+@pytest.fixture
+def storage() -> PluginStorage:
+    # replicas in the same process share the local leases, like replicas on Redis share the Redis leases
+    leases.install({})
+    return PluginStorage("ListeningAdvanced", MemoryStorage({}))
+
+
+def test_replicas_keep_each_others_pending_replies(storage):
+    async def main():
+        first, second = replica(storage), replica(storage)
+        await first.start()
+        await second.start()
+        await asyncio.gather(first.schedule("U1", "one", 60), second.schedule("U2", "two", 60, channel="C1"))
+        pending = await storage.get(PENDING_KEY)
+        assert sorted(item["text"] for item in pending.values()) == ["one", "two"]
+        assert not await second.schedule("U1", "one", 60)
+
+    asyncio.run(main())
+
+
+def test_restored_replies_are_sent_once(storage):
+    async def main():
+        before_restart = replica(storage)
+        await before_restart.schedule("U1", "one", 0.2)
+        await before_restart.schedule("U2", "two", 0.2, channel="C1")
+        replicas = [replica(storage) for _ in range(3)]
+        for replies in replicas:
+            await replies.start()
+        await asyncio.sleep(0.5)
+        assert sent(before_restart, *replicas) == ["one", "two"]
+        assert await storage.get(PENDING_KEY) == {}
+
+    asyncio.run(main())
+
+
+def test_reply_cancelled_on_another_replica_is_not_sent(storage):
+    async def main():
+        first, second = replica(storage), replica(storage)
+        await first.schedule("U1", "one", 0.2)
+        await second.start()
+        await first.start()
+        assert await second.cancel("U1") == 1
+        await asyncio.sleep(0.4)
+        assert sent(first, second) == []
+        assert first.stats()["sent_elsewhere"] == 1
+
+    asyncio.run(main())
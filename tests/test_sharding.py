@@ -0,0 +1,143 @@
+import asyncio
+import itertools
+import socket
+from collections import Counter
+from typing import List, Tuple
+from unittest.mock import AsyncMock, MagicMock
+
+from machine.storage import PluginStorage
+from machine.storage.backends.memory import MemoryStorage
+from slack_sdk.socket_mode.request import SocketModeRequest
+
+from sm_kitchensink_plugin.leases import leases
+from sm_kitchensink_plugin.poll import PollEngine
+from sm_kitchensink_plugin.sharding import (
+    Link,
+    ShardDispatcher,
+    ShardLeases,
+    ShardMachine,
+    ShardStorage,
+    shard_for,
+    shard_key,
+)
+
+
+def test_requests_are_keyed_by_channel_or_user():
+    assert shard_key("events_api", {"event": {"type": "message", "channel": "C1", "user": "U1"}}) == "C1"
+    assert shard_key("events_api", {"event": {"type": "reaction_added", "item": {"channel": "C2"}}}) == "C2"
+    assert shard_key("events_api", {"event": {"type": "channel_created", "channel": {"id": "C3"}}}) == "C3"
+    assert shard_key("events_api", {"event": {"type": "app_home_opened", "user": "U1"}}) == "U1"
+    assert shard_key("slash_commands", {"channel_id": "C4", "user_id": "U1"}) == "C4"
+    assert shard_key("interactive", {"container": {"channel_id": "C5"}, "user": {"id": "U1"}}) == "C5"
+    assert shard_key("interactive", {"type": "view_submission", "user": {"id": "U2"}}) == "U2"
+
+
+def test_keys_map_to_the_same_shard_in_every_process():
+    # crc32 of the key, so this doesn't depend on hash randomization
+    assert [shard_for(key, 4) for key in ("C1", "C2", "C3", "U1")] == [3, 1, 3, 0]
+    assert shard_for(None, 4) == 0
+    assert min(Counter(shard_for(f"C{i}", 4) for i in range(1000)).values()) > 200
+
+
+def dispatcher(shards: int) -> ShardDispatcher:
+    dispatcher = ShardDispatcher(settings={}, shards=shards)
+    dispatcher._links = [MagicMock(drain=AsyncMock()) for _ in range(shards)]
+    return dispatcher
+
+
+def request(type_: str, payload: dict) -> SocketModeRequest:
+    return SocketModeRequest(type=type_, envelope_id="E1", payload=payload)
+
+
+def written(dispatcher: ShardDispatcher) -> list:
+    """(shard, owner) of every request written to a shard"""
+    return [
+        (shard, call.args[0][2]) for shard, link in enumerate(dispatcher._links) for call in link.write.call_args_list
+    ]
+
+
+def test_request_goes_to_the_shard_that_owns_its_channel():
+    async def main():
+        shards = dispatcher(4)
+        client = MagicMock(send_socket_mode_response=AsyncMock())
+        await shards._route(client, request("events_api", {"event": {"type": "message", "channel": "C1"}}))
+        assert written(shards) == [(shard_for("C1", 4), True)]
+        client.send_socket_mode_response.assert_awaited_once()
+
+    asyncio.run(main())
+
+
+def test_cache_events_go_to_every_shard_and_one_owns_them():
+    async def main():
+        shards = dispatcher(3)
+        client = MagicMock(send_socket_mode_response=AsyncMock())
+        event = {"type": "member_joined_channel", "channel": "C1", "user": "U1"}
+        await shards._route(client, request("events_api", {"event": event}))
+        assert written(shards) == [(shard, shard == shard_for("C1", 3)) for shard in range(3)]
+
+    asyncio.run(main())
+
+
+def test_shards_acknowledge_interactions_themselves():
+    async def main():
+        shards = dispatcher(2)
+        client = MagicMock(send_socket_mode_response=AsyncMock())
+        await shards._route(client, request("slash_commands", {"channel_id": "C1", "command": "/echo"}))
+        client.send_socket_mode_response.assert_not_awaited()
+        assert shards._unanswered == {"E1"}
+
+    asyncio.run(main())
+
+
+async def connect_shards(dispatcher: ShardDispatcher, shards: int) -> Tuple[List[ShardMachine], List[asyncio.Task]]:
+    """Shards in this process that call the storage and leases of `dispatcher` over a socket, like shard processes"""
+    dispatcher._storage = MemoryStorage({})
+    clients, tasks = [], []
+    for shard in range(shards):
+        ours, theirs = socket.socketpair()
+        dispatcher._links.append(Link(*await asyncio.open_connection(sock=ours)))
+        machine = ShardMachine.__new__(ShardMachine)
+        machine.shard = shard
+        machine._link = Link(*await asyncio.open_connection(sock=theirs))
+        machine._calls, machine._call_ids = {}, itertools.count()
+        tasks += [asyncio.create_task(dispatcher._serve(shard)), asyncio.create_task(machine._receive())]
+        clients.append(machine)
+    return clients, tasks
+
+
+def test_shards_share_the_storage_and_leases_of_the_dispatcher():
+    async def main():
+        shards = ShardDispatcher(settings={}, shards=3)
+        machines, tasks = await connect_shards(shards, 3)
+        first, second, _ = (ShardLeases(machine._call_storage) for machine in machines)
+        assert await first.acquire("key", "first", 10)
+        assert not await second.acquire("key", "second", 10)
+        await first.release("key", "first")
+        assert await second.acquire("key", "second", 10)
+
+        storage = ShardStorage({}, machines[0]._call_storage)
+        await storage.set("key", b"value")
+        assert await ShardStorage({}, machines[2]._call_storage).get("key") == b"value"
+        for task in tasks:
+            task.cancel()
+
+    asyncio.run(main())
+
+
+def test_votes_cast_on_different_shards_are_all_counted(monkeypatch):
+    async def main():
+        shards = ShardDispatcher(settings={}, shards=3)
+        machines, tasks = await connect_shards(shards, 3)
+        # every shard process has leases that the dispatcher takes, the shards in this process share those of one
+        monkeypatch.setattr(leases, "_leases", ShardLeases(machines[0]._call_storage))
+        engines = []
+        for machine in machines:
+            storage = PluginStorage("BlockKit", ShardStorage({}, machine._call_storage))
+            engines.append(PollEngine(storage, AsyncMock(), window=0.01))
+        poll = ("C1", "1.0")
+        await asyncio.gather(*(engines[i % 3].vote(poll, f"U{i}", "pizza" if i % 2 else "sushi") for i in range(12)))
+        assert await engines[1].tally(poll) == Counter({"pizza": 6, "sushi": 6})
+        for task in tasks:
+            task.cancel()
+
+    asyncio.run(main())